@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Reader for Android sparse images (as produced by img2simg, or ext2simg)
+
+A sparse image is a file header, followed by chunks, each describing a run of blocks in the expanded image:
+    RAW: data follows the chunk header
+    FILL: the run is filled with a repeated 4-byte value
+    DONT_CARE: the run is not written at all
+    CRC32: checksum of the data so far, does not take up any blocks
+https://android.googlesource.com/platform/system/core/+/master/libsparse/sparse_format.h
+"""
+# pylint: disable=line-too-long
+
+import os
+import struct
+
+SPARSE_MAGIC = 0xed26ff3a
+SPARSE_MAJOR_VERSION = 1
+FILE_HEADER = struct.Struct('<IHHHHIIII')  # magic, major, minor, file header size, chunk header size, block size, total blocks, total chunks, checksum
+CHUNK_HEADER = struct.Struct('<HHII')  # chunk type, reserved, size in blocks, total size in bytes (including header)
+
+CHUNK_TYPE_RAW = 0xcac1
+CHUNK_TYPE_FILL = 0xcac2
+CHUNK_TYPE_DONT_CARE = 0xcac3
+CHUNK_TYPE_CRC32 = 0xcac4
+
+
+class SparseChunk:
+    """ one chunk of a sparse image, with offsets relative to the expanded image """
+    def __init__(self, chunk_type:int, offset:int, length:int, data_offset:int=None, fill:int=None) -> None:
+        self.chunk_type = chunk_type
+        self.offset = offset  # bytes, in expanded image
+        self.length = length  # bytes, in expanded image
+        self.data_offset = data_offset  # bytes, in sparse file (RAW only)
+        self.fill = fill  # 32-bit fill value (FILL only)
+
+
+def is_sparse_image(filepath:str) -> bool:
+    """ check if a file starts with the sparse image magic """
+    with open(filepath, 'rb') as spf:
+        magic = spf.read(4)
+    return len(magic) == 4 and struct.unpack('<I', magic)[0] == SPARSE_MAGIC
+
+
+class SparseImage:
+    """ parses the header of an Android sparse image, and its chunk list on demand
+        nothing is ever expanded; chunks only describe where data lives
+    """
+    def __init__(self, filepath:str) -> None:
+        self.filepath = filepath
+        self.file_size = os.path.getsize(filepath)
+        with open(filepath, 'rb') as spf:
+            header = spf.read(FILE_HEADER.size)
+        if len(header) < FILE_HEADER.size:
+            raise ValueError(f'Not a sparse image, too short: {filepath}')
+        (magic, major, _minor, file_header_size, chunk_header_size, block_size, total_blocks, total_chunks, _checksum) = FILE_HEADER.unpack(header)
+        if magic != SPARSE_MAGIC:
+            raise ValueError(f'Not a sparse image: {filepath}')
+        if major != SPARSE_MAJOR_VERSION:
+            raise ValueError(f'Unsupported sparse image version: {major}')
+        if block_size == 0 or block_size % 4 != 0:
+            raise ValueError(f'Invalid sparse image block size: {block_size}')
+        self.file_header_size = file_header_size
+        self.chunk_header_size = chunk_header_size
+        self.block_size = block_size
+        self.total_blocks = total_blocks
+        self.total_chunks = total_chunks
+
+    @property
+    def expanded_size(self) -> int:
+        """ size of the image once expanded, in bytes """
+        return self.total_blocks * self.block_size
+
+    def chunks(self):
+        """ yield a SparseChunk for every chunk in the image, in order """
+        with open(self.filepath, 'rb') as spf:
+            position = self.file_header_size
+            offset = 0
+            for index in range(self.total_chunks):
+                spf.seek(position)
+                header = spf.read(CHUNK_HEADER.size)
+                if len(header) < CHUNK_HEADER.size:
+                    raise ValueError(f'Sparse image is truncated at chunk {index}')
+                (chunk_type, _reserved, chunk_blocks, total_size) = CHUNK_HEADER.unpack(header)
+                data_offset = position + self.chunk_header_size
+                data_size = total_size - self.chunk_header_size
+                length = chunk_blocks * self.block_size
+                if chunk_type == CHUNK_TYPE_RAW:
+                    if data_size != length or data_offset + data_size > self.file_size:
+                        raise ValueError(f'Invalid RAW chunk {index}: {data_size} bytes of data for {chunk_blocks} blocks')
+                    yield SparseChunk(chunk_type, offset, length, data_offset=data_offset)
+                elif chunk_type == CHUNK_TYPE_FILL:
+                    if data_size != 4:
+                        raise ValueError(f'Invalid FILL chunk {index}: {data_size} bytes of fill value')
+                    spf.seek(data_offset)
+                    (fill,) = struct.unpack('<I', spf.read(4))
+                    yield SparseChunk(chunk_type, offset, length, fill=fill)
+                elif chunk_type == CHUNK_TYPE_DONT_CARE:
+                    yield SparseChunk(chunk_type, offset, length)
+                elif chunk_type != CHUNK_TYPE_CRC32:
+                    raise ValueError(f'Unknown sparse chunk type: {hex(chunk_type)} at chunk {index}')
+                position += total_size
+                offset += length
+            if offset != self.expanded_size:
+                raise ValueError(f'Sparse image chunks cover {offset} bytes, but header says {self.expanded_size}')
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Measure startup time of each superbird_tool command
+
+Runs "COMMAND --help" for every command (which parses arguments, then exits before doing anything),
+    and a real convert_env_dump on a generated env dump, several times each, and prints a table
+Works against plain python (default), or a standalone binary built by make-binary.sh:
+    python3 benchmark_startup.py
+    python3 benchmark_startup.py --binary ./superbird_tool.bin
+When benchmarking plain python, also reports whether a command imported pyamlboot or usb (it should not, for offline commands)
+"""
+# pylint: disable=line-too-long,broad-except
+
+import os
+import sys
+import time
+import struct
+import argparse
+import binascii
+import tempfile
+import subprocess
+
+from pathlib import Path
+
+from superbird_tool import COMMANDS
+
+TOOL_PATH = Path(os.path.dirname(__file__)).joinpath('superbird_tool.py')
+RUNS = 10  # runs per command, best and mean are reported
+DEVICE_MODULES = ['pyamlboot', 'usb.core']
+
+
+def make_env_dump(env_dump:str):
+    """ write a small env partition dump, for convert_env_dump to parse """
+    env_data = b'\x00'.join([f'key{index}=value{index}'.encode('ascii') for index in range(100)]) + b'\x00\x00'
+    with open(env_dump, 'wb') as evf:
+        evf.write(struct.pack('I', binascii.crc32(env_data) & 0xffffffff))
+        evf.write(env_data)
+
+
+def time_command(base_command:list, args:list, runs:int) -> tuple:
+    """ run a command several times, returns tuple of: best, mean (in ms) """
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(base_command + args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+        times.append((time.perf_counter() - start) * 1000)
+    return (min(times), sum(times) / len(times))
+
+
+def imports_device_modules(args:list) -> bool:
+    """ check if running the command with plain python imports any of DEVICE_MODULES """
+    result = subprocess.run([sys.executable, '-X', 'importtime', str(TOOL_PATH)] + args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=False)
+    imported = [line.split('|')[-1].strip() for line in result.stderr.decode('utf-8', errors='replace').splitlines() if '|' in line]
+    return bool([module for module in DEVICE_MODULES if module in imported])
+
+
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(description='Measure startup time of each superbird_tool command')
+    argument_parser.add_argument('--binary', action='store', type=str, metavar=('BINARY'), help='benchmark this standalone binary (from make-binary.sh) instead of plain python')
+    argument_parser.add_argument('--runs', action='store', type=int, default=RUNS, metavar=('COUNT'), help=f'runs per command (default: {RUNS})')
+    args = argument_parser.parse_args()
+
+    if args.binary:
+        BASE_COMMAND = [os.path.abspath(args.binary)]
+        print(f'Benchmarking binary: {BASE_COMMAND[0]}')
+    else:
+        BASE_COMMAND = [sys.executable, str(TOOL_PATH)]
+        print(f'Benchmarking python: {sys.executable} {TOOL_PATH}')
+
+    with tempfile.TemporaryDirectory() as TEMP_DIR:
+        ENV_DUMP = os.path.join(TEMP_DIR, 'env.dump')
+        ENV_TXT = os.path.join(TEMP_DIR, 'env.txt')
+        make_env_dump(ENV_DUMP)
+        CASES = [(f'{name} --help', [name, '--help'], needs_device) for name, (_args, _help, needs_device) in COMMANDS.items()]
+        CASES.append(('convert_env_dump (real)', ['convert_env_dump', ENV_DUMP, ENV_TXT], False))
+
+        print('')
+        print(f'{"command":<36} {"device":>7} {"best":>10} {"mean":>10} {"loads usb":>10}')
+        for (LABEL, CASE_ARGS, NEEDS_DEVICE) in CASES:
+            (BEST, MEAN) = time_command(BASE_COMMAND, CASE_ARGS, args.runs)
+            LOADS_USB = '-' if args.binary else ('yes' if imports_device_modules(CASE_ARGS) else 'no')
+            print(f'{LABEL:<36} {"yes" if NEEDS_DEVICE else "no":>7} {round(BEST, 1):>8}ms {round(MEAN, 1):>8}ms {LOADS_USB:>10}')
@@ -30,3 +30,4 @@ else
 fi
 
 echo "Completed build of $OUTPUT_FILE"
+echo "  to measure its startup time: python3 benchmark_startup.py --binary $OUTPUT_FILE"
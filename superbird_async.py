@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+Asynchronous USB transfer engine for superbird in USB Burn Mode
+
+pyamlboot is synchronous: every request waits out a full USB round trip before the next one is queued
+This engine uses the asynchronous API of libusb (through python-libusb1) to keep several requests in flight,
+    which matters most on high-latency paths (hubs, VMs, USB over network)
+
+Only memory reads and writes go through the engine, using the same requests as pyamlboot:
+    read: control transfers of up to 64 bytes (REQ_READ_MEM)
+    write: one control transfer to set up a large write (REQ_WR_LARGE_MEM), followed by bulk transfers of one block each
+
+python-libusb1 is optional, install it with: python3 -m pip install libusb1
+"""
+# pylint: disable=line-too-long,broad-except
+
+from struct import pack
+from contextlib import contextmanager
+
+from usb.core import USBError
+
+try:
+    import usb1
+except ImportError:
+    usb1 = None
+
+VENDOR_ID = 0x1b8e
+PRODUCT_ID = 0xc003
+INTERFACE = 0
+REQ_READ_MEM = 0x02
+REQ_WR_LARGE_MEM = 0x11
+READ_BLOCK_SIZE = 64  # maximum size of a single memory read request
+MAX_WRITE_BLOCKS = 65535  # block count of a large memory write is sent in a 16-bit field, larger writes are split (as pyamlboot does)
+TRANSFER_TIMEOUT = 1000  # ms
+DEFAULT_DEPTH = 8  # transfers in flight
+
+
+class AsyncTransferError(USBError):
+    """ an asynchronous transfer failed; a USBError, so it can be retried like any other """
+
+
+def async_available() -> bool:
+    """ check if python-libusb1 is installed """
+    return usb1 is not None
+
+
+class AsyncTransferEngine:
+    """ keeps up to depth transfers in flight for memory reads and writes
+        context and handle are a usb1.USBContext and usb1.USBDeviceHandle, or anything with the same interface
+    """
+    def __init__(self, context, handle, depth:int=DEFAULT_DEPTH) -> None:
+        self.context = context
+        self.handle = handle
+        self.depth = max(1, depth)
+        self.endpoint_out = self.find_bulk_out_endpoint(handle.getDevice())
+
+    @classmethod
+    def open(cls, depth:int=DEFAULT_DEPTH):
+        """ open the device in USB Burn Mode with its own libusb handle
+            raises AsyncTransferError if python-libusb1 is missing, or device is not found
+        """
+        if usb1 is None:
+            raise AsyncTransferError('python-libusb1 is not installed')
+        context = usb1.USBContext()
+        handle = context.openByVendorIDAndProductID(VENDOR_ID, PRODUCT_ID)
+        if handle is None:
+            context.close()
+            raise AsyncTransferError('Device not found, is it in usb burn mode?')
+        return cls(context, handle, depth)
+
+    @staticmethod
+    def find_bulk_out_endpoint(device) -> int:
+        """ find address of the first bulk OUT endpoint of the device """
+        for setting in device.iterSettings():
+            for endpoint in setting:
+                address = endpoint.getAddress()
+                if not address & 0x80 and endpoint.getAttributes() & 0x03 == 0x02:
+                    return address
+        raise AsyncTransferError('Device has no bulk OUT endpoint')
+
+    def close(self):
+        """ close handle and context """
+        self.handle.close()
+        self.context.close()
+
+    @contextmanager
+    def claimed(self):
+        """ claim the interface for the duration of a bulk transfer
+            whoever else holds the claim (pyamlboot) must release it first
+        """
+        self.handle.claimInterface(INTERFACE)
+        try:
+            yield
+        finally:
+            self.handle.releaseInterface(INTERFACE)
+
+    def run_transfers(self, count:int, prepare, complete=None):
+        """ run count transfers, with up to depth of them in flight at once
+            prepare(transfer, index, callback) must set up a transfer for job index, using the given callback
+            complete(transfer, index) is called for each successful transfer, and may raise AsyncTransferError to fail the run
+            raises AsyncTransferError if any transfer fails, after waiting for the rest to be cancelled
+        """
+        if count <= 0:
+            return
+        state = {'next': 0, 'done': 0, 'error': None}
+        transfers = [self.handle.getTransfer() for _ in range(min(self.depth, count))]
+
+        def submit(transfer):
+            index = state['next']
+            state['next'] += 1
+            prepare(transfer, index, callback)
+            transfer.setUserData(index)
+            transfer.submit()
+
+        def callback(transfer):
+            index = transfer.getUserData()
+            status = transfer.getStatus()
+            if status != usb1_status('TRANSFER_COMPLETED'):
+                if state['error'] is None:
+                    state['error'] = f'transfer {index} failed with status: {status}'
+                return
+            if complete is not None:
+                try:
+                    complete(transfer, index)
+                except Exception as ex:
+                    # callbacks run through ctypes, which would print and swallow the exception, and handleEvents would wait forever
+                    if state['error'] is None:
+                        state['error'] = f'transfer {index} failed: {ex}'
+                    return
+            state['done'] += 1
+            if state['next'] < count and state['error'] is None:
+                submit(transfer)
+
+        try:
+            for transfer in transfers:
+                submit(transfer)
+            while state['done'] < count and state['error'] is None:
+                self.context.handleEvents()
+        finally:
+            # never leave transfers in flight, they reference our buffers
+            for transfer in transfers:
+                if transfer.isSubmitted():
+                    try:
+                        transfer.cancel()
+                    except Exception:
+                        pass
+            while [transfer for transfer in transfers if transfer.isSubmitted()]:
+                self.context.handleEvents()
+        if state['error'] is not None:
+            raise AsyncTransferError(state['error'])
+
+    def read_memory(self, address:int, length:int) -> bytes:
+        """ read memory, with up to depth 64-byte reads in flight """
+        data = bytearray(length)
+        count = (length + READ_BLOCK_SIZE - 1) // READ_BLOCK_SIZE
+
+        def prepare(transfer, index, callback):
+            offset = index * READ_BLOCK_SIZE
+            block_address = address + offset
+            size = min(READ_BLOCK_SIZE, length - offset)
+            transfer.setControl(0xc0, REQ_READ_MEM, block_address >> 16, block_address & 0xffff, size, callback=callback, timeout=TRANSFER_TIMEOUT)
+
+        def complete(transfer, index):
+            offset = index * READ_BLOCK_SIZE
+            size = min(READ_BLOCK_SIZE, length - offset)
+            block = transfer.getBuffer()[:transfer.getActualLength()]
+            if len(block) != size:
+                raise AsyncTransferError(f'short read at {hex(address + offset)}: {len(block)} of {size} bytes')
+            data[offset:offset + size] = block
+
+        self.run_transfers(count, prepare, complete)
+        return bytes(data)
+
+    def write_large_memory(self, address:int, data, block_size:int):
+        """ write memory, with up to depth blocks in flight
+            data must be a multiple of block_size, can be a memoryview
+            writes of more than MAX_WRITE_BLOCKS blocks are split into several large memory writes
+        """
+        data = memoryview(data)
+        if len(data) % block_size != 0:
+            raise ValueError(f'Data size {len(data)} is not a multiple of block size {block_size}')
+        split_size = MAX_WRITE_BLOCKS * block_size
+        for offset in range(0, len(data), split_size):
+            self.write_large_memory_once(address + offset, data[offset:offset + split_size], block_size)
+
+    def write_large_memory_once(self, address:int, data:memoryview, block_size:int):
+        """ one large memory write, of at most MAX_WRITE_BLOCKS blocks """
+        count = len(data) // block_size
+        control_data = pack('<IIII', address, len(data), 0, 0)
+        sent = self.handle.controlWrite(0x40, REQ_WR_LARGE_MEM, block_size, count, control_data, timeout=TRANSFER_TIMEOUT)
+        if sent != len(control_data):
+            raise AsyncTransferError('Failed to setup Large Memory Write')
+
+        def prepare(transfer, index, callback):
+            offset = index * block_size
+            transfer.setBulk(self.endpoint_out, data[offset:offset + block_size], callback=callback, timeout=TRANSFER_TIMEOUT)
+
+        with self.claimed():
+            self.run_transfers(count, prepare)
+
+
+def usb1_status(name:str):
+    """ look up a transfer status constant from usb1 (kept as a function so a stand-in module can provide them) """
+    return getattr(usb1, name)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Benchmark the USB link to a superbird device in USB Burn Mode
+
+Sweeps transfer block and chunk sizes, prints a throughput/latency table,
+    and saves the best settings to LINK_CONFIG_FILE so later runs use them
+Only device RAM (at ADDR_TMP, and crc32 results at ADDR_CRC) is ever written; mmc is only read, never written
+"""
+# pylint: disable=line-too-long,broad-except
+
+import os
+import time
+import binascii
+
+from usb.core import USBError
+
+from superbird_device import SuperbirdDevice, BulkcmdException
+from superbird_device import LINK_CONFIG_FILE, save_link_config
+
+# candidates to sweep, all multiples of the 512 byte sector size
+BLOCK_SIZES = [512, 1024, 2048, 4096, 8192, 16384]
+# write chunks above 512KB are known to fail partway through large partitions, so we do not go higher
+WRITE_CHUNK_SIZES = [64 * 1024, 128 * 1024, 256 * 1024, 512 * 1024]
+READ_CHUNK_SIZES = [32 * 1024, 64 * 1024, 128 * 1024, 256 * 1024, 512 * 1024]
+# partition used as a read-only source for mmc read tests, present and at least 8MB on every device
+SOURCE_PARTITION = 'env'
+ROUNDS = 2  # each measurement is repeated, and the best round is kept
+
+
+class LinkResult:
+    """ result of a single benchmark measurement """
+    def __init__(self, test:str, block_size:int, chunk_size:int, seconds:float, requests:int, ok:bool=True):
+        self.test = test
+        self.block_size = block_size
+        self.chunk_size = chunk_size
+        self.seconds = seconds
+        self.requests = requests
+        self.ok = ok
+
+    @property
+    def throughput(self) -> float:
+        """ throughput in KB/s """
+        if not self.ok or self.seconds <= 0:
+            return 0
+        return (self.chunk_size / self.seconds) / 1024
+
+    @property
+    def latency(self) -> float:
+        """ average time per USB request, in ms """
+        if not self.ok or self.requests <= 0:
+            return 0
+        return (self.seconds / self.requests) * 1000
+
+    def row(self) -> str:
+        """ format as a table row """
+        if not self.ok:
+            return f'{self.test:<14} {self.block_size:>8} {self.chunk_size // 1024:>8}KB {"FAIL":>12} {"-":>10}'
+        return f'{self.test:<14} {self.block_size:>8} {self.chunk_size // 1024:>8}KB {round(self.throughput):>9}KB/s {round(self.latency, 3):>8}ms'
+
+
+def best_time(func, rounds:int=ROUNDS) -> float:
+    """ run func several times, return the fastest time in seconds """
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def verify_ram(dev:SuperbirdDevice, address:int, data:bytes) -> bool:
+    """ check the whole of data made it to RAM, by comparing a crc32 done on the device with our own
+        catches settings that corrupt data, without reading the whole buffer back over USB
+    """
+    dev.bulkcmd_once(dev.crc_command(address, len(data)), silent=True)
+    return dev.crc_matches(dev.read_memory(dev.ADDR_CRC, 4), binascii.crc32(data) & 0xffffffff)
+
+
+def measure(test:str, block_size:int, chunk_size:int, requests:int, func, verify=None) -> LinkResult:
+    """ time func, and check the result with verify if given; any USB failure marks the result as failed """
+    try:
+        seconds = best_time(func)
+        if verify is not None and not verify():
+            print(f'  {test} block: {block_size} chunk: {chunk_size}: crc32 of the data in RAM did not match what was written')
+            return LinkResult(test, block_size, chunk_size, 0, requests, ok=False)
+    except (USBError, BulkcmdException) as ex:
+        print(f'  {test} block: {block_size} chunk: {chunk_size}: failed: {ex}')
+        return LinkResult(test, block_size, chunk_size, 0, requests, ok=False)
+    return LinkResult(test, block_size, chunk_size, seconds, requests)
+
+
+def best_of(results:list) -> LinkResult:
+    """ fastest successful result, or None if all failed """
+    passed = [result for result in results if result.ok]
+    if not passed:
+        return None
+    return max(passed, key=lambda result: result.throughput)
+
+
+def benchmark_link(dev:SuperbirdDevice, save:bool=True) -> dict:
+    """ sweep transfer settings on a device in USB Burn Mode, print results, and save the best config
+        returns the best config found
+    """
+    address = dev.ADDR_TMP
+    payload = os.urandom(max(WRITE_CHUNK_SIZES))
+    results = []
+
+    print('Benchmarking RAM writes')
+    write_block_results = []
+    for block_size in BLOCK_SIZES:
+        chunk_size = max(WRITE_CHUNK_SIZES)
+        data = payload[:chunk_size]
+        result = measure('ram_write', block_size, chunk_size, chunk_size // block_size,
+                         lambda: dev.write_large_memory(address, data, block_size),
+                         lambda: verify_ram(dev, address, data))
+        write_block_results.append(result)
+    results.extend(write_block_results)
+    best_write_block = best_of(write_block_results)
+    if best_write_block is None:
+        print('Every RAM write failed, is the device really in USB Burn Mode?')
+        return {}
+    block_size = best_write_block.block_size
+
+    write_chunk_results = []
+    for chunk_size in WRITE_CHUNK_SIZES:
+        data = payload[:chunk_size]
+        result = measure('ram_write', block_size, chunk_size, chunk_size // block_size,
+                         lambda: dev.write_large_memory(address, data, block_size),
+                         lambda: verify_ram(dev, address, data))
+        write_chunk_results.append(result)
+    results.extend(write_chunk_results)
+
+    print('Benchmarking RAM reads')
+    ram_read_results = []
+    for chunk_size in READ_CHUNK_SIZES:
+        ram_read_results.append(measure('ram_read', 64, chunk_size, chunk_size // 64,
+                                        lambda: dev.read_memory(address, chunk_size)))
+    results.extend(ram_read_results)
+
+    print(f'Benchmarking mmc reads into RAM (from partition: {SOURCE_PARTITION})')
+    mmc_read_results = []
+    for chunk_size in READ_CHUNK_SIZES:
+        command = f'amlmmc read {SOURCE_PARTITION} {hex(address)} 0x0 {hex(chunk_size)}'
+        mmc_read_results.append(measure('mmc_read', dev.PART_SECTOR_SIZE, chunk_size, 1,
+                                        lambda: dev.bulkcmd_once(command, silent=True)))
+    results.extend(mmc_read_results)
+
+    # a dump chunk costs one mmc read into RAM, plus reading it back out over USB
+    dump_results = []
+    for mmc_result, ram_result in zip(mmc_read_results, ram_read_results):
+        ok = mmc_result.ok and ram_result.ok
+        dump_results.append(LinkResult('dump_pipeline', 64, mmc_result.chunk_size, mmc_result.seconds + ram_result.seconds,
+                                       mmc_result.requests + ram_result.requests, ok=ok))
+    results.extend(dump_results)
+
+    print('')
+    print(f'{"test":<14} {"block":>8} {"chunk":>10} {"throughput":>13} {"latency":>10}')
+    for result in results:
+        print(result.row())
+    print('')
+
+    config = {'TRANSFER_BLOCK_SIZE': block_size}
+    best_write_chunk = best_of(write_chunk_results)
+    if best_write_chunk is not None:
+        config['WRITE_CHUNK_SIZE'] = best_write_chunk.chunk_size
+    best_dump = best_of(dump_results)
+    if best_dump is not None:
+        config['READ_CHUNK_SIZE'] = best_dump.chunk_size
+    for key, value in config.items():
+        print(f'best {key}: {value} ({value // 1024}KB)')
+    if save:
+        save_link_config(config)
+        print(f'saved link config to {LINK_CONFIG_FILE}, it will be used by later runs')
+        print('  delete that file to go back to the defaults')
+    return config
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+Packed partition restore: send fewer bytes over USB, for images with lots of repeated data
+
+The u-boot on superbird has no decompression command (no unzip, gzip or lz4, see uboot-command-reference.txt),
+    so chunks are packed into something it can expand with the commands it does have:
+        4KB blocks which are a single repeated 32-bit value (zeros, erased space) become mw.l fills
+        blocks identical to an earlier block of the same chunk are only sent once
+        everything else is sent as-is
+    the remaining blocks (literals) are uploaded to ADDR_SCRATCH, then copied into place in ADDR_TMP with cp.l
+Chunks are packed in a pool of processes, ahead of the USB loop, so packing never waits on USB or the other way around
+
+Every bulkcmd costs far more than the data it saves (see SuperbirdDevice.bulkcmd_once), so a packed chunk is always a single bulkcmd,
+    the fills and copies joined with the amlmmc write, just like an unpacked chunk
+Images are packed in spans of PACK_SPAN_SIZE, so long stretches of empty space cost one bulkcmd per span, not one per chunk
+    a bulkcmd only has room for a few fills and copies, so a span which alternates between data and empty space packs poorly as a whole
+    spans are split in halves wherever the halves cost less to send (counting COMMAND_COST per bulkcmd), down to a minimum size
+    pieces which still do not pack are sent as-is
+Realistic gain: mostly empty images (settings, data, a freshly built system image) send a small fraction of their size;
+    full filesystems and images of compressed data gain little or nothing, and cost the time spent packing them
+"""
+# pylint: disable=line-too-long,broad-except
+
+import os
+import struct
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+PACK_BLOCK_SIZE = 4 * 1024  # bytes, chunks are packed in blocks of this size (ext4 block size)
+MAX_COMMAND_LENGTH = 480  # bytes, longest bulkcmd sent for a packed chunk, including the amlmmc write
+PACK_SPAN_SIZE = 4 * 1024 * 1024  # bytes, largest chunk expanded with one bulkcmd (ADDR_SCRATCH and ADDR_TMP must both have room for it)
+PACK_AHEAD = 2  # spans packed ahead of the USB loop, per worker process
+COMMAND_COST = 1024 * 1024  # bytes, what one more bulkcmd costs: every bulkcmd waits 0.2s, about as long as sending 1MB at 4.9MB/s
+
+
+class PackedChunk:
+    """ a chunk of a partition image, packed for sending
+        literal: bytes to upload to scratch (empty if the chunk is entirely fills)
+        command: commands which expand literal (and fills) into the chunk, joined with &&
+    """
+    def __init__(self, size:int, literal:bytes, command:str) -> None:
+        self.size = size
+        self.literal = literal
+        self.command = command
+
+    def wire_size(self) -> int:
+        """ how many bytes of data this chunk sends over USB """
+        return len(self.literal)
+
+
+def repeated_value(block:bytes):
+    """ if block is a single 32-bit value repeated, return that value, else None """
+    if len(block) % 4 != 0 or block != block[:4] * (len(block) // 4):
+        return None
+    return struct.unpack('<I', block[:4])[0]
+
+
+def plan_chunk(data:bytes, min_fill:int, dedupe:bool, target_address:int, scratch_address:int) -> tuple:
+    """ plan how to expand data: runs of at least min_fill blocks of one repeated value are filled, the rest is literal
+        with dedupe, blocks identical to an earlier block are only included in literal once
+        returns tuple of: literal bytes, command (fills and copies joined with &&)
+    """
+    blocks = [data[offset:offset + PACK_BLOCK_SIZE] for offset in range(0, len(data), PACK_BLOCK_SIZE)]
+    values = [repeated_value(block) for block in blocks]
+    # runs which are too short are not worth a command, send them as literal
+    index = 0
+    while index < len(blocks):
+        end = index + 1
+        while values[index] is not None and end < len(blocks) and values[end] == values[index]:
+            end += 1
+        if values[index] is not None and end - index < min_fill:
+            values[index:end] = [None] * (end - index)
+        index = end
+    literal = bytearray()
+    literal_offsets = {}  # block data: offset in literal
+    operations = []  # [kind, value or literal offset, chunk offset, length], kind is 'fill' or 'copy'
+    for index, block in enumerate(blocks):
+        if values[index] is not None:
+            (kind, source) = ('fill', values[index])
+        else:
+            if not dedupe or block not in literal_offsets:
+                literal_offsets[block] = len(literal)
+                literal += block
+            (kind, source) = ('copy', literal_offsets[block])
+        block_offset = index * PACK_BLOCK_SIZE
+        if operations:
+            last = operations[-1]
+            if kind == last[0] and ((kind == 'fill' and source == last[1]) or (kind == 'copy' and source == last[1] + last[3])):
+                last[3] += len(block)
+                continue
+        operations.append([kind, source, block_offset, len(block)])
+    commands = []
+    for (kind, source, block_offset, length) in operations:
+        if kind == 'fill':
+            commands.append(f'mw.l {hex(target_address + block_offset)} {hex(source)} {hex(length // 4)}')
+        else:
+            commands.append(f'cp.l {hex(scratch_address + source)} {hex(target_address + block_offset)} {hex(length // 4)}')
+    return (bytes(literal), ' && '.join(commands))
+
+
+def pack_chunk(data:bytes, target_address:int, scratch_address:int, max_length:int) -> PackedChunk:
+    """ pack a chunk, to be expanded at target_address, with literals uploaded to scratch_address
+        if the command would be longer than max_length, shorter fill runs are sent as literal instead, until it fits
+        returns None if the chunk is better sent as-is
+    """
+    min_fill = 1
+    while min_fill * PACK_BLOCK_SIZE <= len(data):
+        (literal, command) = plan_chunk(data, min_fill, min_fill == 1, target_address, scratch_address)
+        if len(literal) == len(data):
+            return None
+        if len(command) <= max_length:
+            return PackedChunk(len(data), literal, command)
+        min_fill *= 2
+    return None
+
+
+def pack_span(infile:str, offset:int, size:int, min_size:int, target_address:int, scratch_address:int, max_length:int) -> list:
+    """ pack a span of a file, split into the pieces which cost the least to send (see cheapest_pieces)
+        reads past the end of the file are zeros
+        returns list of tuples: (offset, size, PackedChunk or None to send as-is)
+    """
+    with open(infile, 'rb') as inf:
+        inf.seek(offset)
+        data = inf.read(size)
+    data += bytes(size - len(data))
+    (_cost, pieces) = cheapest_pieces(data, 0, size, min_size, target_address, scratch_address, max_length)
+    return [(offset + start, length, packed) for (start, length, packed) in pieces]
+
+
+def cheapest_pieces(data:bytes, start:int, length:int, min_size:int, target_address:int, scratch_address:int, max_length:int) -> tuple:
+    """ cheapest way to send data[start:start + length]: packed as a whole, as-is if no larger than min_size, or split in halves sent the cheapest way
+        cost is the bytes sent, plus COMMAND_COST per bulkcmd
+        returns tuple of: cost, list of tuples: (start, length, PackedChunk or None to send as-is)
+    """
+    packed = pack_chunk(data[start:start + length], target_address, scratch_address, max_length)
+    best = None
+    if packed is not None:
+        best = (packed.wire_size() + COMMAND_COST, [(start, length, packed)])
+    elif length <= min_size:
+        best = (length + COMMAND_COST, [(start, length, None)])
+    half = length // 2 // PACK_BLOCK_SIZE * PACK_BLOCK_SIZE
+    # halves cost at least two bulkcmds, so they can only be cheaper if this costs more than that
+    if length > min_size and half > 0 and (best is None or best[0] > 2 * COMMAND_COST):
+        (first_cost, first_pieces) = cheapest_pieces(data, start, half, min_size, target_address, scratch_address, max_length)
+        (second_cost, second_pieces) = cheapest_pieces(data, start + half, length - half, min_size, target_address, scratch_address, max_length)
+        if best is None or first_cost + second_cost < best[0]:
+            best = (first_cost + second_cost, first_pieces + second_pieces)
+    if best is None:
+        best = (length + COMMAND_COST, [(start, length, None)])
+    return best
+
+
+def packed_spans(infile:str, spans:list, min_size:int, target_address:int, scratch_address:int, max_length:int):
+    """ pack spans of a file in a pool of processes, yielding the pieces of each (offset, size) in spans, in order (see pack_span)
+        only a few spans are packed ahead, so memory use does not depend on the size of the file
+    """
+    workers = os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        spans = iter(spans)
+        while True:
+            while len(pending) < workers * PACK_AHEAD:
+                span = next(spans, None)
+                if span is None:
+                    break
+                pending.append(pool.submit(pack_span, infile, span[0], span[1], min_size, target_address, scratch_address, max_length))
+            if not pending:
+                return
+            yield pending.popleft().result()
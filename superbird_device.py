@@ -6,14 +6,23 @@ Wrapper for performing tasks on superbird device
 
 import os
 import sys
+import re
+import json
+import mmap
 import time
+import struct
+import binascii
 import traceback
 import platform
 
+from contextlib import contextmanager
+from pathlib import Path
+
 try:
     from pyamlboot import pyamlboot
     from usb.core import USBTimeoutError, USBError
     import usb.core
+    import usb.util
 except ImportError:
     print("""
     ###########################################################################################
@@ -52,9 +61,14 @@ except ImportError:
     sys.exit(1)
 
 from superbird_partitions import SUPERBIRD_PARTITIONS
+from android_sparse import SparseImage, is_sparse_image, CHUNK_TYPE_RAW, CHUNK_TYPE_FILL
 
 BURN_MODE_TIMEOUT = 10  # seconds, how long to wait for device to enter USB Burn Mode
 
+# best transfer settings found by --benchmark_link are saved here, and applied to every SuperbirdDevice
+LINK_CONFIG_FILE = Path.home().joinpath('.superbird_link.json')
+LINK_CONFIG_KEYS = ['TRANSFER_BLOCK_SIZE', 'WRITE_CHUNK_SIZE', 'READ_CHUNK_SIZE']
+
 class BulkcmdException(Exception):
     """
     So we can catch this specifically
@@ -131,6 +145,7 @@ def enter_burn_mode(dev):
             dev = SuperbirdDevice()
             time.sleep(1)
             dev.bulkcmd('amlmmc part 1')
+            dev.partition_table_loaded = True
             return dev
         else:
             print('Failed to enter USB Burn Mode!')
@@ -139,6 +154,42 @@ def enter_burn_mode(dev):
         print(f'Cannot enter burn mode from current mode: {dev_mode}')
         return None
 
+@contextmanager
+def mapped_file(filepath:str):
+    """ memory-map a file read-only, and yield a memoryview of its contents
+        slices of the view do not copy, so large images can be sent in chunks
+        without ever reading the whole file into memory
+        any slices taken from the view must be released before leaving the context
+    """
+    with open(filepath, 'rb') as flp:
+        if os.fstat(flp.fileno()).st_size == 0:
+            # cannot mmap an empty file
+            yield memoryview(b'')
+            return
+        with mmap.mmap(flp.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                yield view
+            finally:
+                view.release()
+
+def load_link_config() -> dict:
+    """ load transfer settings saved by --benchmark_link, returns empty dict if there are none """
+    if not LINK_CONFIG_FILE.is_file():
+        return {}
+    try:
+        with open(LINK_CONFIG_FILE, 'r', encoding='utf-8') as lcf:
+            config = json.load(lcf)
+    except Exception as ex:
+        print(f'Ignoring unreadable link config {LINK_CONFIG_FILE}: {ex}')
+        return {}
+    return {key: int(value) for key, value in config.items() if key in LINK_CONFIG_KEYS}
+
+def save_link_config(config:dict):
+    """ save transfer settings, to be used by later runs """
+    with open(LINK_CONFIG_FILE, 'w', encoding='utf-8') as lcf:
+        json.dump({key: config[key] for key in LINK_CONFIG_KEYS if key in config}, lcf, indent=4)
+
 def stdout_clear_lines(num:int=1):
     """ un-print the last N lines """
     while num > 0:
@@ -151,9 +202,16 @@ class SuperbirdDevice:
     ADDR_KERNEL = 0x01080000
     ADDR_INITRD = 0x13000000
     ADDR_TMP = 0x13000000
+    ADDR_CRC = 0x12fff000  # device-side crc32 results are stored here, just below ADDR_TMP
+    ADDR_SCRATCH = 0x12000000  # packed chunks are uploaded here, then expanded into ADDR_TMP
     # commands which cause a usb timeout when reading response
     #   for any other commands, we raise an exception if they cause a timeout
     TIMEOUT_COMMANDS = ['booti', 'bootm', 'bootp', 'mw.b', 'reset', 'reboot']
+    # commands which do not change env or partitions, so cached state stays valid
+    READ_ONLY_COMMANDS = ('amlmmc read ', 'amlmmc part ')
+    # commands which have the same effect when run twice, so bulkcmd can retry them after a USB error
+    #   a timeout can come after the device already ran the command, so anything else (like setenv appending to ${initargs}) is run only once
+    IDEMPOTENT_COMMANDS = ('amlmmc read ', 'amlmmc write ', 'amlmmc part ', 'amlmmc env', 'amlmmc erase ', 'env save', 'env import ', 'mw.l ', 'cp.l ', 'crc32 ')
     PARTITIONS = SUPERBIRD_PARTITIONS
     PART_SECTOR_SIZE = 512  # bytes, size of sectors used in partition table
     TRANSFER_BLOCK_SIZE = 8 * PART_SECTOR_SIZE  # 4KB data transfered into memory one block at a time
@@ -161,8 +219,30 @@ class SuperbirdDevice:
     READ_CHUNK_SIZE = 256 * PART_SECTOR_SIZE  # 128KB chunk read from mmc into memory, then read out to local file
     # writes larger than threshold will be broken into chunks of WRITE_CHUNK_SIZE
     TRANSFER_SIZE_THRESHOLD = 2 * 1024 * 1024  # 2MB
+    # partitions are cloned on the device this much at a time, never leaving RAM
+    #   each chunk is one bulkcmd (read, write, crc32, read back, crc32), which must finish before the bulkcmd response times out
+    CLONE_CHUNK_SIZE = 4 * 1024 * 1024
+    ENV_READ_CHUNK_SIZE = 64 * 1024  # env is read from mmc into RAM this much at a time, actual env is usually only a few KB
+    ENV_READ_BLOCK_SIZE = 1024  # env is read out of RAM this much at a time, until its end is found
+    # transient USB errors are retried this many times (per command or chunk) before giving up
+    RETRY_BUDGET = 5
+    RETRY_BACKOFF = 0.5  # seconds, doubled after each failed attempt
+    RETRY_BACKOFF_MAX = 8  # seconds
+    # dump_partition checksums each chunk on the device, and does not read out chunks which are all zeros
+    SKIP_ZERO_CHUNKS = True
+    # if set, memory reads and writes keep this many USB transfers in flight, using superbird_async (needs python-libusb1)
+    ASYNC_DEPTH = None
+    # if set, restore_partition packs chunks on the host (see superbird_compress), sending fewer bytes over USB
+    COMPRESS_CHUNKS = False
 
     def __init__(self) -> None:
+        self.retry_count = 0  # total number of failed attempts that were retried
+        # state cached for the lifetime of this device object, useful for sessions running many operations
+        self.partition_cache = {}  # validated (size, offset) by partition name
+        self.partition_table_loaded = False  # amlmmc part 1 has been run
+        self.env_cache = None  # env dict, cleared by any command which could change it
+        self.engine = None  # AsyncTransferEngine, if enabled
+        self.zero_crc_cache = {}  # crc32 of an all-zero chunk, by chunk size
         try:
             self.device = pyamlboot.AmlogicSoC()
         except ValueError:
@@ -185,6 +265,41 @@ class SuperbirdDevice:
                 self.print('  python3 -m pip uninstall pyamlboot')
                 self.print('  python3 -m pip install git+https://github.com/superna9999/pyamlboot')
                 sys.exit(1)
+        self.apply_link_config(load_link_config())
+        if self.ASYNC_DEPTH:
+            self.open_engine()
+
+    def open_engine(self):
+        """ open the asynchronous transfer engine, falling back to synchronous transfers if it is not available """
+        # pylint: disable=import-outside-toplevel
+        from superbird_async import AsyncTransferEngine, AsyncTransferError
+        self.close_engine()
+        try:
+            self.engine = AsyncTransferEngine.open(self.ASYNC_DEPTH)
+        except AsyncTransferError as ex:
+            self.print(f' Async transfers not available ({ex}), using synchronous transfers')
+            self.engine = None
+
+    def close_engine(self):
+        """ close the asynchronous transfer engine, if open """
+        if self.engine is not None:
+            try:
+                self.engine.close()
+            except Exception:
+                pass
+            self.engine = None
+
+    def release_interface(self):
+        """ let go of pyusb's claim on the interface, so the engine can claim it; pyusb claims it again when needed """
+        try:
+            usb.util.release_interface(self.device.dev, 0)
+        except Exception:
+            pass
+
+    def apply_link_config(self, config:dict):
+        """ override transfer settings (TRANSFER_BLOCK_SIZE, WRITE_CHUNK_SIZE, READ_CHUNK_SIZE) for this device """
+        for key, value in config.items():
+            setattr(self, key, value)
 
     @staticmethod
     def decode(response):
@@ -200,48 +315,148 @@ class SuperbirdDevice:
         print(message)
         sys.stdout.flush()
 
-    def bulkcmd(self, command:str, ignore_timeout=False, silent=False):
-        """ perform a bulkcmd, separated by semicolon """
+    def bulkcmd(self, command:str, ignore_timeout=False, silent=False, retry:bool=None):
+        """ perform a bulkcmd, separated by semicolon
+            with retry, transient USB errors are retried (see retry); by default, only idempotent commands are (see is_idempotent)
+            commands which are expected to time out are never retried
+        """
         if not silent:
             self.print(f' executing bulkcmd: "{command}"')
+        if not command.startswith(self.READ_ONLY_COMMANDS):
+            self.env_cache = None
+        # if you use booti or mw.b, it wont return, thus will raise USBTimeoutError
+        expect_timeout = bool([word for word in self.TIMEOUT_COMMANDS if word in command]) or ignore_timeout
+        if retry is None:
+            retry = self.is_idempotent(command)
         try:
-            resp = self.device.bulkCmd(command)
-            response = self.decode(resp)
-            if not silent:
-                self.print(f'  result: {response}')
-            if 'success' not in response:
-                self.print(f'Bulkcmd failed: {command} -> {response}')
-                raise BulkcmdException('Bulkcmd failed')
-            time.sleep(0.2)
-        except (USBTimeoutError, BulkcmdException) as ex:
-            # if you use booti or mw.b, it wont return, thus will raise USBTimeoutError
-            if [word for word in self.TIMEOUT_COMMANDS if word in command] or ignore_timeout:
-                if not silent:
-                    self.print('  ...')
+            if expect_timeout or not retry:
+                self.bulkcmd_once(command, silent=silent)
             else:
-                self.print(f' Error ({ex.__class__.__name__}): bulkcmd timed out or failed!')
-                self.print(' This can happen if the device ends up in a strange state, like as the result of a previously failed command')
-                self.print(' Try power cycling the device by pulling the cable, and then boot up and try again')
-                self.print('  You might need to do this multiple times')
-                self.print('    If the device is connected through a USB hub, try connecting it directly to a port on your machine')
-                sys.exit(1)
-        except USBError:
+                self.retry(f'bulkcmd "{command}"', self.bulkcmd_once, command, silent=silent)
+        except (USBError, BulkcmdException) as ex:
             # on Windows, raises USBError instead of USBTimeoutError
-            if [word for word in self.TIMEOUT_COMMANDS if word in command] or ignore_timeout:
+            if expect_timeout:
                 if not silent:
                     self.print('  ...')
             else:
-                self.print(' Error: bulkcmd timed out!')
+                self.print(f' Error ({ex.__class__.__name__}): bulkcmd timed out or failed!')
                 self.print(' This can happen if the device ends up in a strange state, like as the result of a previously failed command')
                 self.print(' Try power cycling the device by pulling the cable, and then boot up and try again')
                 self.print('  You might need to do this multiple times')
                 self.print('    If the device is connected through a USB hub, try connecting it directly to a port on your machine')
                 sys.exit(1)
 
-    def write(self, address:int, data, chunk_size=8, append_zeros=True):
-        """ write data to an address """
-        self.print(f' writing to: {hex(address)}')
-        self.device.writeLargeMemory(address, data, chunk_size, append_zeros)
+    def is_idempotent(self, command:str) -> bool:
+        """ check if running a command twice has the same effect as running it once, so it is safe to retry
+            every part of it (separated by ; or &&) must be one of IDEMPOTENT_COMMANDS, or a setenv which does not refer to any variable
+        """
+        for part in re.split(r';|&&', command):
+            part = part.strip()
+            if part.startswith('setenv ') and '$' not in part:
+                continue
+            if not part.startswith(self.IDEMPOTENT_COMMANDS):
+                return False
+        return True
+
+    def bulkcmd_once(self, command:str, silent=False) -> str:
+        """ perform a single bulkcmd attempt, returns response
+            raises BulkcmdException if device reports failure, USB errors are passed through
+        """
+        response = self.decode(self.device.bulkCmd(command))
+        if not silent:
+            self.print(f'  result: {response}')
+        if 'success' not in response:
+            self.print(f'Bulkcmd failed: {command} -> {response}')
+            raise BulkcmdException('Bulkcmd failed')
+        time.sleep(0.2)
+        return response
+
+    def retry(self, description:str, func, *args, **kwargs):
+        """ call func, retrying with backoff on USB errors, up to RETRY_BUDGET attempts
+            after a non-timeout error, or repeated timeouts, the device handle is re-opened before trying again
+            every failure is logged, and counted in self.retry_count
+            the last error is raised once the budget is used up
+        """
+        attempt = 0
+        delay = self.RETRY_BACKOFF
+        reopen = False
+        while True:
+            try:
+                if reopen:
+                    self.reconnect()
+                return func(*args, **kwargs)
+            except USBError as ex:
+                attempt += 1
+                self.retry_count += 1
+                self.print(f' USB error during {description}, attempt {attempt}/{self.RETRY_BUDGET}: ({ex.__class__.__name__}) {ex}')
+                if attempt >= self.RETRY_BUDGET:
+                    raise
+                # a single timeout is often just a slow response; anything else likely means the handle is stale
+                reopen = attempt > 1 or not isinstance(ex, USBTimeoutError)
+                time.sleep(delay)
+                delay = min(delay * 2, self.RETRY_BACKOFF_MAX)
+
+    def reconnect(self):
+        """ drop the current USB handle, wait for the device to enumerate in USB Burn Mode, then open it again
+            the device may have been reset, so cached state is dropped, and the partition table is loaded again before returning
+            raises USBError if the device does not come back in time
+        """
+        self.print(' re-opening device')
+        old_dev = getattr(self.device, 'dev', None)
+        if old_dev is not None:
+            try:
+                usb.util.dispose_resources(old_dev)
+            except Exception:
+                pass
+        wait_time = 0
+        while not check_device_mode('usb-burn', silent=True):
+            if wait_time >= BURN_MODE_TIMEOUT:
+                raise USBError('device did not re-appear in USB Burn Mode')
+            time.sleep(1)
+            wait_time += 1
+        try:
+            self.device = pyamlboot.AmlogicSoC()
+        except ValueError as ex:
+            raise USBError(f'device disappeared while re-opening: {ex}') from ex
+        self.partition_table_loaded = False
+        self.partition_cache = {}
+        self.env_cache = None
+        if self.engine is not None:
+            self.open_engine()
+        # the command being retried may need it, like amlmmc read
+        self.bulkcmd_once('amlmmc part 1', silent=True)
+        self.partition_table_loaded = True
+
+    def write(self, address:int, data, chunk_size=8, append_zeros=True, silent=False):
+        """ write data to an address
+            data can be bytes or a memoryview; only the final partial block (if any) is copied, to pad it with zeros
+        """
+        if not silent:
+            self.print(f' writing to: {hex(address)}')
+        self.write_large_memory(address, data, chunk_size, append_zeros)
+
+    def write_large_memory(self, address:int, data, block_size:int, append_zeros=True):
+        """ wrapper for writeLargeMemory which accepts memoryview slices without copying them
+            pyamlboot pads by concatenating, which does not work with memoryview,
+            so we send the block-aligned part as-is, and pad the tail ourselves
+        """
+        data = memoryview(data)
+        tail_size = len(data) % block_size
+        aligned_size = len(data) - tail_size
+        if tail_size and not append_zeros:
+            raise ValueError(f'Data size {len(data)} is not a multiple of block size {block_size}')
+        parts = []
+        if aligned_size:
+            parts.append((address, data[:aligned_size]))
+        if tail_size:
+            parts.append((address + aligned_size, bytes(data[aligned_size:]) + bytes(block_size - tail_size)))
+        if self.engine is not None:
+            self.release_interface()
+        for (part_address, part_data) in parts:
+            if self.engine is not None:
+                self.engine.write_large_memory(part_address, part_data, block_size)
+            else:
+                self.device.writeLargeMemory(part_address, part_data, block_size, appendZeros=False)
 
     def send_env(self, env_string:str):
         """ send given env string to device, space-separated kernel args on one line """
@@ -262,39 +477,36 @@ class SuperbirdDevice:
     def send_file(self, filepath:str, address:int, chunk_size:int=512, append_zeros=True):
         """ write given file to device memory at given address """
         self.print(f'writing {filepath} at {hex(address)}')
-        file_data = None
-        with open(filepath, 'rb') as flp:
-            file_data = flp.read()
-        self.write(address, file_data, chunk_size, append_zeros)
+        with mapped_file(filepath) as file_data:
+            self.write(address, file_data, chunk_size, append_zeros)
 
     def bl2_boot(self, bl2_file:str, bootloader_file:str):
         """ send a bl2 and then chain a uboot image with it """
         # TODO there is something wrong with bl2_boot
         self.send_file(bl2_file, self.ADDR_BL2, chunk_size=4096, append_zeros=True)
         self.device.run(self.ADDR_BL2)
-        data = None
-        with open(bootloader_file, 'rb') as blf:
-            data = blf.read()
-        time.sleep(2)
+        with mapped_file(bootloader_file) as data:
+            time.sleep(2)
 
-        prev_length = -1
-        prev_offset = -1
-        seq = 0
-        while True:
-            (length, offset) = self.device.getBootAMLC()
+            prev_length = -1
+            prev_offset = -1
+            seq = 0
+            while True:
+                (length, offset) = self.device.getBootAMLC()
 
-            if length == prev_length and offset == prev_offset:
-                self.print("[BL2 END]")
-                break
+                if length == prev_length and offset == prev_offset:
+                    self.print("[BL2 END]")
+                    break
 
-            prev_length = length
-            prev_offset = offset
+                prev_length = length
+                prev_offset = offset
 
-            self.print(f'AMLC dataSize={length}, offset={offset}, seq={seq}')
-            self.device.writeAMLCData(seq, offset, data[offset:offset+length])
-            self.print("[DONE]")
+                self.print(f'AMLC dataSize={length}, offset={offset}, seq={seq}')
+                with data[offset:offset+length] as amlc_data:
+                    self.device.writeAMLCData(seq, offset, amlc_data)
+                self.print("[DONE]")
 
-            seq = seq + 1
+                seq = seq + 1
 
     def boot(self, env_file:str, kernel:str, initrd:str):
         """ boot using given env.txt, kernel, kernel address, and initrd, intitrd_address """
@@ -307,6 +519,8 @@ class SuperbirdDevice:
 
     def read_memory(self, address, length):
         """Read some data from memory"""
+        if self.engine is not None:
+            return self.engine.read_memory(address, length)
         data = None
         offset = 0
         while length:
@@ -327,10 +541,150 @@ class SuperbirdDevice:
                 break
         return data
 
+    def read_env(self) -> bytes:
+        """ read the env partition, but only up to the end of the env data
+                env is a 4-byte crc, followed by key=value strings, each terminated by \\0, with an empty string (\\0\\0) marking the end
+                so we read it from mmc into RAM in chunks, and read it out of RAM a little at a time, stopping as soon as we see the end
+            returns bytes in the same layout as a partition dump (crc, env data, terminator), but without the unused remainder
+        """
+        (part_size, _part_offset) = self.validate_partition_size('env')
+        if part_size is None:
+            raise ValueError('Failed to validate partition size!')
+        data = bytearray()
+        mmc_offset = 0
+        while mmc_offset < part_size:
+            chunk_size = min(self.ENV_READ_CHUNK_SIZE, part_size - mmc_offset)
+            self.bulkcmd(f'amlmmc read env {hex(self.ADDR_TMP)} {hex(mmc_offset)} {hex(chunk_size)}', silent=True)
+            position = 0
+            while position < chunk_size:
+                read_size = min(self.ENV_READ_BLOCK_SIZE, chunk_size - position)
+                search_from = max(4, len(data) - 1)  # terminator may straddle two reads
+                data += self.retry(f'reading env at offset {hex(mmc_offset + position)}', self.read_memory, self.ADDR_TMP + position, read_size)
+                end = data.find(b'\x00\x00', search_from)
+                if end >= 0:
+                    return bytes(data[:end + 2])
+                position += read_size
+            mmc_offset += chunk_size
+        self.print('Did not find end of env, returning the whole partition')
+        return bytes(data)
+
+    def dump_env(self, outfile:str):
+        """ dump the used portion of the env partition to a file, readable by read_environ
+            this is not a partition image, it is only for reading the env (get_env); use dump_partition for a dump which can be restored
+        """
+        start_time = time.time()
+        env_data = self.read_env()
+        with open(outfile, 'wb') as evf:
+            evf.write(env_data)
+        self.print(f'dumped env: {len(env_data)} bytes into file: {outfile}, took: {round(time.time() - start_time, 2)}s')
+
+    def read_partition_chunk(self, part_name:str, offset:int, size:int, skip_zero:bool=False) -> bytes:
+        """ read a chunk of a partition into RAM, then read it out of RAM, in one retryable step
+            with skip_zero, the chunk is checksummed on the device first, and if it is all zeros, None is returned without reading it out
+        """
+        command = f'amlmmc read {part_name} {hex(self.ADDR_TMP)} {hex(offset)} {hex(size)}'
+        if skip_zero:
+            # joined with &&: if the read fails, the bulkcmd fails, instead of checksumming whatever was left in RAM,
+            #   which could be zeros, and make the chunk a hole in the dump
+            self.bulkcmd_once(f'{command} && {self.crc_command(self.ADDR_TMP, size)}', silent=True)
+            if self.crc_matches(self.read_memory(self.ADDR_CRC, 4), self.zero_crc(size)):
+                return None
+        else:
+            self.bulkcmd_once(command, silent=True)
+        return self.read_memory(self.ADDR_TMP, size)
+
+    def check_partition_chunk(self, part_name:str, offset:int, size:int, crc:int) -> bool:
+        """ read a chunk of a partition into RAM, and check its crc32 on the device, without reading it out """
+        self.bulkcmd_once(f'amlmmc read {part_name} {hex(self.ADDR_TMP)} {hex(offset)} {hex(size)} && {self.crc_command(self.ADDR_TMP, size)}', silent=True)
+        return self.crc_matches(self.read_memory(self.ADDR_CRC, 4), crc)
+
+    def crc_command(self, address:int, size:int, result_address:int=None) -> str:
+        """ commands to checksum a region of RAM with crc32, storing the result at result_address (default: ADDR_CRC)
+            the result is cleared first, so a crc32 which did not store anything cannot look like a match
+            commands are joined with &&, so the bulkcmd fails if any of them fails
+        """
+        if result_address is None:
+            result_address = self.ADDR_CRC
+        return f'mw.l {hex(result_address)} 0 1 && crc32 {hex(address)} {hex(size)} {hex(result_address)}'
+
+    def clone_partition_chunk(self, source:str, target:str, offset:int, size:int, verify:bool=True):
+        """ copy a chunk from one partition to another entirely on the device, in one retryable step
+            with verify, the target is read back, and its crc32 compared with the source (on the device)
+            raises BulkcmdException if verification fails
+        """
+        command = f'amlmmc read {source} {hex(self.ADDR_TMP)} {hex(offset)} {hex(size)} && amlmmc write {target} {hex(self.ADDR_TMP)} {hex(offset)} {hex(size)}'
+        if not verify:
+            self.bulkcmd_once(command, silent=True)
+            return
+        # crc of source goes to ADDR_CRC, crc of target read back goes right after it
+        self.bulkcmd_once(
+            f'{command} && {self.crc_command(self.ADDR_TMP, size)} && amlmmc read {target} {hex(self.ADDR_TMP)} {hex(offset)} {hex(size)} && {self.crc_command(self.ADDR_TMP, size, self.ADDR_CRC + 4)}',
+            silent=True
+        )
+        crc_data = self.read_memory(self.ADDR_CRC, 8)
+        if crc_data[:4] != crc_data[4:] or crc_data[:4] == bytes(4):
+            self.print(f'Verification failed: {target} at {hex(offset)} does not match {source}')
+            raise BulkcmdException('Clone verification failed')
+
+    def clone_partition(self, source:str, target:str, verify:bool=True):
+        """ copy a partition to another partition of the same size, entirely on the device
+            only commands (and checksums, with verify) cross USB, using chunks of CLONE_CHUNK_SIZE
+            a chunk whose bulkcmd times out is retried like any other USB error; copying a chunk again is harmless
+        """
+        (source_size, _source_offset) = self.validate_partition_size(source)
+        (target_size, _target_offset) = self.validate_partition_size(target)
+        if source_size is None or target_size is None:
+            raise ValueError('Failed to validate partition size!')
+        if source_size != target_size:
+            raise ValueError(f'Cannot clone {source} ({source_size} bytes) to {target} ({target_size} bytes), sizes differ')
+        self.env_cache = None
+        start_time = time.time()
+        offset = 0
+        while offset < source_size:
+            chunk_size = min(self.CLONE_CHUNK_SIZE, source_size - offset)
+            self.print(f' cloning {source} -> {target}: {hex(offset)} {round(chunk_size / 1024 / 1024, 2)}MB, progress: {round(offset / source_size * 100)}%')
+            self.retry(f'cloning {source} to {target} chunk at offset {hex(offset)}', self.clone_partition_chunk, source, target, offset, chunk_size, verify)
+            offset += chunk_size
+        self.print(f'cloned {source} -> {target}: {round(source_size / 1024 / 1024, 2)}MB{", verified" if verify else ""}, took: {round(time.time() - start_time, 2)}s')
+
+    @staticmethod
+    def crc_matches(crc_data:bytes, crc:int) -> bool:
+        """ check if a crc32 result read from ADDR_CRC matches an expected value
+            depending on u-boot version, crc32 stores its result in native (little-endian) or big-endian order
+        """
+        return crc_data in (struct.pack('<I', crc), struct.pack('>I', crc))
+
+    def zero_crc(self, size:int) -> int:
+        """ crc32 of an all-zero chunk of given size """
+        if size not in self.zero_crc_cache:
+            self.zero_crc_cache[size] = binascii.crc32(bytes(size)) & 0xffffffff
+        return self.zero_crc_cache[size]
+
+    def write_partition_chunk(self, part_name:str, data, offset:int, size:int, extra_targets:list=()):
+        """ write a chunk into RAM, then write it from RAM to a partition, in one retryable step
+            the same chunk is also written to each of extra_targets, without uploading it again
+        """
+        self.write_large_memory(self.ADDR_TMP, data, self.TRANSFER_BLOCK_SIZE, append_zeros=True)
+        self.bulkcmd_once(self.write_command([part_name] + list(extra_targets), offset, size), silent=True)
+
+    def write_packed_chunk(self, part_name:str, packed, offset:int, size:int, extra_targets:list=()):
+        """ upload a PackedChunk, expand it into RAM, and write it to a partition (and each of extra_targets), in one retryable step """
+        # literals can be up to PACK_SPAN_SIZE, uploaded in pieces of WRITE_CHUNK_SIZE like any other chunk
+        for position in range(0, len(packed.literal), self.WRITE_CHUNK_SIZE):
+            self.write_large_memory(self.ADDR_SCRATCH + position, packed.literal[position:position + self.WRITE_CHUNK_SIZE], self.TRANSFER_BLOCK_SIZE, append_zeros=True)
+        self.bulkcmd_once(f'{packed.command} && {self.write_command([part_name] + list(extra_targets), offset, size)}', silent=True)
+
+    def write_command(self, part_names:list, offset:int, size:int) -> str:
+        """ command to write a chunk from ADDR_TMP to each of the given partitions, failing if any write fails """
+        return ' && '.join([f'amlmmc write {part_name} {hex(self.ADDR_TMP)} {hex(offset)} {hex(size)}' for part_name in part_names])
+
     def validate_partition_size(self, part_name):
         """ Validate the partition size by attempting to read the last sector
             returns tuple of: correct partition size (or None if invalid), and partition offset (or None if invalid)
+            successful results are cached, so each partition is only validated once per device object
         """
+        if part_name in self.partition_cache:
+            return self.partition_cache[part_name]
         if part_name not in self.PARTITIONS:
             self.print(f'Error: Invalid partition name: "{part_name}"')
             return (None, None)
@@ -364,6 +718,7 @@ class SuperbirdDevice:
                 return (None, None)
         stdout_clear_lines(1)
         print(f'Validating size of partition: {part_name} size: {hex(part_size)} {round(part_size / 1024 / 1024)}MB - OK')
+        self.partition_cache[part_name] = (part_size, part_offset)
         return (part_size, part_offset)
 
     def dump_partition(self, part_name:str, outfile:str):
@@ -372,6 +727,7 @@ class SuperbirdDevice:
                 but we can read from mmc into memory,
                 so we read it into memory, then read it from memory and append it to file, one chunk at a time
                 this is excruciatingly slow, compared to dumping using the offical amlogic tool, about 500KB/s, roughly 110 minutes to dump
+            chunks which are all zeros (checked with crc32 on the device) are not read out, and left as holes in the output file
         """
         (part_size, part_offset) = self.validate_partition_size(part_name)
         if part_size is None:
@@ -386,13 +742,18 @@ class SuperbirdDevice:
                     if part_name == 'bootloader':
                         # when writing bootloader, it is actually written one sector after beginning of the partition
                         offset = self.PART_SECTOR_SIZE
+                    start_offset = offset
+                    skipped = 0
                     first_chunk = True
                     last_chunk = False
                     remaining = part_size
                     start_time = time.time()
+                    retries_seen = self.retry_count
                     while remaining:
-                        if first_chunk:
+                        if first_chunk or self.retry_count != retries_seen:
+                            # do not clear lines if there are retry messages to keep on screen
                             first_chunk = False
+                            retries_seen = self.retry_count
                         else:
                             stdout_clear_lines(2)
                         if remaining <= chunk_size:
@@ -406,15 +767,22 @@ class SuperbirdDevice:
                         else:
                             speed = round((offset / elapsed) / 1024)  # in KB/s
                         self.print(f'dumping partition: "{part_name}" {hex(part_offset)}+{hex(offset)} into file: {outfile} ')
-                        self.print(f'chunk_size: {chunk_size / 1024}KB, speed: {speed}KB/s progress: {progress}% remaining: {round(remaining / 1024 / 1024)}MB / {round(part_size / 1024 / 1024)}MB')
-                        self.bulkcmd(f'amlmmc read {part_name} {hex(self.ADDR_TMP)} {hex(offset)} {hex(chunk_size)}', silent=True)
-                        rdata = self.read_memory(self.ADDR_TMP, chunk_size)
-                        ofl.raw.write(rdata)
-                        ofl.flush()
+                        self.print(f'chunk_size: {chunk_size / 1024}KB, speed: {speed}KB/s progress: {progress}% remaining: {round(remaining / 1024 / 1024)}MB / {round(part_size / 1024 / 1024)}MB, zeros skipped: {round(skipped / 1024 / 1024)}MB')
+                        rdata = self.retry(f'reading partition: "{part_name}" chunk at offset {hex(offset)}', self.read_partition_chunk, part_name, offset, chunk_size, self.SKIP_ZERO_CHUNKS)
+                        if rdata is None:
+                            # all zeros, leave a hole
+                            skipped += chunk_size
+                        else:
+                            ofl.seek(offset - start_offset)
+                            ofl.write(rdata)
                         if last_chunk:
                             break
                         offset += chunk_size
                         remaining -= chunk_size
+                    # make sure the file is full size, even if it ends with a hole
+                    ofl.truncate(part_size)
+                    elapsed = time.time() - start_time
+                    self.print(f'dumped partition: "{part_name}" {round(part_size / 1024 / 1024, 2)}MB, zeros skipped: {round(skipped / 1024 / 1024, 2)}MB, took: {round(elapsed, 2)}s')
             except Exception as ex:
                 # in the event of any failure while reading partitions,
                 #   force the entire script to exit
@@ -422,16 +790,33 @@ class SuperbirdDevice:
                 print(traceback.format_exc())
                 sys.exit(1)
 
-    def restore_partition(self, part_name:str, infile:str):
+    def restore_partition(self, part_name:str, infile:str, extra_targets:list=()):
         """ Restore given partition from given dump
             Like with dump_partition, we first have to read it into RAM, then instruct the device to write it to mmc, one chunk at a time
+            Android sparse images are also accepted, see restore_sparse_partition
+            The same image is also written to each of extra_targets (which must be the same size), uploading each chunk only once
+            With COMPRESS_CHUNKS, raw images are packed on the host first, see restore_packed_partition
         """
-        self.bulkcmd('amlmmc part 1', silent=True)
+        if not self.partition_table_loaded:
+            self.bulkcmd('amlmmc part 1', silent=True)
+            self.partition_table_loaded = True
+        self.env_cache = None  # restoring env partition changes env
         (part_size, part_offset) = self.validate_partition_size(part_name)
         if part_size is None:
             raise ValueError('Failed to validate partition size!')
         else:
             try:
+                for target in extra_targets:
+                    if part_name == 'bootloader' or target == 'bootloader':
+                        raise ValueError('bootloader cannot be written together with other partitions')
+                    if self.validate_partition_size(target)[0] != part_size:
+                        raise ValueError(f'{target} is not the same size as {part_name}')
+                target_names = ', '.join([f'"{name}"' for name in [part_name] + list(extra_targets)])
+                if is_sparse_image(infile):
+                    if part_name == 'bootloader':
+                        raise ValueError('Sparse images cannot be used for bootloader partition')
+                    self.restore_sparse_partition(part_name, infile, part_size, part_offset, extra_targets)
+                    return
                 chunk_size = self.WRITE_CHUNK_SIZE
                 file_size = os.path.getsize(infile)
                 if part_name == 'bootloader':
@@ -440,10 +825,13 @@ class SuperbirdDevice:
                     file_size = part_size
                 if file_size > part_size:
                     raise ValueError(f'File is larger than target partition: {file_size} vs {part_size}')
+                if self.COMPRESS_CHUNKS and part_name != 'bootloader':
+                    self.restore_packed_partition(part_name, infile, file_size, part_offset, extra_targets)
+                    return
                 if file_size <= self.TRANSFER_SIZE_THRESHOLD:
                     # 2MB and lower, send as one chunk
                     chunk_size = file_size
-                with open(infile, 'rb') as ifl:
+                with mapped_file(infile) as image:
                     # now we are ready to actually write to the partition
                     offset = 0
                     first_chunk = True
@@ -452,9 +840,12 @@ class SuperbirdDevice:
                     start_time = time.time()
                     # TODO right now get_status always fails, it does not seem to be tracking our write progress
                     # self.device.bulkCmd(f'download store {part_name} normal {hex(part_size)}')
+                    retries_seen = self.retry_count
                     while remaining:
-                        if first_chunk:
+                        if first_chunk or self.retry_count != retries_seen:
+                            # do not clear lines if there are retry messages to keep on screen
                             first_chunk = False
+                            retries_seen = self.retry_count
                         else:
                             stdout_clear_lines(2)
                         if remaining <= chunk_size:
@@ -467,17 +858,17 @@ class SuperbirdDevice:
                             speed = 0
                         else:
                             speed = round((offset / elapsed) / 1024 / 1024, 2)  # in MB/s
-                        data = ifl.read(chunk_size)
                         remaining -= chunk_size
-                        self.print(f'writing partition: "{part_name}" {hex(part_offset)}+{hex(offset)} from file: {infile}')
+                        self.print(f'writing partition: {target_names} {hex(part_offset)}+{hex(offset)} from file: {infile}')
                         self.print(f'chunk_size: {chunk_size / 1024}KB, speed: {speed}MB/s progress: {progress}% remaining: {round(remaining / 1024 / 1024)}MB / {round(part_size / 1024 / 1024)}MB')
-                        self.device.writeLargeMemory(self.ADDR_TMP, data, self.TRANSFER_BLOCK_SIZE, appendZeros=True)
-                        if part_name == 'bootloader':
-                            # bootloader always causes timeout
-                            self.bulkcmd(f'amlmmc write {part_name} {hex(self.ADDR_TMP)} {hex(offset)} {hex(chunk_size)}', silent=True, ignore_timeout=True)
-                            time.sleep(2)  # let bootloader settle
-                        else:
-                            self.bulkcmd(f'amlmmc write {part_name} {hex(self.ADDR_TMP)} {hex(offset)} {hex(chunk_size)}', silent=True)
+                        with image[offset:offset + chunk_size] as data:
+                            if part_name == 'bootloader':
+                                # bootloader always causes timeout
+                                self.write_large_memory(self.ADDR_TMP, data, self.TRANSFER_BLOCK_SIZE, append_zeros=True)
+                                self.bulkcmd(f'amlmmc write {part_name} {hex(self.ADDR_TMP)} {hex(offset)} {hex(chunk_size)}', silent=True, ignore_timeout=True)
+                                time.sleep(2)  # let bootloader settle
+                            else:
+                                self.retry(f'writing partition: {target_names} chunk at offset {hex(offset)}', self.write_partition_chunk, part_name, data, offset, chunk_size, extra_targets)
                         offset += chunk_size
                         if last_chunk:
                             break
@@ -488,3 +879,111 @@ class SuperbirdDevice:
                 print(f'Error while restoring partition {part_name}, {ex}')
                 print(traceback.format_exc())
                 sys.exit(1)
+
+    def fill_partition_chunk(self, part_name:str, fill:int, offset:int, size:int, extra_targets:list=()):
+        """ fill a chunk of RAM on the device with a 32-bit value, then write it to a partition (and each of extra_targets), in one retryable step """
+        self.bulkcmd_once(f'mw.l {hex(self.ADDR_TMP)} {hex(fill)} {hex(size // 4)}', silent=True)
+        self.bulkcmd_once(self.write_command([part_name] + list(extra_targets), offset, size), silent=True)
+
+    def restore_packed_partition(self, part_name:str, infile:str, file_size:int, part_offset:int, extra_targets:list=()):
+        """ Restore given partition (and each of extra_targets) from a raw image, packed on the host (see superbird_compress)
+            the image is packed in spans of PACK_SPAN_SIZE, each piece expanded on the device with one bulkcmd
+            spans are split in halves where that sends less (see pack_span), down to WRITE_CHUNK_SIZE, and pieces which do not pack are sent as-is
+            only the extent of the image is written, the rest of the partition is left alone
+        """
+        from superbird_compress import PACK_SPAN_SIZE, MAX_COMMAND_LENGTH, packed_spans  # pylint: disable=import-outside-toplevel
+        target_names = ', '.join([f'"{name}"' for name in [part_name] + list(extra_targets)])
+        image_size = (file_size + self.PART_SECTOR_SIZE - 1) // self.PART_SECTOR_SIZE * self.PART_SECTOR_SIZE
+        spans = [(offset, min(PACK_SPAN_SIZE, image_size - offset)) for offset in range(0, image_size, PACK_SPAN_SIZE)]
+        # room left in the bulkcmd for the fills and copies, next to the longest amlmmc write of this restore
+        max_length = MAX_COMMAND_LENGTH - len(self.write_command([part_name] + list(extra_targets), image_size, PACK_SPAN_SIZE)) - len(' && ')
+        self.print(f'restoring partition: {target_names} from file: {infile}, packed')
+        sent = 0
+        written = 0
+        first_chunk = True
+        retries_seen = self.retry_count
+        start_time = time.time()
+        with mapped_file(infile) as image:
+            for pieces in packed_spans(infile, spans, self.WRITE_CHUNK_SIZE, self.ADDR_TMP, self.ADDR_SCRATCH, max_length):
+                for (offset, size, packed) in pieces:
+                    if first_chunk or self.retry_count != retries_seen:
+                        # do not clear lines if there are retry messages to keep on screen
+                        first_chunk = False
+                        retries_seen = self.retry_count
+                    else:
+                        stdout_clear_lines(2)
+                    progress = round((offset / image_size) * 100)
+                    elapsed = time.time() - start_time
+                    if elapsed < 1:
+                        # on a quick enough system, elapsed can be zero, and cause divbyzero error when calculating speed
+                        (speed, wire_speed) = (0, 0)
+                    else:
+                        speed = round((written / elapsed) / 1024 / 1024, 2)  # in MB/s
+                        wire_speed = round((sent / elapsed) / 1024 / 1024, 2)
+                    self.print(f'writing partition: {target_names} {hex(part_offset)}+{hex(offset)} from file: {infile}')
+                    self.print(f'chunk_size: {size / 1024}KB, speed: {speed}MB/s, wire: {wire_speed}MB/s, progress: {progress}% sent: {round(sent / 1024 / 1024)}MB / {round(written / 1024 / 1024)}MB written')
+                    if packed is not None:
+                        self.retry(f'writing partition: {target_names} packed chunk at offset {hex(offset)}', self.write_packed_chunk, part_name, packed, offset, size, extra_targets)
+                        sent += packed.wire_size()
+                    else:
+                        with image[offset:offset + size] as data:
+                            # the last piece can extend past the end of the file, up to the next sector
+                            piece = data if len(data) == size else bytes(data) + bytes(size - len(data))
+                            self.retry(f'writing partition: {target_names} chunk at offset {hex(offset)}', self.write_partition_chunk, part_name, piece, offset, size, extra_targets)
+                        sent += size
+                    written += size
+        elapsed = max(time.time() - start_time, 0.001)
+        self.print(f'restored partition: {target_names} {round(written / 1024 / 1024, 2)}MB, sent: {round(sent / 1024 / 1024, 2)}MB, took: {round(elapsed, 2)}s, effective: {round(written / elapsed / 1024 / 1024, 2)}MB/s, wire: {round(sent / elapsed / 1024 / 1024, 2)}MB/s')
+
+    def restore_sparse_partition(self, part_name:str, infile:str, part_size:int, part_offset:int, extra_targets:list=()):
+        """ Restore given partition (and each of extra_targets) from an Android sparse image, without expanding it
+            RAW chunks are sent in pieces of WRITE_CHUNK_SIZE, FILL chunks are filled in device RAM instead of being sent,
+            and DONT_CARE chunks are skipped entirely
+        """
+        target_names = ', '.join([f'"{name}"' for name in [part_name] + list(extra_targets)])
+        image = SparseImage(infile)
+        if image.expanded_size > part_size:
+            raise ValueError(f'Sparse image is larger than target partition: {image.expanded_size} vs {part_size}')
+        if image.block_size % self.PART_SECTOR_SIZE != 0:
+            raise ValueError(f'Sparse image block size {image.block_size} is not a multiple of sector size {self.PART_SECTOR_SIZE}')
+        self.print(f'restoring partition: {target_names} from sparse image: {infile}, {round(image.expanded_size / 1024 / 1024)}MB expanded')
+        sent = 0
+        filled = 0
+        skipped = 0
+        first_chunk = True
+        retries_seen = self.retry_count
+        start_time = time.time()
+        with mapped_file(infile) as data:
+            for chunk in image.chunks():
+                if chunk.chunk_type not in [CHUNK_TYPE_RAW, CHUNK_TYPE_FILL]:
+                    skipped += chunk.length
+                    continue
+                position = 0
+                while position < chunk.length:
+                    if first_chunk or self.retry_count != retries_seen:
+                        # do not clear lines if there are retry messages to keep on screen
+                        first_chunk = False
+                        retries_seen = self.retry_count
+                    else:
+                        stdout_clear_lines(2)
+                    size = min(self.WRITE_CHUNK_SIZE, chunk.length - position)
+                    offset = chunk.offset + position
+                    progress = round((offset / image.expanded_size) * 100)
+                    elapsed = time.time() - start_time
+                    if elapsed < 1:
+                        # on a quick enough system, elapsed can be zero, and cause divbyzero error when calculating speed
+                        speed = 0
+                    else:
+                        speed = round((sent / elapsed) / 1024 / 1024, 2)  # in MB/s
+                    self.print(f'writing partition: {target_names} {hex(part_offset)}+{hex(offset)} from sparse image: {infile}')
+                    self.print(f'chunk_size: {size / 1024}KB, speed: {speed}MB/s progress: {progress}% sent: {round(sent / 1024 / 1024)}MB filled: {round(filled / 1024 / 1024)}MB skipped: {round(skipped / 1024 / 1024)}MB')
+                    if chunk.chunk_type == CHUNK_TYPE_RAW:
+                        start = chunk.data_offset + position
+                        with data[start:start + size] as piece:
+                            self.retry(f'writing partition: {target_names} chunk at offset {hex(offset)}', self.write_partition_chunk, part_name, piece, offset, size, extra_targets)
+                        sent += size
+                    else:
+                        self.retry(f'filling partition: {target_names} chunk at offset {hex(offset)}', self.fill_partition_chunk, part_name, chunk.fill, offset, size, extra_targets)
+                        filled += size
+                    position += size
+        self.print(f'restored partition: {target_names} from sparse image, sent: {round(sent / 1024 / 1024, 2)}MB filled: {round(filled / 1024 / 1024, 2)}MB skipped: {round(skipped / 1024 / 1024, 2)}MB')
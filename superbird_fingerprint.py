@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Identify which known firmware a device is running, without dumping it
+
+A catalog (json file) holds, for each known image, the crc32 of a few sampled ranges of each firmware partition
+add_to_catalog computes them from a --dump_device folder
+fingerprint has the device compute the same crc32s with u-boot crc32 (a few ranges per bulkcmd, 4 bytes read back per range),
+    then reports the catalog image which matches, or which partitions diverge from the closest one
+    partitions which cannot be sampled (unknown to this tool, or failing to read on the device) are reported as unknown, and not compared
+
+Only partitions which do not change during normal use are sampled; env, misc, settings and data are left out
+"""
+# pylint: disable=line-too-long,broad-except
+
+import os
+import sys
+import json
+import mmap
+import binascii
+
+from superbird_partitions import DUMP_FILENAMES
+
+CATALOG_VERSION = 1
+SAMPLE_COUNT = 4  # ranges sampled per partition, the first always at the start (where headers and superblocks live)
+SAMPLE_SIZE = 64 * 1024  # bytes per sampled range
+SAMPLE_ALIGN = 512  # sampled ranges start on a sector boundary
+FINGERPRINT_PARTITIONS = ['bootloader', 'fip_a', 'fip_b', 'logo', 'dtbo_a', 'dtbo_b', 'vbmeta_a', 'vbmeta_b', 'boot_a', 'boot_b', 'system_a', 'system_b']
+BOOTLOADER_OFFSET = 512  # bootloader dumps start one sector into the partition
+MAX_COMMAND_LENGTH = 480  # bytes, longest bulkcmd sent; the ranges of a partition are split over as many bulkcmds as needed
+
+
+def sample_ranges(size:int) -> list:
+    """ ranges to sample from a partition (or dump) of given size, as a list of (offset, length) """
+    length = min(SAMPLE_SIZE, size)
+    if length == 0:
+        return []
+    last = (size - length) // SAMPLE_ALIGN * SAMPLE_ALIGN
+    offsets = sorted(set([(last * index // max(SAMPLE_COUNT - 1, 1)) // SAMPLE_ALIGN * SAMPLE_ALIGN for index in range(SAMPLE_COUNT)]))
+    return [(offset, length) for offset in offsets]
+
+
+def load_catalog(catalog_file:str) -> dict:
+    """ load a catalog, or return an empty one if the file does not exist """
+    if not os.path.isfile(catalog_file):
+        return {'version': CATALOG_VERSION, 'images': {}}
+    with open(catalog_file, 'r', encoding='utf-8') as ctf:
+        catalog = json.load(ctf)
+    if catalog.get('version') != CATALOG_VERSION:
+        raise ValueError(f'Unsupported catalog version: {catalog.get("version")}')
+    return catalog
+
+
+def add_to_catalog(catalog_file:str, folder_name:str, image_name:str):
+    """ sample the firmware partitions of a --dump_device folder, and add them to a catalog under the given name """
+    print(f'Adding {folder_name} to catalog: {catalog_file} as: {image_name}')
+    catalog = load_catalog(catalog_file)
+    image = {}
+    for part_name in FINGERPRINT_PARTITIONS:
+        dump_file = os.path.join(folder_name, DUMP_FILENAMES[part_name])
+        if not os.path.isfile(dump_file) or os.path.getsize(dump_file) == 0:
+            print(f'  {part_name}: missing {dump_file}, not sampled')
+            continue
+        samples = []
+        with open(dump_file, 'rb') as dmf:
+            with mmap.mmap(dmf.fileno(), 0, access=mmap.ACCESS_READ) as dump:
+                for (offset, length) in sample_ranges(len(dump)):
+                    samples.append({'offset': offset, 'size': length, 'crc': binascii.crc32(dump[offset:offset + length]) & 0xffffffff})
+        image[part_name] = samples
+        print(f'  {part_name}: {len(samples)} ranges sampled')
+    if image_name in catalog['images']:
+        print(f'  replacing existing entry: {image_name}')
+    catalog['images'][image_name] = image
+    with open(catalog_file, 'w', encoding='utf-8') as ctf:
+        json.dump(catalog, ctf, indent=1)
+    print(f'Catalog now has {len(catalog["images"])} images')
+
+
+def sample_command(dev, part_name:str, batch:list) -> str:
+    """ bulkcmd which has the device compute crc32 of each (offset, length) in batch, storing the results one after another at ADDR_CRC
+        offsets are relative to the start of a dump of the partition
+    """
+    base = BOOTLOADER_OFFSET if part_name == 'bootloader' else 0
+    commands = []
+    for index, (offset, length) in enumerate(batch):
+        commands.append(f'amlmmc read {part_name} {hex(dev.ADDR_TMP)} {hex(base + offset)} {hex(length)}')
+        commands.append(dev.crc_command(dev.ADDR_TMP, length, dev.ADDR_CRC + index * 4))
+    return ' && '.join(commands)
+
+
+def sample_batch(dev, part_name:str, batch:list) -> list:
+    """ have the device compute crc32 of each (offset, length) in batch, in one bulkcmd
+        returns list of 4 bytes of crc32 result for each range, as stored by the device
+    """
+    dev.bulkcmd_once(sample_command(dev, part_name, batch), silent=True)
+    results = dev.read_memory(dev.ADDR_CRC, len(batch) * 4)
+    return [results[index * 4:index * 4 + 4] for index in range(len(batch))]
+
+
+def sample_partition(dev, part_name:str, ranges:list, size:int) -> dict:
+    """ have the device compute crc32 of each range of a partition, in as few bulkcmds of up to MAX_COMMAND_LENGTH as it takes
+        ranges are clamped to size (of a dump of the partition), ranges starting past it are not sampled
+        returns dict of (offset, size): 4 bytes of crc32 result as stored by the device, or None if not sampled
+    """
+    results = {sample_range: None for sample_range in ranges}
+    sampled = [sample_range for sample_range in ranges if sample_range[0] < size]
+    batch = []
+    for index, (offset, length) in enumerate(sampled):
+        batch.append((offset, min(length, size - offset)))
+        following = sampled[index + 1:index + 2]
+        if following and len(sample_command(dev, part_name, batch + following)) <= MAX_COMMAND_LENGTH:
+            continue
+        crcs = dev.retry(f'sampling {part_name}', sample_batch, dev, part_name, batch)
+        results.update(zip(sampled[index + 1 - len(batch):index + 1], crcs))
+        batch = []
+    return results
+
+
+def fingerprint(dev, catalog_file:str):
+    """ identify which catalogued image the device is running, using crc32 of sampled ranges computed on the device """
+    # pylint: disable=import-outside-toplevel
+    from superbird_device import BulkcmdException
+    catalog = load_catalog(catalog_file)
+    if not catalog['images']:
+        print(f'Catalog is empty: {catalog_file}, add images to it with add_to_catalog')
+        sys.exit(1)
+    if not dev.partition_table_loaded:
+        dev.bulkcmd('amlmmc part 1')
+        dev.partition_table_loaded = True
+    # every image of the same device model samples the same ranges, so each range only needs to be computed once
+    ranges = {}
+    for image in catalog['images'].values():
+        for part_name, samples in image.items():
+            ranges.setdefault(part_name, set()).update([(sample['offset'], sample['size']) for sample in samples])
+    print(f'Sampling {sum(len(part_ranges) for part_ranges in ranges.values())} ranges from {len(ranges)} partitions')
+    results = {}  # partition name: results of sample_partition, partitions which could not be sampled are left out
+    for part_name in sorted(ranges, key=lambda name: FINGERPRINT_PARTITIONS.index(name) if name in FINGERPRINT_PARTITIONS else len(FINGERPRINT_PARTITIONS)):
+        if part_name not in FINGERPRINT_PARTITIONS:
+            print(f'  {part_name}: not a firmware partition, unknown')
+            continue
+        (part_size, _part_offset) = dev.validate_partition_size(part_name)
+        if part_size is None:
+            print(f'  {part_name}: failed to validate partition, unknown')
+            continue
+        try:
+            # a dump is as large as the partition, including the bootloader, whose dump starts one sector in
+            results[part_name] = sample_partition(dev, part_name, sorted(ranges[part_name]), part_size)
+        except BulkcmdException as ex:
+            print(f'  {part_name}: failed to sample ({ex}), unknown')
+    # compare against each image, leaving out partitions which could not be sampled
+    scores = []
+    for image_name, image in catalog['images'].items():
+        (matching, diverging) = ([], [])
+        for part_name, samples in image.items():
+            if part_name not in results:
+                continue
+            part_results = results[part_name]
+            if all(part_results[(sample['offset'], sample['size'])] is not None and dev.crc_matches(part_results[(sample['offset'], sample['size'])], sample['crc']) for sample in samples):
+                matching.append(part_name)
+            else:
+                diverging.append(part_name)
+        scores.append((len(matching), image_name, diverging))
+    unknown = sorted(set(ranges) - set(results))
+    if unknown:
+        print(f'Could not sample: {", ".join(unknown)}; these partitions are unknown, and were not compared')
+    matches = [image_name for (score, image_name, diverging) in scores if score and not diverging]
+    if matches:
+        print(f'Device matches: {", ".join(matches)}')
+        return
+    (score, image_name, diverging) = max(scores, key=lambda score: score[0])
+    print('Device does not match any catalogued image')
+    print(f'Closest: {image_name}, {score} of {score + len(diverging)} partitions match, diverging partitions:')
+    for part_name in diverging:
+        print(f'  {part_name}')
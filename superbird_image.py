@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+Offline conversion between a --dump_device folder and a single raw eMMC disk image
+
+assemble_image places each partition dump at its offset from SUPERBIRD_PARTITIONS, so the result can be inspected as a whole disk
+split_image does the reverse, producing a folder that --restore_device accepts
+
+Output files are sparse: all-zero blocks, and holes in the input, are left as holes instead of being written,
+    and data is copied kernel-side with copy_file_range (which can reflink on btrfs/xfs) where available
+"""
+# pylint: disable=line-too-long,broad-except
+
+import os
+import errno
+
+from superbird_partitions import SUPERBIRD_PARTITIONS, DUMP_FILENAMES
+
+PART_SECTOR_SIZE = 512  # bytes, size of sectors used in partition table
+BOOTLOADER_SIZE = 2 * 1024 * 1024  # bootloader dumps are 2MB, starting one sector into the partition
+SPARSE_BLOCK_SIZE = 1024 * 1024  # input is checked for zeros one block at a time
+ZERO_BLOCK = bytes(SPARSE_BLOCK_SIZE)
+# errors from copy_file_range which mean we should fall back to copying through userspace
+COPY_FALLBACK_ERRORS = [errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF]
+
+
+def partition_extent(part_name:str) -> tuple:
+    """ location of a partition dump within the disk image
+        returns tuple of: offset in bytes, maximum size in bytes
+    """
+    part_offset = SUPERBIRD_PARTITIONS[part_name]['offset'] * PART_SECTOR_SIZE
+    part_size = SUPERBIRD_PARTITIONS[part_name]['size'] * PART_SECTOR_SIZE
+    if part_name == 'bootloader':
+        # bootloader is written one sector after the beginning of the partition, and dumps start there too
+        return (part_offset + PART_SECTOR_SIZE, BOOTLOADER_SIZE)
+    return (part_offset, part_size)
+
+
+def disk_size() -> int:
+    """ size of a full disk image, in bytes: up to the end of the last partition """
+    return max([partition_extent(part_name)[0] + partition_extent(part_name)[1] for part_name in DUMP_FILENAMES])
+
+
+def data_extents(fd:int, start:int, end:int):
+    """ yield tuples of (offset, length) for regions between start and end which may contain data
+        holes are skipped using SEEK_DATA / SEEK_HOLE; if not supported, the whole range is one region
+    """
+    if not hasattr(os, 'SEEK_DATA'):
+        yield (start, end - start)
+        return
+    offset = start
+    while offset < end:
+        try:
+            data_start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as ex:
+            if ex.errno != errno.ENXIO:
+                # filesystem does not support seeking holes
+                yield (offset, end - offset)
+            # ENXIO: no more data after offset
+            return
+        if data_start >= end:
+            return
+        data_end = min(os.lseek(fd, data_start, os.SEEK_HOLE), end)
+        yield (data_start, data_end - data_start)
+        offset = data_end
+
+
+def copy_range(src_fd:int, dst_fd:int, src_offset:int, dst_offset:int, length:int):
+    """ copy a range between files, kernel-side if possible """
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while length > 0:
+                copied = os.copy_file_range(src_fd, dst_fd, length, src_offset, dst_offset)
+                if copied == 0:
+                    break
+                src_offset += copied
+                dst_offset += copied
+                length -= copied
+        except OSError as ex:
+            if ex.errno not in COPY_FALLBACK_ERRORS:
+                raise
+    while length > 0:
+        data = os.pread(src_fd, min(length, SPARSE_BLOCK_SIZE), src_offset)
+        if not data:
+            raise EOFError(f'Unexpected end of file at offset {src_offset}')
+        os.pwrite(dst_fd, data, dst_offset)
+        src_offset += len(data)
+        dst_offset += len(data)
+        length -= len(data)
+
+
+def sparse_copy(src_fd:int, dst_fd:int, src_offset:int, dst_offset:int, length:int) -> int:
+    """ copy a range between files, skipping holes and all-zero blocks
+        destination must already be sized (truncated) so that skipped ranges read as zeros
+        returns number of bytes actually copied
+    """
+    copied = 0
+    for (extent_offset, extent_length) in data_extents(src_fd, src_offset, src_offset + length):
+        extent_end = extent_offset + extent_length
+        run_start = None  # start of the current run of non-zero blocks
+        position = extent_offset
+        while position < extent_end:
+            block_size = min(SPARSE_BLOCK_SIZE, extent_end - position)
+            block = os.pread(src_fd, block_size, position)
+            if len(block) < block_size:
+                # file is shorter than expected, stop at end of file
+                extent_end = position + len(block)
+            is_zero = block == ZERO_BLOCK if len(block) == SPARSE_BLOCK_SIZE else block.count(0) == len(block)
+            if is_zero and run_start is not None:
+                copy_range(src_fd, dst_fd, run_start, dst_offset + (run_start - src_offset), position - run_start)
+                copied += position - run_start
+                run_start = None
+            elif not is_zero and run_start is None:
+                run_start = position
+            position += len(block)
+            if not block:
+                break
+        if run_start is not None:
+            copy_range(src_fd, dst_fd, run_start, dst_offset + (run_start - src_offset), extent_end - run_start)
+            copied += extent_end - run_start
+    return copied
+
+
+def assemble_image(folder_name:str, image_file:str):
+    """ assemble partition dumps from a --dump_device folder into a single sparse raw disk image """
+    print(f'Assembling disk image: {image_file} from dumpfiles in {folder_name}')
+    image_size = disk_size()
+    total_copied = 0
+    with open(image_file, 'wb') as imf:
+        imf.truncate(image_size)
+        for part_name, file_name in DUMP_FILENAMES.items():
+            dump_file = os.path.join(folder_name, file_name)
+            if not os.path.isfile(dump_file):
+                print(f'  {part_name}: missing {dump_file}, leaving it empty')
+                continue
+            (offset, max_size) = partition_extent(part_name)
+            dump_size = os.path.getsize(dump_file)
+            if dump_size > max_size:
+                print(f'  {part_name}: {dump_file} is larger than the partition, only using the first {max_size} bytes')
+                dump_size = max_size
+            with open(dump_file, 'rb') as dmf:
+                copied = sparse_copy(dmf.fileno(), imf.fileno(), 0, offset, dump_size)
+            total_copied += copied
+            print(f'  {part_name}: {hex(offset)} {round(dump_size / 1024 / 1024, 2)}MB, data: {round(copied / 1024 / 1024, 2)}MB')
+    print(f'Assembled {round(image_size / 1024 / 1024)}MB disk image, containing {round(total_copied / 1024 / 1024, 2)}MB of data')
+
+
+def split_image(image_file:str, folder_name:str):
+    """ split a raw disk image into sparse partition dumps, in a folder which --restore_device accepts """
+    # pylint: disable=import-outside-toplevel
+    from superbird_operations import convert_env_dump
+    print(f'Splitting disk image: {image_file} into dumpfiles in {folder_name}')
+    image_size = os.path.getsize(image_file)
+    os.makedirs(folder_name, exist_ok=True)
+    total_copied = 0
+    with open(image_file, 'rb') as imf:
+        for part_name, file_name in DUMP_FILENAMES.items():
+            (offset, part_size) = partition_extent(part_name)
+            if offset >= image_size:
+                print(f'  {part_name}: beyond end of image, skipping')
+                continue
+            if part_name == 'data' and offset + part_size > image_size:
+                # some devices have a smaller data partition
+                part_size = min(SUPERBIRD_PARTITIONS[part_name]['size_alt'] * PART_SECTOR_SIZE, image_size - offset)
+            part_size = min(part_size, image_size - offset)
+            dump_file = os.path.join(folder_name, file_name)
+            with open(dump_file, 'wb') as dmf:
+                dmf.truncate(part_size)
+                copied = sparse_copy(imf.fileno(), dmf.fileno(), offset, 0, part_size)
+            total_copied += copied
+            print(f'  {part_name}: {dump_file} {round(part_size / 1024 / 1024, 2)}MB, data: {round(copied / 1024 / 1024, 2)}MB')
+    convert_env_dump(os.path.join(folder_name, DUMP_FILENAMES['env']), os.path.join(folder_name, 'env.txt'))
+    print(f'Split disk image into {folder_name}, containing {round(total_copied / 1024 / 1024, 2)}MB of data')
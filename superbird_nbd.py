@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+"""
+Serve a partition of a device in USB Burn Mode as a network block device (NBD), on a local Unix socket
+
+This lets you mount or fsck a partition in place, without dumping it first:
+    sudo ./superbird_tool.py serve_nbd settings /tmp/settings.sock
+    sudo nbd-client -unix /tmp/settings.sock /dev/nbd0 -N settings
+    sudo fsck.ext4 -n /dev/nbd0
+
+Reads go through a PartitionReader (superbird_reader.py), so they are cached
+Writes (only with serve_nbd_writable) are held in RAM, and coalesced into chunks of up to WRITE_CHUNK_SIZE,
+    which are written when the client flushes, disconnects, or too much is pending
+
+Only the fixed newstyle handshake and simple replies are implemented, which every NBD client supports
+NbdClient is a minimal client for the same protocol, for scripts which cannot use the kernel client
+"""
+# pylint: disable=line-too-long,broad-except
+
+import os
+import sys
+import stat
+import socket
+import struct
+import traceback
+
+from superbird_reader import PartitionReader
+
+# handshake
+NBD_MAGIC = b'NBDMAGIC'
+NBD_OPTS_MAGIC = 0x49484156454F5054  # IHAVEOPT
+NBD_REP_MAGIC = 0x3e889045565a9
+NBD_FLAG_FIXED_NEWSTYLE = 1 << 0
+NBD_FLAG_NO_ZEROES = 1 << 1
+NBD_OPT_EXPORT_NAME = 1
+NBD_OPT_ABORT = 2
+NBD_OPT_LIST = 3
+NBD_OPT_INFO = 6
+NBD_OPT_GO = 7
+NBD_REP_ACK = 1
+NBD_REP_SERVER = 2
+NBD_REP_INFO = 3
+NBD_REP_ERR_UNSUP = (1 << 31) + 1
+NBD_INFO_EXPORT = 0
+NBD_INFO_BLOCK_SIZE = 3
+# transmission
+NBD_REQUEST_MAGIC = 0x25609513
+NBD_SIMPLE_REPLY_MAGIC = 0x67446698
+NBD_FLAG_HAS_FLAGS = 1 << 0
+NBD_FLAG_READ_ONLY = 1 << 1
+NBD_FLAG_SEND_FLUSH = 1 << 2
+NBD_FLAG_SEND_FUA = 1 << 3
+NBD_CMD_READ = 0
+NBD_CMD_WRITE = 1
+NBD_CMD_DISC = 2
+NBD_CMD_FLUSH = 3
+NBD_CMD_FLAG_FUA = 1 << 0
+NBD_EPERM = 1
+NBD_EIO = 5
+NBD_EINVAL = 22
+NBD_ENOSPC = 28
+
+MAX_REQUEST_SIZE = 32 * 1024 * 1024  # larger requests are refused, and clients are told so
+WRITE_PENDING_LIMIT = 4 * 1024 * 1024  # pending writes are flushed to the device once they reach this size
+
+
+class NbdError(Exception):
+    """ the other side of an NBD connection broke the protocol, or replied with an error """
+
+
+def recv_exactly(connection, size:int) -> bytes:
+    """ receive exactly size bytes, raises EOFError if the connection closes first """
+    data = bytearray()
+    while len(data) < size:
+        received = connection.recv(size - len(data))
+        if not received:
+            raise EOFError('connection closed')
+        data += received
+    return bytes(data)
+
+
+class PartitionExport:
+    """ a partition, as seen by the NBD server: read, write and flush at byte offsets
+        writes are kept as dirty sectors until flush, reads see them
+    """
+    def __init__(self, dev, part_name:str, writable:bool=False) -> None:
+        if writable and part_name == 'bootloader':
+            raise ValueError('bootloader cannot be served writable, use restore_partition')
+        self.dev = dev
+        self.part_name = part_name
+        self.read_only = not writable
+        self.reader = PartitionReader(dev, part_name)
+        self.size = self.reader.size
+        self.sector_size = dev.PART_SECTOR_SIZE
+        self.dirty = {}  # sector index: bytes, waiting to be written
+        self.sectors_written = 0
+
+    def read(self, offset:int, size:int) -> bytes:
+        """ read from the device (through the cache), with pending writes applied on top """
+        data = self.reader.read_at(offset, size)
+        if not self.dirty:
+            return data
+        data = bytearray(data)
+        first = offset // self.sector_size
+        last = (offset + size - 1) // self.sector_size
+        for sector in range(first, last + 1):
+            if sector in self.dirty:
+                sector_start = sector * self.sector_size
+                start = max(offset, sector_start)
+                end = min(offset + size, sector_start + self.sector_size)
+                data[start - offset:end - offset] = self.dirty[sector][start - sector_start:end - sector_start]
+        return bytes(data)
+
+    def write(self, offset:int, data:bytes):
+        """ hold a write as dirty sectors; partial sectors are filled in from the device first """
+        first = offset // self.sector_size
+        last = (offset + len(data) - 1) // self.sector_size
+        for sector in range(first, last + 1):
+            sector_start = sector * self.sector_size
+            start = max(offset, sector_start)
+            end = min(offset + len(data), sector_start + self.sector_size)
+            if end - start == self.sector_size:
+                self.dirty[sector] = data[start - offset:end - offset]
+            else:
+                sector_data = bytearray(self.read(sector_start, self.sector_size))
+                sector_data[start - sector_start:end - sector_start] = data[start - offset:end - offset]
+                self.dirty[sector] = bytes(sector_data)
+        if len(self.dirty) * self.sector_size >= WRITE_PENDING_LIMIT:
+            self.flush()
+
+    def flush(self):
+        """ write all dirty sectors to the device, as runs of consecutive sectors of up to WRITE_CHUNK_SIZE """
+        if not self.dirty:
+            return
+        max_sectors = self.dev.WRITE_CHUNK_SIZE // self.sector_size
+        run = []
+        for sector in sorted(self.dirty):
+            if run and (sector != run[-1] + 1 or len(run) >= max_sectors):
+                self.write_run(run)
+                run = []
+            run.append(sector)
+        self.write_run(run)
+        self.dirty = {}
+
+    def write_run(self, run:list):
+        """ write consecutive dirty sectors to the device """
+        offset = run[0] * self.sector_size
+        data = b''.join([self.dirty[sector] for sector in run])
+        self.dev.retry(f'writing partition: "{self.part_name}" at offset {hex(offset)}', self.dev.write_partition_chunk, self.part_name, data, offset, len(data))
+        self.reader.invalidate(offset, len(data))
+        self.sectors_written += len(run)
+
+
+class NbdServer:
+    """ serves one export to one client at a time, over a connected socket """
+    def __init__(self, export) -> None:
+        self.export = export
+        self.requests = 0
+
+    def transmission_flags(self) -> int:
+        """ flags telling the client what the export supports """
+        flags = NBD_FLAG_HAS_FLAGS | NBD_FLAG_SEND_FLUSH
+        if self.export.read_only:
+            flags |= NBD_FLAG_READ_ONLY
+        else:
+            flags |= NBD_FLAG_SEND_FUA
+        return flags
+
+    def serve(self, connection):
+        """ handshake, then handle requests until the client disconnects; pending writes are always flushed """
+        try:
+            if self.handshake(connection):
+                self.transmission(connection)
+        except (EOFError, ConnectionError):
+            pass
+        finally:
+            self.export.flush()
+
+    def send_option_reply(self, connection, option:int, reply_type:int, data:bytes=b''):
+        """ reply to an option during the handshake """
+        connection.sendall(struct.pack('>QIII', NBD_REP_MAGIC, option, reply_type, len(data)) + data)
+
+    def handshake(self, connection) -> bool:
+        """ fixed newstyle negotiation; returns True once the client has picked the export """
+        connection.sendall(NBD_MAGIC + struct.pack('>QH', NBD_OPTS_MAGIC, NBD_FLAG_FIXED_NEWSTYLE | NBD_FLAG_NO_ZEROES))
+        (client_flags,) = struct.unpack('>I', recv_exactly(connection, 4))
+        no_zeroes = client_flags & NBD_FLAG_NO_ZEROES
+        export_info = struct.pack('>QH', self.export.size, self.transmission_flags())
+        name = self.export.part_name.encode('utf-8')
+        while True:
+            (magic, option, length) = struct.unpack('>QII', recv_exactly(connection, 16))
+            if magic != NBD_OPTS_MAGIC:
+                raise NbdError(f'bad option magic: {hex(magic)}')
+            data = recv_exactly(connection, length)
+            if option == NBD_OPT_EXPORT_NAME:
+                # any export name is accepted, there is only one
+                connection.sendall(export_info + (b'' if no_zeroes else bytes(124)))
+                return True
+            if option == NBD_OPT_ABORT:
+                self.send_option_reply(connection, option, NBD_REP_ACK)
+                return False
+            if option == NBD_OPT_LIST:
+                self.send_option_reply(connection, option, NBD_REP_SERVER, struct.pack('>I', len(name)) + name)
+                self.send_option_reply(connection, option, NBD_REP_ACK)
+            elif option in (NBD_OPT_INFO, NBD_OPT_GO):
+                self.send_option_reply(connection, option, NBD_REP_INFO, struct.pack('>H', NBD_INFO_EXPORT) + export_info)
+                self.send_option_reply(connection, option, NBD_REP_INFO, struct.pack('>HIII', NBD_INFO_BLOCK_SIZE, 1, self.export.sector_size, MAX_REQUEST_SIZE))
+                self.send_option_reply(connection, option, NBD_REP_ACK)
+                if option == NBD_OPT_GO:
+                    return True
+            else:
+                self.send_option_reply(connection, option, NBD_REP_ERR_UNSUP)
+
+    def send_reply(self, connection, handle:int, error:int=0, data:bytes=b''):
+        """ simple reply to a request, followed by data for reads """
+        connection.sendall(struct.pack('>IIQ', NBD_SIMPLE_REPLY_MAGIC, error, handle) + data)
+
+    def transmission(self, connection):
+        """ handle requests until the client disconnects """
+        while True:
+            (magic, flags, command, handle, offset, length) = struct.unpack('>IHHQQI', recv_exactly(connection, 28))
+            if magic != NBD_REQUEST_MAGIC:
+                raise NbdError(f'bad request magic: {hex(magic)}')
+            self.requests += 1
+            data = recv_exactly(connection, length) if command == NBD_CMD_WRITE else b''
+            if command == NBD_CMD_DISC:
+                return
+            if command in (NBD_CMD_READ, NBD_CMD_WRITE) and (length > MAX_REQUEST_SIZE or offset + length > self.export.size):
+                # writes past the end are out of space, anything else is invalid
+                self.send_reply(connection, handle, NBD_ENOSPC if command == NBD_CMD_WRITE and length <= MAX_REQUEST_SIZE else NBD_EINVAL)
+                continue
+            try:
+                if command == NBD_CMD_READ:
+                    self.send_reply(connection, handle, 0, self.export.read(offset, length))
+                elif command == NBD_CMD_WRITE:
+                    if self.export.read_only:
+                        self.send_reply(connection, handle, NBD_EPERM)
+                        continue
+                    self.export.write(offset, data)
+                    if flags & NBD_CMD_FLAG_FUA:
+                        self.export.flush()
+                    self.send_reply(connection, handle)
+                elif command == NBD_CMD_FLUSH:
+                    self.export.flush()
+                    self.send_reply(connection, handle)
+                else:
+                    self.send_reply(connection, handle, NBD_EINVAL)
+            except Exception as ex:
+                # retries used up; tell the client, and let it decide whether to carry on
+                print(f'Error during NBD request: {ex}')
+                self.send_reply(connection, handle, NBD_EIO)
+
+
+class NbdClient:
+    """ minimal NBD client, for reading and writing an export without the kernel client """
+    def __init__(self, socket_path:str, export_name:str='') -> None:
+        self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.connection.connect(socket_path)
+        self.handle = 0
+        (magic, opts_magic, _server_flags) = struct.unpack('>8sQH', recv_exactly(self.connection, 18))
+        if magic != NBD_MAGIC or opts_magic != NBD_OPTS_MAGIC:
+            raise NbdError('server does not speak newstyle NBD')
+        self.connection.sendall(struct.pack('>I', NBD_FLAG_FIXED_NEWSTYLE | NBD_FLAG_NO_ZEROES))
+        name = export_name.encode('utf-8')
+        self.connection.sendall(struct.pack('>QII', NBD_OPTS_MAGIC, NBD_OPT_EXPORT_NAME, len(name)) + name)
+        (self.size, self.flags) = struct.unpack('>QH', recv_exactly(self.connection, 10))
+
+    def close(self):
+        """ disconnect cleanly """
+        self.connection.sendall(struct.pack('>IHHQQI', NBD_REQUEST_MAGIC, 0, NBD_CMD_DISC, 0, 0, 0))
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_args):
+        self.close()
+
+    def request(self, command:int, offset:int=0, length:int=0, data:bytes=b'', flags:int=0) -> bytes:
+        """ send one request and wait for its reply; returns data read, raises NbdError on error replies """
+        self.handle += 1
+        self.connection.sendall(struct.pack('>IHHQQI', NBD_REQUEST_MAGIC, flags, command, self.handle, offset, length) + data)
+        (magic, error, handle) = struct.unpack('>IIQ', recv_exactly(self.connection, 16))
+        if magic != NBD_SIMPLE_REPLY_MAGIC or handle != self.handle:
+            raise NbdError('unexpected reply from server')
+        if error:
+            raise NbdError(f'request failed with error: {error}')
+        return recv_exactly(self.connection, length) if command == NBD_CMD_READ else b''
+
+    def read(self, offset:int, length:int) -> bytes:
+        """ read length bytes at offset """
+        return self.request(NBD_CMD_READ, offset, length)
+
+    def write(self, offset:int, data:bytes, fua:bool=False):
+        """ write data at offset; with fua, it reaches the device before the reply """
+        self.request(NBD_CMD_WRITE, offset, len(data), data, NBD_CMD_FLAG_FUA if fua else 0)
+
+    def flush(self):
+        """ ask the server to write everything pending to the device """
+        self.request(NBD_CMD_FLUSH)
+
+
+def socket_in_use(socket_path:str) -> bool:
+    """ check if something is accepting connections on a Unix socket """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(socket_path)
+        except OSError:
+            return False
+    return True
+
+
+def serve_nbd(dev, part_name:str, socket_path:str, writable:bool=False):
+    """ serve a partition over NBD on a Unix socket, one client at a time, until interrupted """
+    if not hasattr(socket, 'AF_UNIX'):
+        print('NBD needs Unix socket support, which is not available on this platform')
+        sys.exit(1)
+    if os.path.lexists(socket_path):
+        # only a stale socket is replaced: never a file someone gave by mistake, nor a server which is still running
+        if not stat.S_ISSOCK(os.lstat(socket_path).st_mode):
+            print(f'Error: {socket_path} exists and is not a socket')
+            sys.exit(1)
+        if socket_in_use(socket_path):
+            print(f'Error: {socket_path} is in use by another server')
+            sys.exit(1)
+        os.unlink(socket_path)
+    if not dev.partition_table_loaded:
+        dev.bulkcmd('amlmmc part 1')
+        dev.partition_table_loaded = True
+    try:
+        export = PartitionExport(dev, part_name, writable)
+    except ValueError as ex:
+        print(f'Error: {ex}')
+        sys.exit(1)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server.bind(socket_path)
+        os.chmod(socket_path, 0o600)
+        server.listen(1)
+        print(f'Serving {part_name} ({round(export.size / 1024 / 1024)}MB, {"read-write" if writable else "read-only"}) over NBD at: {socket_path}')
+        print(f'  connect with: nbd-client -unix {socket_path} /dev/nbd0 -N {part_name}; press Ctrl-C to stop')
+        while True:
+            connection, _address = server.accept()
+            with connection:
+                print('Client connected')
+                nbd_server = NbdServer(export)
+                try:
+                    nbd_server.serve(connection)
+                except Exception as ex:
+                    print(f'Error while serving NBD client: {ex}')
+                    print(traceback.format_exc())
+                print(f'Client disconnected after {nbd_server.requests} requests, cache hits: {export.reader.hits}, misses: {export.reader.misses}, sectors written: {export.sectors_written}')
+    except KeyboardInterrupt:
+        print('Stopping NBD server')
+    finally:
+        server.close()
+        if os.path.lexists(socket_path) and stat.S_ISSOCK(os.lstat(socket_path).st_mode):
+            os.unlink(socket_path)
+        export.flush()
+        if export.sectors_written:
+            dev.env_cache = None
@@ -0,0 +1,430 @@
+#!/usr/bin/env python3
+"""
+Dump and restore partitions over the network, when the device is booted normally with the USB Gadget (S49usbgadget)
+
+In USB Burn Mode, every chunk is staged in device RAM and read out 64 bytes at a time, about 500KB/s
+When booted normally, Linux on the device can read and write the partition block devices directly,
+    so we stream them over adb, or over a plain TCP connection on usbnet (see setup_host_usbnet.sh),
+    compressed with gzip -1 on the sending side, and verified with md5sum on both sides
+
+Transports:
+    adb: uses adb exec-out / exec-in, nothing else needed on the device
+    tcp: talks to a small shell agent on the device, which you can start from a shell on the device (adb shell) with:
+        while true; do nc -l -s 192.168.7.2 -p 7777 -e sh -c 'read -r line; eval "$line"'; done &
+        each connection sends one command line, followed by data for commands that read stdin, and gets back stdout
+        WARNING: the agent is an unauthenticated root shell for anyone who can connect to it
+            bound to the usbnet address as above, only the host on the other end of the USB cable can reach it
+            to keep it off the network entirely, bind it to 127.0.0.1 instead, and reach it through adb:
+                adb forward tcp:7777 tcp:7777, then use: --network tcp:127.0.0.1
+            never bind it to all interfaces, and stop it when done
+
+Bootloader can only be dumped this way; it is only ever restored in USB Burn Mode, as are env and partitions which are mounted
+    restore_device skips those, and lists them; restoring one of them with restore_partition raises NetworkUnsupportedError
+"""
+# pylint: disable=line-too-long,broad-except
+
+import os
+import sys
+import time
+import zlib
+import socket
+import shutil
+import hashlib
+import subprocess
+
+from superbird_partitions import SUPERBIRD_PARTITIONS, DUMP_FILENAMES
+from android_sparse import SparseImage, is_sparse_image, CHUNK_TYPE_RAW, CHUNK_TYPE_FILL
+
+DEFAULT_HOST = '192.168.7.2'  # device address on usbnet, from S49usbgadget
+DEFAULT_PORT = 7777
+CONNECT_TIMEOUT = 3  # seconds
+STREAM_CHUNK_SIZE = 1024 * 1024  # bytes read or sent at a time
+COMPRESS_LEVEL = 1  # gzip level, on both sides; the link is fast enough that more compression only costs time
+GZIP_WBITS = 31  # zlib wbits for gzip format
+STATUS_MARKER = '__superbird_status='
+PART_SECTOR_SIZE = 512
+BOOTLOADER_SIZE = 2 * 1024 * 1024  # bootloader dumps are 2MB, starting one sector into the disk
+DEVICE_DISK = '/dev/mmcblk0'
+# partitions restored by restore_device, in order; env and bootloader need USB Burn Mode
+RESTORE_PARTITIONS = ['fip_a', 'fip_b', 'logo', 'dtbo_a', 'dtbo_b', 'vbmeta_a', 'vbmeta_b', 'boot_a', 'boot_b', 'misc', 'settings', 'system_a', 'system_b', 'data']
+
+
+class NetworkTransportError(Exception):
+    """ a command could not be run on the device, or failed """
+
+
+class NetworkUnsupportedError(NetworkTransportError):
+    """ an operation can only be done in USB Burn Mode; nothing was written """
+
+
+def device_node(part_name:str) -> str:
+    """ block device for a partition on the device; the kernel names them after the partition table """
+    return f'/dev/{part_name}'
+
+
+class NetworkTransport:
+    """ runs shell commands on the device, streaming their input and output
+        subclasses implement read_stream and write_stream
+    """
+    name = 'network'
+
+    def available(self) -> bool:
+        """ check if the device can be reached with this transport """
+        try:
+            return self.run('echo ok').strip() == 'ok'
+        except Exception:
+            return False
+
+    def run(self, command:str) -> str:
+        """ run a command, returns its output
+            raises NetworkTransportError if it exits with non-zero status
+        """
+        output = b''.join(self.read_stream(f'{command}; echo "{STATUS_MARKER}$?"')).decode('utf-8', errors='replace')
+        (output, _marker, status) = output.rpartition(STATUS_MARKER)
+        if status.strip() != '0':
+            raise NetworkTransportError(f'command failed ({status.strip() or "no status"}): {command}')
+        return output
+
+    def read_stream(self, command:str):
+        """ run a command, yield its output in chunks as it arrives """
+        raise NotImplementedError
+
+    def write_stream(self, command:str, chunks):
+        """ run a command, sending it each chunk on stdin, and wait for it to finish """
+        raise NotImplementedError
+
+
+class AdbTransport(NetworkTransport):
+    """ runs commands through adb exec-out / exec-in, which pass binary data through unchanged """
+    name = 'adb'
+
+    def __init__(self, adb:str='adb') -> None:
+        self.adb = adb
+
+    def available(self) -> bool:
+        if shutil.which(self.adb) is None:
+            return False
+        return super().available()
+
+    def read_stream(self, command:str):
+        process = subprocess.Popen([self.adb, 'exec-out', command], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        try:
+            while True:
+                data = process.stdout.read(STREAM_CHUNK_SIZE)
+                if not data:
+                    break
+                yield data
+        finally:
+            process.stdout.close()
+            if process.wait() != 0:
+                raise NetworkTransportError(f'adb exited with status {process.returncode}')
+
+    def write_stream(self, command:str, chunks):
+        # exec-in only carries stdin; the command's output is discarded
+        process = subprocess.Popen([self.adb, 'exec-in', command], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            for chunk in chunks:
+                process.stdin.write(chunk)
+        finally:
+            process.stdin.close()
+            if process.wait() != 0:
+                raise NetworkTransportError(f'adb exited with status {process.returncode}')
+
+
+class TcpTransport(NetworkTransport):
+    """ runs commands through the shell agent on the device (see module docstring), one connection per command """
+    name = 'tcp'
+
+    def __init__(self, host:str=DEFAULT_HOST, port:int=DEFAULT_PORT) -> None:
+        self.host = host
+        self.port = port
+
+    def connect(self, command:str) -> socket.socket:
+        """ connect to the agent, and send it a command """
+        try:
+            sock = socket.create_connection((self.host, self.port), timeout=CONNECT_TIMEOUT)
+        except OSError as ex:
+            raise NetworkTransportError(f'cannot connect to {self.host}:{self.port}: {ex}') from ex
+        sock.settimeout(None)
+        sock.sendall(command.encode('utf-8') + b'\n')
+        return sock
+
+    def read_stream(self, command:str):
+        with self.connect(command) as sock:
+            sock.shutdown(socket.SHUT_WR)
+            while True:
+                data = sock.recv(STREAM_CHUNK_SIZE)
+                if not data:
+                    break
+                yield data
+
+    def write_stream(self, command:str, chunks):
+        with self.connect(command) as sock:
+            for chunk in chunks:
+                sock.sendall(chunk)
+            sock.shutdown(socket.SHUT_WR)
+            # wait for the command to finish, it closes the connection when done
+            while sock.recv(STREAM_CHUNK_SIZE):
+                pass
+
+
+def make_transport(spec:str) -> NetworkTransport:
+    """ create a transport from a --network value: adb, tcp, tcp:HOST or tcp:HOST:PORT """
+    parts = spec.split(':')
+    if parts[0] == 'adb' and len(parts) == 1:
+        return AdbTransport()
+    if parts[0] == 'tcp' and len(parts) <= 3:
+        host = parts[1] if len(parts) > 1 and parts[1] else DEFAULT_HOST
+        port = int(parts[2]) if len(parts) > 2 else DEFAULT_PORT
+        return TcpTransport(host, port)
+    raise ValueError(f'Unknown network transport: {spec}, expected: adb, tcp, tcp:HOST or tcp:HOST:PORT')
+
+
+def quote(value:str) -> str:
+    """ quote a value for the device shell """
+    return "'" + value.replace("'", "'\\''") + "'"
+
+
+def read_command(part_name:str) -> str:
+    """ device command which outputs the raw contents of a partition, in the same layout as a USB Burn Mode dump """
+    if part_name == 'bootloader':
+        return f'dd if={DEVICE_DISK} bs={PART_SECTOR_SIZE} skip=1 count={BOOTLOADER_SIZE // PART_SECTOR_SIZE} 2>/dev/null'
+    return f'dd if={quote(device_node(part_name))} bs=1M 2>/dev/null'
+
+
+def partition_size(transport:NetworkTransport, part_name:str) -> int:
+    """ size of a partition on the device, in bytes """
+    if part_name == 'bootloader':
+        return BOOTLOADER_SIZE
+    node = quote(device_node(part_name))
+    output = transport.run(f'blockdev --getsize64 {node} 2>/dev/null || echo $(( $(cat /sys/class/block/$(basename $(readlink -f {node}))/size) * {PART_SECTOR_SIZE} ))')
+    return int(output.strip().splitlines()[-1])
+
+
+def is_mounted(transport:NetworkTransport, part_name:str) -> bool:
+    """ check if a partition is mounted on the device, including as root filesystem
+        compares block device numbers, not names: the root filesystem is mounted as /dev/root, or by its mmcblk0pN name
+            (like root=/dev/mmcblk0p14 from disable_avb2), and /dev/<part_name> is a block node of its own, not a link to either
+    """
+    if part_name == 'bootloader':
+        return False
+    node = quote(device_node(part_name))
+    # stat %t:%T is major:minor in hex; stat %d of / is the kernel encoding of the device number, in decimal
+    output = transport.run(
+        f'node=$(stat -L -c %t:%T {node} 2>/dev/null); '
+        f'if [ -n "$node" ] && [ "$node" != "0:0" ]; then '
+        f'for source in $(cut -d" " -f1 /proc/mounts); do [ "$(stat -L -c %t:%T "$source" 2>/dev/null)" = "$node" ] && echo mounted; done; '
+        f'major=$((0x${{node%:*}})); minor=$((0x${{node#*:}})); '
+        f'[ "$(stat -c %d /)" = "$(( (minor & 0xff) | (major << 8) | ((minor & ~0xff) << 12) ))" ] && echo mounted; '
+        f'fi; true'
+    )
+    return 'mounted' in output
+
+
+def device_md5(transport:NetworkTransport, part_name:str, size:int) -> str:
+    """ md5 of the first size bytes of a partition, as read on the device """
+    command = read_command(part_name)
+    return transport.run(f'{command} | head -c {size} | md5sum').split()[0]
+
+
+class Progress:
+    """ prints progress of a stream, at most once per second """
+    def __init__(self, label:str, total:int) -> None:
+        self.label = label
+        self.total = total
+        self.start_time = time.time()
+        self.last_print = 0
+
+    def update(self, done:int, wire:int, force:bool=False):
+        """ done: bytes of partition data so far, wire: compressed bytes so far """
+        now = time.time()
+        if not force and now - self.last_print < 1:
+            return
+        self.last_print = now
+        elapsed = max(now - self.start_time, 0.001)
+        progress = round(done / self.total * 100) if self.total else 100
+        print(f'\r{self.label}: {progress}% {round(done / 1024 / 1024)}MB / {round(self.total / 1024 / 1024)}MB, speed: {round(done / elapsed / 1024)}KB/s, on the wire: {round(wire / 1024 / 1024, 1)}MB ', end='')
+        sys.stdout.flush()
+        if force:
+            print('')
+
+
+def dump_partition(transport:NetworkTransport, part_name:str, outfile:str):
+    """ dump a partition to a file over the network, verifying it against md5sum on the device """
+    if part_name not in SUPERBIRD_PARTITIONS:
+        raise ValueError(f'Invalid partition name: {part_name}')
+    part_size = partition_size(transport, part_name)
+    mounted = is_mounted(transport, part_name)
+    if mounted:
+        print(f'Warning: {part_name} is mounted on the device, its contents may change while dumping')
+    print(f'dumping partition: "{part_name}" over {transport.name} into file: {outfile}')
+    progress = Progress(f'dumping {part_name}', part_size)
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    checksum = hashlib.md5()
+    (done, wire) = (0, 0)
+    with open(outfile, 'wb') as ofl:
+        for data in transport.read_stream(f'{read_command(part_name)} | gzip -{COMPRESS_LEVEL}'):
+            wire += len(data)
+            raw = decompressor.decompress(data)
+            ofl.write(raw)
+            checksum.update(raw)
+            done += len(raw)
+            progress.update(done, wire)
+        raw = decompressor.flush()
+        ofl.write(raw)
+        checksum.update(raw)
+        done += len(raw)
+    progress.update(done, wire, force=True)
+    if not decompressor.eof or done != part_size:
+        raise NetworkTransportError(f'Incomplete dump of {part_name}: got {done} of {part_size} bytes')
+    expected = device_md5(transport, part_name, done)
+    if expected != checksum.hexdigest():
+        message = f'Checksum mismatch for {part_name}: device {expected}, local {checksum.hexdigest()}'
+        if not mounted:
+            raise NetworkTransportError(message)
+        print(f'Warning: {message} (partition is mounted, and changed while dumping)')
+    else:
+        print(f'verified md5: {expected}')
+
+
+def image_chunks(infile:str):
+    """ yield the raw contents of an image file in chunks, expanding it if it is an Android sparse image """
+    if not is_sparse_image(infile):
+        with open(infile, 'rb') as inf:
+            while True:
+                data = inf.read(STREAM_CHUNK_SIZE)
+                if not data:
+                    return
+                yield data
+    image = SparseImage(infile)
+    with open(infile, 'rb') as inf:
+        for chunk in image.chunks():
+            remaining = chunk.length
+            if chunk.chunk_type == CHUNK_TYPE_RAW:
+                inf.seek(chunk.data_offset)
+            fill_block = (chunk.fill or 0).to_bytes(4, 'little') * (STREAM_CHUNK_SIZE // 4)
+            while remaining:
+                size = min(remaining, STREAM_CHUNK_SIZE)
+                if chunk.chunk_type == CHUNK_TYPE_RAW:
+                    yield inf.read(size)
+                elif chunk.chunk_type == CHUNK_TYPE_FILL:
+                    yield fill_block[:size]
+                else:
+                    # DONT_CARE: over the network, writing zeros costs almost nothing once compressed
+                    yield bytes(size)
+                remaining -= size
+
+
+def image_size(infile:str) -> int:
+    """ size of an image once expanded """
+    if is_sparse_image(infile):
+        return SparseImage(infile).expanded_size
+    return os.path.getsize(infile)
+
+
+def check_restorable(transport:NetworkTransport, part_name:str, infile:str):
+    """ raise NetworkTransportError if a partition cannot be restored over the network from infile """
+    if part_name not in SUPERBIRD_PARTITIONS:
+        raise ValueError(f'Invalid partition name: {part_name}')
+    if part_name in ['bootloader', 'env']:
+        raise NetworkUnsupportedError(f'{part_name} can only be restored in USB Burn Mode')
+    if is_mounted(transport, part_name):
+        raise NetworkUnsupportedError(f'{part_name} is mounted on the device, it can only be restored in USB Burn Mode')
+    part_size = partition_size(transport, part_name)
+    file_size = image_size(infile)
+    if file_size > part_size:
+        raise NetworkTransportError(f'{infile} ({file_size} bytes) is larger than {part_name} ({part_size} bytes)')
+
+
+def restore_partition(transport:NetworkTransport, part_name:str, infile:str, checked:bool=False):
+    """ restore a partition from a file over the network, then verify it with md5sum on the device
+        part_name can be a comma-separated list, like in USB Burn Mode
+    """
+    if ',' in part_name:
+        part_names = [name.strip() for name in part_name.split(',') if name.strip()]
+        for name in part_names:
+            check_restorable(transport, name, infile)
+        for name in part_names:
+            restore_partition(transport, name, infile, checked=True)
+        return
+    if not checked:
+        check_restorable(transport, part_name, infile)
+    file_size = image_size(infile)
+    print(f'restoring partition: "{part_name}" over {transport.name} from file: {infile}')
+    progress = Progress(f'restoring {part_name}', file_size)
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, GZIP_WBITS)
+    checksum = hashlib.md5()
+    state = {'done': 0, 'wire': 0}
+
+    def compressed_chunks():
+        for data in image_chunks(infile):
+            checksum.update(data)
+            state['done'] += len(data)
+            compressed = compressor.compress(data)
+            state['wire'] += len(compressed)
+            progress.update(state['done'], state['wire'])
+            if compressed:
+                yield compressed
+        compressed = compressor.flush()
+        state['wire'] += len(compressed)
+        yield compressed
+
+    transport.write_stream(f'gunzip -c | dd of={quote(device_node(part_name))} bs=1M 2>/dev/null; sync', compressed_chunks())
+    progress.update(state['done'], state['wire'], force=True)
+    # adb cannot report whether the command succeeded, so the checksum is what tells us
+    expected = checksum.hexdigest()
+    actual = device_md5(transport, part_name, file_size)
+    if actual != expected:
+        raise NetworkTransportError(f'Checksum mismatch after restoring {part_name}: device {actual}, local {expected}')
+    print(f'verified md5: {actual}')
+
+
+def dump_device(transport:NetworkTransport, folder_name:str):
+    """ dump all partitions to a folder over the network, in the same layout as USB Burn Mode """
+    # pylint: disable=import-outside-toplevel
+    from superbird_operations import convert_env_dump
+    print(f'dumping entire device over {transport.name} to {folder_name}')
+    shutil.rmtree(folder_name, ignore_errors=True)
+    os.mkdir(folder_name)
+    for part_name, file_name in DUMP_FILENAMES.items():
+        dump_partition(transport, part_name, f'{folder_name}/{file_name}')
+        if part_name == 'env':
+            # same as in USB Burn Mode, env.dump is the whole partition, and env.txt is converted from it
+            convert_env_dump(f'{folder_name}/{file_name}', f'{folder_name}/env.txt')
+    print('device dump complete')
+
+
+def restore_device(transport:NetworkTransport, folder_name:str):
+    """ restore all partitions which can be restored over the network, from a folder
+        partitions which are mounted on the device are skipped, and listed at the end to restore in USB Burn Mode
+        nothing is written unless every other partition can be restored
+    """
+    print(f'restoring device over {transport.name} from dumpfiles in {folder_name}')
+    part_list = [part_name for part_name in RESTORE_PARTITIONS if part_name != 'data' or os.path.isfile(f'{folder_name}/{DUMP_FILENAMES[part_name]}')]
+    for part_name in part_list:
+        if not os.path.isfile(f'{folder_name}/{DUMP_FILENAMES[part_name]}'):
+            print(f'Error: missing expected dump file: {folder_name}/{DUMP_FILENAMES[part_name]}')
+            sys.exit(1)
+    skipped = [part_name for part_name in part_list if is_mounted(transport, part_name)]
+    part_list = [part_name for part_name in part_list if part_name not in skipped]
+    for part_name in part_list:
+        check_restorable(transport, part_name, f'{folder_name}/{DUMP_FILENAMES[part_name]}')
+    for part_name in skipped:
+        print(f'skipping partition: "{part_name}", it is mounted on the device')
+    for part_name in part_list:
+        restore_partition(transport, part_name, f'{folder_name}/{DUMP_FILENAMES[part_name]}', checked=True)
+    print('device restore complete')
+    print(f'{", ".join(["env", "bootloader"] + skipped)} were not restored; they can only be restored in USB Burn Mode:')
+    print(f'  send_full_env {folder_name}/env.txt')
+    print(f'  restore_partition bootloader {folder_name}/bootloader.dump')
+    for part_name in skipped:
+        print(f'  restore_partition {part_name} {folder_name}/{DUMP_FILENAMES[part_name]}')
+
+
+# operations which can run over the network, each takes a NetworkTransport followed by the same arguments as in superbird_operations.OPERATIONS
+NETWORK_OPERATIONS = {
+    'dump_partition': dump_partition,
+    'restore_partition': restore_partition,
+    'dump_device': dump_device,
+    'restore_device': restore_device,
+}
@@ -0,0 +1,407 @@
+#!/usr/bin/env python3
+"""
+Operations that can be performed on a superbird device in USB Burn Mode
+
+Each operation takes a SuperbirdDevice (already in USB Burn Mode) followed by its string arguments,
+    so they can be run directly by superbird_tool.py, or by a session (see superbird_session.py)
+"""
+# pylint: disable=line-too-long,broad-except
+
+import os
+import sys
+import shutil
+import filecmp
+import tempfile
+
+from pathlib import Path
+
+from uboot_env import read_environ
+from superbird_partitions import DUMP_FILENAMES
+
+# this method chosen specifically because it works correctly when bundled using nuitka --onefile
+IMAGES_PATH = Path(os.path.dirname(__file__)).joinpath('images')
+
+
+def convert_env_dump(env_dump:str, env_file:str):
+    """ convert a dumped env partition image into a human-readable text file """
+    print(f'Converting partition dump: {env_dump} to textfile: {env_file}')
+    (environ, _length, _crc) = read_environ(env_dump)
+    write_env_file(environ, env_file)
+
+
+def write_env_file(environ:dict, env_file:str):
+    """ write env dict to a human-readable text file """
+    with open(env_file, 'w', encoding='utf-8') as oef:
+        lines = []
+        for key, value in environ.items():
+            lines.append(f'{key}={value}\n')
+        oef.writelines(lines)
+
+
+def bulkcmd(dev, command:str):
+    """ run a uboot command on the device """
+    dev.bulkcmd(command)
+
+
+def continue_boot(dev):
+    """ continue booting normally """
+    print('Continuing boot...')
+    dev.bulkcmd('mw.b 0x17f89754 1')
+
+
+def boot_adb_kernel(dev, slot:str):
+    """ boot a kernel with adb enabled on chosen slot (A or B)(not persistent) """
+    if slot.lower() not in ['a', 'b']:
+        print('Invalid slot provided, using slot a')
+        slot = 'a'
+    print('Booting adb kernel on slot', slot)
+    if slot.lower() == 'a':
+        file_env = str(IMAGES_PATH.joinpath('env_a.txt'))
+    else:
+        file_env = str(IMAGES_PATH.joinpath('env_b.txt'))
+    file_kernel = str(IMAGES_PATH.joinpath('superbird.kernel.img'))
+    file_initrd = str(IMAGES_PATH.joinpath('superbird.initrd.img'))
+    dev.boot(file_env, file_kernel, file_initrd)
+
+
+def enable_uart_shell(dev):
+    """ enable UART shell """
+    print('Enabling UART shell')
+    dev.bulkcmd('amlmmc env')
+    dev.bulkcmd('setenv initargs init=/sbin/pre-init')
+    dev.bulkcmd(r'setenv initargs ${initargs} ramoops.pstore_en=1')
+    dev.bulkcmd(r'setenv initargs ${initargs} ramoops.record_size=0x8000')
+    dev.bulkcmd(r'setenv initargs ${initargs} ramoops.console_size=0x4000')
+    dev.bulkcmd(r'setenv initargs ${initargs} rootfstype=ext4')
+    dev.bulkcmd(r'setenv initargs ${initargs} console=ttyS0,115200n8')
+    dev.bulkcmd(r'setenv initargs ${initargs} no_console_suspend')
+    dev.bulkcmd(r'setenv initargs ${initargs} earlycon=aml-uart,0xff803000')
+    dev.bulkcmd('env save')
+
+
+def disable_avb2(dev, slot:str):
+    """ disable A/B booting, lock to chosen slot (A or B) """
+    if slot.lower() not in ['a', 'b']:
+        print('Invalid slot provided, using slot a')
+        slot = 'a'
+    print('Disabling A/B booting locking to slot:', slot)
+
+    dev.bulkcmd('amlmmc env')
+    dev.bulkcmd(r'setenv storeargs ${storeargs} setenv avb2 0\;')
+    dev.bulkcmd('setenv initargs init=/sbin/pre-init')
+    dev.bulkcmd(r'setenv initargs "${initargs} ramoops.pstore_en=1"')
+    dev.bulkcmd(r'setenv initargs "${initargs} ramoops.record_size=0x8000"')
+    dev.bulkcmd(r'setenv initargs "${initargs} ramoops.console_size=0x4000"')
+    dev.bulkcmd(r'setenv initargs "${initargs} rootfstype=ext4"')
+    dev.bulkcmd(r'setenv initargs "${initargs} console=ttyS0,115200n8"')
+    dev.bulkcmd(r'setenv initargs "${initargs} no_console_suspend"')
+    dev.bulkcmd(r'setenv initargs "${initargs} earlycon=aml-uart,0xff803000"')
+    if slot.lower() == 'a':
+        dev.bulkcmd(r'setenv initargs "${initargs} ro root=/dev/mmcblk0p14"')
+        dev.bulkcmd('setenv active_slot _a')
+        dev.bulkcmd('setenv boot_part boot_a')
+    else:
+        dev.bulkcmd(r'setenv initargs "${initargs} ro root=/dev/mmcblk0p15"')
+        dev.bulkcmd('setenv active_slot _b')
+        dev.bulkcmd('setenv boot_part boot_b')
+    dev.bulkcmd('env save')
+
+
+def enable_burn_mode(dev):
+    """ enable USB Burn Mode at every boot (when connected to USB host) """
+    print('Enabling USB Burn Mode at every boot (if USB host connected)')
+    dev.bulkcmd('amlmmc env')
+    dev.bulkcmd(r'setenv storeargs "${storeargs} run update\;"')
+    dev.bulkcmd('env save')
+    print('Every time the device boots, if usb is connected it will boot into USB Burn Mode')
+
+
+def enable_burn_mode_button(dev):
+    """ enable USB Burn Mode if preset button 4 is held while booting (when connected to USB host) """
+    print('Enabling USB Burn Mode at boot if preset button 4 is held')
+    dev.bulkcmd('amlmmc env')
+    dev.bulkcmd(r'setenv storeargs "${storeargs} if gpio input GPIOA_3; then run update; fi;"')
+    dev.bulkcmd('env save')
+    print('Every time the device boots, if usb is connected AND preset button 4 is held, it will boot into USB Burn Mode')
+
+
+def disable_burn_mode(dev):
+    """ disable USB Burn Mode at every boot (when connected to USB host) """
+    print('Disabling USB Burn Mode at every boot (if USB host connected)')
+    dev.bulkcmd('amlmmc env')
+    dev.bulkcmd(r'setenv storeargs "setenv bootargs \${initargs} \${fs_type}"')
+    dev.bulkcmd(r'setenv storeargs "${storeargs} reboot_mode_android=\${reboot_mode_android}"')
+    dev.bulkcmd(r'setenv storeargs "${storeargs} logo=\${display_layer},loaded,\${fb_addr}"')
+    dev.bulkcmd(r'setenv storeargs "${storeargs} fb_width=\${fb_width} fb_height=\${fb_height}"')
+    dev.bulkcmd(r'setenv storeargs "${storeargs} vout=\${outputmode},enable"')
+    dev.bulkcmd(r'setenv storeargs "${storeargs} panel_type=\${panel_type}"')
+    dev.bulkcmd(r'setenv storeargs "${storeargs} frac_rate_policy=\${frac_rate_policy}"')
+    dev.bulkcmd(r'setenv storeargs "${storeargs} osd_reverse=\${osd_reverse}"')
+    dev.bulkcmd(r'setenv storeargs "${storeargs} video_reverse=\${video_reverse}"')
+    dev.bulkcmd(r'setenv storeargs "${storeargs} irq_check_en=\${Irq_check_en}"')
+    dev.bulkcmd(r'setenv storeargs "${storeargs} androidboot.selinux=\${EnableSelinux}"')
+    dev.bulkcmd(r'setenv storeargs "${storeargs} androidboot.firstboot=\${firstboot}"')
+    dev.bulkcmd(r'setenv storeargs "${storeargs} jtag=\${jtag} uboot_version=\${gitver}\;"')
+    dev.bulkcmd(r'setenv storeargs "${storeargs} setenv bootargs \${bootargs} androidboot.hardware=amlogic\;"')
+    dev.bulkcmd(r'setenv storeargs "${storeargs} setenv avb2 0\;"')
+    dev.bulkcmd('env save')
+    print('The device will now boot normally, and will NOT boot into USB Burn Mode')
+
+
+def disable_charger_check(dev):
+    """ disable check for valid charger at boot """
+    print('Disabling check for valid charger')
+    # normally, bootcmd=run check_charger
+    #   if it detects OK charger, it then calls: run storeboot
+    #   so we can skip the check by changing bootcmd to just call: run storeboot
+    dev.bulkcmd('amlmmc env')
+    dev.bulkcmd('setenv bootcmd "run storeboot"')
+    dev.bulkcmd('env save')
+    print('The device will not check for valid charger')
+
+
+def enable_charger_check(dev):
+    """ enable check for valid charger at boot """
+    dev.bulkcmd('amlmmc env')
+    dev.bulkcmd('setenv bootcmd "run check_charger"')
+    dev.bulkcmd('env save')
+    print('The device will now check for valid charger, requiring you to press menu button to bypass')
+
+
+def dump_partition(dev, part_name:str, outfile:str):
+    """ dump a partition to a file """
+    dev.dump_partition(part_name, outfile)
+    print(f'dumped partition to {outfile}')
+
+
+def restore_partition(dev, part_name:str, infile:str):
+    """ restore a partition from a dump file
+        part_name can be a comma-separated list (like boot_a,boot_b), to write the same file to each, uploading it only once
+    """
+    part_names = [name.strip() for name in part_name.split(',') if name.strip()]
+    dev.restore_partition(part_names[0], infile, part_names[1:])
+    print(f'restored partition from {infile}')
+
+
+def restore_partitions(dev, folder_name:str, part_names:list):
+    """ restore partitions from their dump files in a folder, in order
+        when the dumps for both slots of a partition are identical, both are written from a single upload
+    """
+    restored = []
+    for part_name in part_names:
+        if part_name in restored:
+            continue
+        infile = f'{folder_name}/{DUMP_FILENAMES[part_name]}'
+        extra_targets = []
+        if part_name.endswith('_a') and f'{part_name[:-2]}_b' in part_names:
+            twin = f'{part_name[:-2]}_b'
+            twin_file = f'{folder_name}/{DUMP_FILENAMES[twin]}'
+            if filecmp.cmp(infile, twin_file, shallow=False):
+                print(f'{infile} and {twin_file} are identical, writing both from one upload')
+                extra_targets.append(twin)
+        dev.restore_partition(part_name, infile, extra_targets)
+        restored += [part_name] + extra_targets
+
+
+def dump_device(dev, folder_name:str):
+    """ dump all partitions to a folder """
+    print(f'dumping entire device to {folder_name}')
+    shutil.rmtree(folder_name, ignore_errors=True)
+    os.mkdir(folder_name)
+    dev.dump_partition('bootloader', f'{folder_name}/bootloader.dump')
+    # env.dump is the whole partition, so it can be restored, patched or assembled like any other dump
+    dev.dump_partition('env', f'{folder_name}/env.dump')
+    # convert dumped env to txt version, for ease of access,
+    #   and so it is present when restoring later
+    convert_env_dump(f'{folder_name}/env.dump', f'{folder_name}/env.txt')
+    dev.dump_partition('fip_a', f'{folder_name}/fip_a.dump')
+    dev.dump_partition('fip_b', f'{folder_name}/fip_b.dump')
+    dev.dump_partition('logo', f'{folder_name}/logo.dump')
+    dev.dump_partition('dtbo_a', f'{folder_name}/dtbo_a.dump')
+    dev.dump_partition('dtbo_b', f'{folder_name}/dtbo_b.dump')
+    dev.dump_partition('vbmeta_a', f'{folder_name}/vbmeta_a.dump')
+    dev.dump_partition('vbmeta_b', f'{folder_name}/vbmeta_b.dump')
+    dev.dump_partition('boot_a', f'{folder_name}/boot_a.dump')
+    dev.dump_partition('boot_b', f'{folder_name}/boot_b.dump')
+    dev.dump_partition('misc', f'{folder_name}/misc.dump')
+    dev.dump_partition('settings', f'{folder_name}/settings.ext4')
+    dev.dump_partition('system_a', f'{folder_name}/system_a.ext2')
+    dev.dump_partition('system_b', f'{folder_name}/system_b.ext2')
+    dev.dump_partition('data', f'{folder_name}/data.ext4')
+    print('device dump complete')
+
+
+def restore_device(dev, folder_name:str):
+    """ restore all partitions from a folder """
+    # NOTE: here we do NOT touch bootloader partition
+    print(f'restoring entire device from dumpfiles in {folder_name}')
+    file_list = [
+        'fip_a.dump', 'fip_b.dump', 'logo.dump', 'dtbo_a.dump', 'dtbo_b.dump', 'vbmeta_a.dump',
+        'vbmeta_b.dump', 'boot_a.dump', 'boot_b.dump', 'misc.dump', 'settings.ext4', 'system_a.ext2', 'system_b.ext2',
+    ]
+    for part_name in file_list:
+        if not os.path.isfile(f'{folder_name}/{part_name}'):
+            print(f'Error: missing expected dump file: {folder_name}/{part_name}')
+            sys.exit(1)
+    # we use the .txt instead of .dump because sometimes the partition size does not line up perfectly
+    #   also probably the safer way to interact with env partition
+    #   if txt version does not exist, we create it for you
+    if not os.path.isfile(f'{folder_name}/env.txt'):
+        if not os.path.isfile(f'{folder_name}/env.dump'):
+            print(f'Error: missing expected dump file: {folder_name}/env.dump')
+            sys.exit(1)
+        convert_env_dump(f'{folder_name}/env.dump', f'{folder_name}/env.txt')
+    print('Wiping env partition')
+    dev.bulkcmd('amlmmc env')
+    dev.bulkcmd('amlmmc erase env')
+    dev.send_env_file(f'{folder_name}/env.txt')
+    dev.bulkcmd('env save')
+    restore_partitions(dev, folder_name, [
+        'fip_a', 'fip_b', 'logo', 'dtbo_a', 'dtbo_b', 'vbmeta_a', 'vbmeta_b',
+        'boot_a', 'boot_b', 'misc', 'settings', 'system_a', 'system_b',
+    ])
+    # handle data partition last
+    if not os.path.exists(f'{folder_name}/data.ext4'):
+        print(f'did not find {folder_name}/data.ext4, erasing data partition instead')
+        dev.bulkcmd('amlmmc erase data')
+    else:
+        try:
+            # test if data.ext4 is actually all zeros (dumped a wiped filesystem)
+            #   A true stock image has that partition erased, and it gets formatted at first boot
+            #   if this dump is from stock, then we can save time by just erasing that partition
+            test_chunk = None
+            with open(f'{folder_name}/data.ext4', 'rb') as daf:
+                # read the first 1024KB
+                test_chunk = daf.read(1024 * 1024)
+            try:
+                decoded_chunk = test_chunk.decode('ascii').strip('\x00')
+            except Exception:
+                # since it is not really ascii, decoding will only work if all the
+                # bytes are within the appropriate range for ascii
+                # however, if it fails to decode, then it is definitely NOT all zeroed out
+                decoded_chunk = '42' # just needs to not be empty
+            if decoded_chunk == '':
+                print(f'The first 1MB of {folder_name}/data.ext4 are null, erasing data partition instead')
+                dev.bulkcmd('amlmmc erase data')
+            else:
+                dev.restore_partition('data', f'{folder_name}/data.ext4')
+        except:
+            print('Error restoring data.ext4, erasing data partition instead')
+            dev.bulkcmd('amlmmc erase data')
+    # always do bootloader last
+    dev.restore_partition('bootloader', f'{folder_name}/bootloader.dump')
+    dev.bulkcmd('reset')
+    print('device restore complete')
+
+
+def restore_stock_env(dev):
+    """ wipe env, then restore default env values from stock_env.txt """
+    env_file = 'stock_env.txt'
+    print('Restoring env by first wiping env, then importing stock_env.txt')
+    dev.bulkcmd('amlmmc env')
+    dev.bulkcmd('amlmmc erase env')
+    dev.send_env_file(env_file)
+    dev.bulkcmd('env save')
+
+
+def send_env(dev, env_file:str):
+    """ import contents of given env.txt file (without wiping) """
+    # Do not wipe env partition first, just import values from given file
+    print(f'Importing the contents of {env_file}')
+    dev.bulkcmd('amlmmc env')
+    dev.send_env_file(env_file)
+    dev.bulkcmd('env save')
+
+
+def send_full_env(dev, env_file:str):
+    """ wipe env, then import contents of given env.txt file """
+    # wipe the env partition, then import from given file
+    print('Wiping env partition')
+    dev.bulkcmd('amlmmc env')
+    dev.bulkcmd('amlmmc erase env')
+    print(f'Importing the contents of {env_file}')
+    dev.send_env_file(env_file)
+    dev.bulkcmd('env save')
+
+
+def get_env(dev, env_file:str):
+    """ dump device env partition, and convert it to env.txt format
+        the parsed env is cached on the device object, until something changes it
+    """
+    print(f'Getting current env and writing to text file: {env_file}')
+    if dev.env_cache is None:
+        with tempfile.NamedTemporaryFile() as temp_file:
+            dev.dump_env(temp_file.name)
+            (environ, _length, _crc) = read_environ(temp_file.name)
+        dev.env_cache = environ
+    else:
+        print('Using env already read during this session')
+    write_env_file(dev.env_cache, env_file)
+
+
+def benchmark_link(dev):
+    """ measure USB transfer speed with different settings, and save the best settings """
+    # pylint: disable=import-outside-toplevel
+    from superbird_benchmark import benchmark_link as run_benchmark
+    run_benchmark(dev)
+
+
+def clone_slot(dev, source:str, target:str):
+    """ copy every partition of one slot (A or B) to the other, entirely on the device """
+    (source, target) = (source.lower(), target.lower())
+    if source not in ['a', 'b'] or target not in ['a', 'b'] or source == target:
+        print(f'Invalid slots: {source} {target}, need to clone A to B, or B to A')
+        sys.exit(1)
+    slot_partitions = [part_name[:-2] for part_name in dev.PARTITIONS if part_name.endswith('_a')]
+    print(f'Cloning slot {source.upper()} to slot {target.upper()}: {", ".join(slot_partitions)}')
+    if not dev.partition_table_loaded:
+        dev.bulkcmd('amlmmc part 1')
+        dev.partition_table_loaded = True
+    try:
+        for part_name in slot_partitions:
+            dev.clone_partition(f'{part_name}_{source}', f'{part_name}_{target}')
+    except Exception as ex:
+        print(f'Error while cloning slot {source.upper()} to slot {target.upper()}: {ex}')
+        sys.exit(1)
+    print(f'Slot {target.upper()} is now a copy of slot {source.upper()}')
+
+
+def apply_patch(dev, patch_file:str):
+    """ check that the device matches the base of a patch bundle, then write only the changed chunks """
+    # pylint: disable=import-outside-toplevel
+    from superbird_patch import apply_patch as run_apply_patch
+    run_apply_patch(dev, patch_file)
+
+
+def fingerprint(dev, catalog_file:str):
+    """ identify which catalogued firmware the device is running, without dumping it """
+    # pylint: disable=import-outside-toplevel
+    from superbird_fingerprint import fingerprint as run_fingerprint
+    run_fingerprint(dev, catalog_file)
+
+
+# operations which need the device in USB Burn Mode, by command-line option name
+OPERATIONS = {
+    'bulkcmd': bulkcmd,
+    'continue_boot': continue_boot,
+    'boot_adb_kernel': boot_adb_kernel,
+    'enable_uart_shell': enable_uart_shell,
+    'disable_avb2': disable_avb2,
+    'enable_burn_mode': enable_burn_mode,
+    'enable_burn_mode_button': enable_burn_mode_button,
+    'disable_burn_mode': disable_burn_mode,
+    'disable_charger_check': disable_charger_check,
+    'enable_charger_check': enable_charger_check,
+    'dump_device': dump_device,
+    'restore_device': restore_device,
+    'dump_partition': dump_partition,
+    'restore_partition': restore_partition,
+    'restore_stock_env': restore_stock_env,
+    'send_env': send_env,
+    'send_full_env': send_full_env,
+    'get_env': get_env,
+    'benchmark_link': benchmark_link,
+    'apply_patch': apply_patch,
+    'clone_slot': clone_slot,
+    'fingerprint': fingerprint,
+}
@@ -6,8 +6,7 @@ Partitions for superbird, extracted from output of: bulkcmd 'amlmmc part 1'
 
 # TODO we have an alternate size for data partition, but is the offset always the same?
 
-# offset is in bytes
-# size is in 512-byte sectors
+# offset and size are in 512-byte sectors
 
 SUPERBIRD_PARTITIONS = {
     'bootloader': {
@@ -85,6 +84,27 @@ SUPERBIRD_PARTITIONS = {
     },
 }
 
+# file names used for each partition in a --dump_device / --restore_device folder
+#   reserved and cache are never dumped
+DUMP_FILENAMES = {
+    'bootloader': 'bootloader.dump',
+    'env': 'env.dump',
+    'fip_a': 'fip_a.dump',
+    'fip_b': 'fip_b.dump',
+    'logo': 'logo.dump',
+    'dtbo_a': 'dtbo_a.dump',
+    'dtbo_b': 'dtbo_b.dump',
+    'vbmeta_a': 'vbmeta_a.dump',
+    'vbmeta_b': 'vbmeta_b.dump',
+    'boot_a': 'boot_a.dump',
+    'boot_b': 'boot_b.dump',
+    'misc': 'misc.dump',
+    'settings': 'settings.ext4',
+    'system_a': 'system_a.ext2',
+    'system_b': 'system_b.ext2',
+    'data': 'data.ext4',
+}
+
 
 # output of: bulkcmd 'amlmmc part 1'
 
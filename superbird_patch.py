@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Delta patch bundles: move a device from one known image to another, writing only what changed
+
+make_patch compares two --dump_device folders (base and target) chunk by chunk, and writes a bundle (a zip file) containing:
+    manifest.json: for each changed run of chunks: partition, offset, size, crc32 of the base data, crc32 of the target data
+    the target data of each changed run, compressed
+apply_patch checks every base crc32 on the device first (nothing is written unless the device matches the base),
+    then writes only the changed runs, and checks each one against its target crc32
+Checksums are computed on the device with crc32, so the base data never crosses USB
+
+env and bootloader are not part of a patch; if they differ, restore them separately
+"""
+# pylint: disable=line-too-long,broad-except
+
+import os
+import sys
+import json
+import mmap
+import time
+import zipfile
+import binascii
+
+from contextlib import contextmanager
+
+from superbird_partitions import DUMP_FILENAMES
+
+PATCH_VERSION = 1
+PATCH_CHUNK_SIZE = 64 * 1024  # dumps are compared this much at a time
+PATCH_RUN_SIZE = 512 * 1024  # adjacent changed chunks are merged into runs, up to this size (same as SuperbirdDevice.WRITE_CHUNK_SIZE)
+# partitions included in a patch, in the order they are written
+PATCH_PARTITIONS = ['fip_a', 'fip_b', 'logo', 'dtbo_a', 'dtbo_b', 'vbmeta_a', 'vbmeta_b', 'boot_a', 'boot_b', 'misc', 'settings', 'system_a', 'system_b', 'data']
+MANIFEST_NAME = 'manifest.json'
+
+
+@contextmanager
+def mapped_dump(filepath:str):
+    """ memory-map a dump file read-only; yields an empty bytes object for an empty file """
+    with open(filepath, 'rb') as dmf:
+        if os.fstat(dmf.fileno()).st_size == 0:
+            yield b''
+            return
+        with mmap.mmap(dmf.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield mapped
+
+
+def changed_runs(base, target, chunk_size:int=PATCH_CHUNK_SIZE, run_size:int=PATCH_RUN_SIZE):
+    """ compare base and target (bytes-like, such as mmap), yield tuples of (offset, size) for runs of changed chunks
+        chunks beyond the end of base always count as changed
+        each comparison is a single memcmp of two chunks, so this runs at about the speed of reading the files
+    """
+    run_start = None
+    for offset in range(0, len(target), chunk_size):
+        end = min(offset + chunk_size, len(target))
+        changed = end > len(base) or base[offset:end] != target[offset:end]
+        if run_start is not None and (not changed or offset - run_start >= run_size):
+            yield (run_start, offset - run_start)
+            run_start = None
+        if changed and run_start is None:
+            run_start = offset
+    if run_start is not None:
+        yield (run_start, len(target) - run_start)
+
+
+def make_patch(base_folder:str, target_folder:str, patch_file:str):
+    """ compare two --dump_device folders, and write a patch bundle with only the changed chunks """
+    print(f'Comparing base: {base_folder} with target: {target_folder}')
+    start_time = time.time()
+    manifest = {'version': PATCH_VERSION, 'runs': []}
+    (total_size, changed_size) = (0, 0)
+    with zipfile.ZipFile(patch_file, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=6) as zpf:
+        for part_name in PATCH_PARTITIONS:
+            base_file = os.path.join(base_folder, DUMP_FILENAMES[part_name])
+            target_file = os.path.join(target_folder, DUMP_FILENAMES[part_name])
+            if not os.path.isfile(target_file):
+                print(f'  {part_name}: not in target, skipping')
+                continue
+            if not os.path.isfile(base_file):
+                print(f'Error: missing base dump file: {base_file}')
+                sys.exit(1)
+            part_changed = 0
+            with mapped_dump(base_file) as base, mapped_dump(target_file) as target:
+                if len(base) != len(target):
+                    print(f'  {part_name}: base is {len(base)} bytes, target is {len(target)} bytes')
+                for (offset, size) in changed_runs(base, target):
+                    data = target[offset:offset + size]
+                    base_data = base[offset:offset + size]
+                    member = f'{part_name}/{hex(offset)}.bin'
+                    manifest['runs'].append({
+                        'partition': part_name,
+                        'offset': offset,
+                        'size': size,
+                        # runs extending past the end of base cannot be checked
+                        'base_crc': binascii.crc32(base_data) & 0xffffffff if len(base_data) == size else None,
+                        'target_crc': binascii.crc32(data) & 0xffffffff,
+                        'data': member,
+                    })
+                    zpf.writestr(member, data)
+                    part_changed += size
+                total_size += len(target)
+            changed_size += part_changed
+            print(f'  {part_name}: {round(part_changed / 1024 / 1024, 2)}MB changed')
+        for part_name in ['bootloader', 'env']:
+            base_file = os.path.join(base_folder, DUMP_FILENAMES[part_name])
+            target_file = os.path.join(target_folder, DUMP_FILENAMES[part_name])
+            if os.path.isfile(base_file) and os.path.isfile(target_file):
+                with mapped_dump(base_file) as base, mapped_dump(target_file) as target:
+                    if base[:] != target[:]:
+                        print(f'  {part_name}: differs, but is not included in patches; restore it separately')
+        zpf.writestr(MANIFEST_NAME, json.dumps(manifest, indent=1))
+    print(f'Wrote patch: {patch_file} ({round(os.path.getsize(patch_file) / 1024 / 1024, 2)}MB), {len(manifest["runs"])} runs, {round(changed_size / 1024 / 1024, 2)}MB of {round(total_size / 1024 / 1024, 2)}MB changed, took: {round(time.time() - start_time, 2)}s')
+
+
+def read_manifest(zpf:zipfile.ZipFile) -> dict:
+    """ read and validate the manifest of a patch bundle """
+    manifest = json.loads(zpf.read(MANIFEST_NAME))
+    if manifest.get('version') != PATCH_VERSION:
+        raise ValueError(f'Unsupported patch version: {manifest.get("version")}')
+    return manifest
+
+
+def apply_patch(dev, patch_file:str):
+    """ check that the device matches the base of a patch bundle, then write only the changed chunks """
+    print(f'Applying patch: {patch_file}')
+    with zipfile.ZipFile(patch_file, 'r') as zpf:
+        manifest = read_manifest(zpf)
+        runs = manifest['runs']
+        if not dev.partition_table_loaded:
+            dev.bulkcmd('amlmmc part 1')
+            dev.partition_table_loaded = True
+        for part_name in sorted(set(run['partition'] for run in runs)):
+            (part_size, _part_offset) = dev.validate_partition_size(part_name)
+            if part_size is None:
+                print(f'Error: failed to validate partition: {part_name}')
+                sys.exit(1)
+            end = max(run['offset'] + run['size'] for run in runs if run['partition'] == part_name)
+            if end > part_size:
+                print(f'Error: patch writes up to {end} bytes into {part_name}, but it is only {part_size} bytes')
+                sys.exit(1)
+        print(f'Checking {len(runs)} runs against base checksums')
+        mismatched = []
+        for run in runs:
+            if run['base_crc'] is None:
+                continue
+            if not dev.retry(f'checking {run["partition"]} at {hex(run["offset"])}', dev.check_partition_chunk, run['partition'], run['offset'], run['size'], run['base_crc']):
+                mismatched.append(run)
+        if mismatched:
+            print(f'Error: device does not match the base of this patch, {len(mismatched)} runs differ:')
+            for part_name in sorted(set(run['partition'] for run in mismatched)):
+                print(f'  {part_name}')
+            print('Nothing was written')
+            sys.exit(1)
+        print('Device matches base, writing changes')
+        start_time = time.time()
+        written = 0
+        for index, run in enumerate(runs):
+            data = zpf.read(run['data'])
+            if len(data) != run['size'] or binascii.crc32(data) & 0xffffffff != run['target_crc']:
+                print(f'Error: patch data for {run["partition"]} at {hex(run["offset"])} is corrupt')
+                sys.exit(1)
+            dev.print(f' [{index + 1}/{len(runs)}] writing {run["partition"]} at {hex(run["offset"])}, {round(run["size"] / 1024)}KB')
+            dev.retry(f'writing {run["partition"]} at {hex(run["offset"])}', dev.write_partition_chunk, run['partition'], data, run['offset'], run['size'])
+            if not dev.retry(f'verifying {run["partition"]} at {hex(run["offset"])}', dev.check_partition_chunk, run['partition'], run['offset'], run['size'], run['target_crc']):
+                print(f'Error: {run["partition"]} at {hex(run["offset"])} does not match the patch after writing')
+                sys.exit(1)
+            written += run['size']
+        dev.env_cache = None
+    print(f'Patch applied: wrote {round(written / 1024 / 1024, 2)}MB, took: {round(time.time() - start_time, 2)}s')
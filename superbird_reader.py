@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Random-access, read-only file-like access to a partition of a device in USB Burn Mode
+
+PartitionReader behaves like a file opened with open(path, 'rb'): read, readinto, seek, tell
+    so host-side tools (parsing an ext4 superblock, the env, the logo header) can fetch a few KB without dumping the whole partition
+
+Reads are done in sector-aligned chunks: amlmmc read into RAM, then read out of RAM (SuperbirdDevice.read_partition_chunk)
+Chunks are kept in an LRU cache, up to a memory limit, and consecutive missing chunks are fetched with a single amlmmc read
+
+As with dumps, position 0 of the bootloader is one sector into the partition, so offsets match a --dump_partition file
+
+    with PartitionReader(dev, 'system_a') as reader:
+        reader.seek(1024)
+        superblock = reader.read(1024)
+    print(reader.hits, reader.misses)
+"""
+# pylint: disable=line-too-long,broad-except
+
+import io
+
+from collections import OrderedDict
+
+CACHE_CHUNK_SIZE = 16 * 1024  # bytes cached per chunk, a multiple of the sector size; small, because every byte read out of RAM costs USB round trips
+CACHE_LIMIT = 8 * 1024 * 1024  # bytes of chunks kept in the cache
+BOOTLOADER_OFFSET = 512  # bootloader dumps start one sector into the partition
+
+
+class PartitionReader(io.RawIOBase):
+    """ seekable, read-only file-like object for one partition
+        hits and misses count chunks found in, and missing from, the cache
+    """
+    def __init__(self, dev, part_name:str, chunk_size:int=CACHE_CHUNK_SIZE, cache_limit:int=CACHE_LIMIT) -> None:
+        super().__init__()
+        if chunk_size <= 0 or chunk_size % dev.PART_SECTOR_SIZE != 0:
+            raise ValueError(f'Chunk size {chunk_size} is not a multiple of sector size {dev.PART_SECTOR_SIZE}')
+        (part_size, _part_offset) = dev.validate_partition_size(part_name)
+        if part_size is None:
+            raise ValueError(f'Failed to validate partition: {part_name}')
+        self.dev = dev
+        self.part_name = part_name
+        self.size = part_size
+        self.base = BOOTLOADER_OFFSET if part_name == 'bootloader' else 0
+        self.chunk_size = chunk_size
+        self.cache_limit = cache_limit
+        self.cache = OrderedDict()  # chunk index: bytes, least recently used first
+        self.cached_size = 0
+        self.position = 0
+        self.hits = 0
+        self.misses = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        self._checkClosed()
+        return self.position
+
+    def seek(self, offset:int, whence:int=io.SEEK_SET) -> int:
+        self._checkClosed()
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f'Invalid whence: {whence}')
+        if position < 0:
+            raise ValueError(f'Negative seek position: {position}')
+        self.position = position
+        return self.position
+
+    def readinto(self, buffer) -> int:
+        self._checkClosed()
+        data = self.read_at(self.position, len(buffer))
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def read_at(self, offset:int, size:int) -> bytes:
+        """ read up to size bytes at offset, without moving the position; short only at the end of the partition """
+        size = max(0, min(size, self.size - offset))
+        if size == 0:
+            return b''
+        first = offset // self.chunk_size
+        last = (offset + size - 1) // self.chunk_size
+        chunks = self.fetch_chunks(first, last)
+        data = b''.join(chunks)
+        start = offset - first * self.chunk_size
+        return data[start:start + size]
+
+    def fetch_chunks(self, first:int, last:int) -> list:
+        """ get chunks first to last (inclusive), from the cache or from the device
+            runs of missing chunks are read from the device in one step, up to the device READ_CHUNK_SIZE
+        """
+        chunks = {}
+        missing = []
+        for index in range(first, last + 1):
+            if index in self.cache:
+                self.cache.move_to_end(index)
+                chunks[index] = self.cache[index]
+                self.hits += 1
+            else:
+                missing.append(index)
+                self.misses += 1
+        run = []
+        for index in missing:
+            if run and (index != run[-1] + 1 or (len(run) + 1) * self.chunk_size > self.dev.READ_CHUNK_SIZE):
+                chunks.update(self.read_run(run))
+                run = []
+            run.append(index)
+        if run:
+            chunks.update(self.read_run(run))
+        return [chunks[index] for index in range(first, last + 1)]
+
+    def read_run(self, run:list) -> dict:
+        """ read consecutive chunks from the device, and add them to the cache; returns dict of chunk index: bytes """
+        offset = run[0] * self.chunk_size
+        size = min(len(run) * self.chunk_size, self.size - offset)
+        data = self.dev.retry(f'reading partition: "{self.part_name}" at offset {hex(offset)}', self.dev.read_partition_chunk, self.part_name, self.base + offset, size)
+        chunks = {}
+        for position, index in enumerate(run):
+            chunks[index] = data[position * self.chunk_size:(position + 1) * self.chunk_size]
+            self.add_to_cache(index, chunks[index])
+        return chunks
+
+    def add_to_cache(self, index:int, chunk:bytes):
+        """ add a chunk to the cache, evicting the least recently used chunks to stay within cache_limit """
+        self.cache[index] = chunk
+        self.cached_size += len(chunk)
+        while self.cached_size > self.cache_limit and self.cache:
+            (_index, evicted) = self.cache.popitem(last=False)
+            self.cached_size -= len(evicted)
+
+    def invalidate(self, offset:int, size:int):
+        """ drop cached chunks overlapping a range, such as after it was written """
+        for index in range(offset // self.chunk_size, (offset + size - 1) // self.chunk_size + 1):
+            if index in self.cache:
+                self.cached_size -= len(self.cache.pop(index))
+
+    def clear_cache(self):
+        """ drop all cached chunks, such as after the partition was written """
+        self.cache.clear()
+        self.cached_size = 0
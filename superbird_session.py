@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Long-running device session, with a local control socket
+
+A session holds one open SuperbirdDevice in USB Burn Mode, and runs operations (see superbird_operations.py)
+    sent to it over a Unix socket, so setup (USB enumeration, entering USB Burn Mode, reading the partition table)
+    only happens once, and cached state (validated partition sizes, env) is reused between operations
+When a session is running, superbird_tool.py acts as a thin client and sends operations to it
+
+Protocol: one JSON object per line
+    client sends: {"operation": name, "args": [str, ...], "cwd": str, "options": {name: value, ...}}
+        options (see SESSION_OPTIONS) override device settings for this operation only
+    session replies with any number of: {"output": str}
+    and finally: {"status": int}
+"""
+# pylint: disable=line-too-long,broad-except
+
+import os
+import sys
+import json
+import socket
+import tempfile
+import traceback
+
+from contextlib import redirect_stdout
+
+from superbird_operations import OPERATIONS
+
+# can be overridden with env var SUPERBIRD_SESSION
+SESSION_SOCKET = os.environ.get('SUPERBIRD_SESSION', os.path.join(tempfile.gettempdir(), 'superbird_tool.sock'))
+END_SESSION = 'end_session'  # operation name that stops the session
+# options a client can set for one operation: the SuperbirdDevice setting each one overrides
+SESSION_OPTIONS = {
+    'retries': 'RETRY_BUDGET',
+    'async_depth': 'ASYNC_DEPTH',
+    'compress': 'COMPRESS_CHUNKS',
+}
+
+
+class SocketWriter:
+    """ file-like object which forwards everything written to it, to a client socket as output messages """
+    def __init__(self, stream) -> None:
+        self.stream = stream
+
+    def write(self, text:str) -> int:
+        """ send text to client """
+        if text:
+            send_message(self.stream, {'output': text})
+        return len(text)
+
+    def flush(self):
+        """ flush the socket stream """
+        self.stream.flush()
+
+
+def send_message(stream, message:dict):
+    """ send one message as a line of json """
+    stream.write(json.dumps(message).encode('utf-8') + b'\n')
+    stream.flush()
+
+
+def read_message(stream) -> dict:
+    """ read one message, returns None if connection was closed """
+    line = stream.readline()
+    if not line:
+        return None
+    return json.loads(line.decode('utf-8'))
+
+
+def session_available() -> bool:
+    """ check if a session is running and accepting connections """
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(SESSION_SOCKET):
+        return False
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(SESSION_SOCKET)
+    except OSError:
+        return False
+    return True
+
+
+def request_operation(operation:str, args:list, options:dict=None) -> int:
+    """ send an operation to the running session, print its output as it arrives
+        options (see SESSION_OPTIONS) apply to this operation only
+        returns the exit status of the operation
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(SESSION_SOCKET)
+        stream = client.makefile('rwb')
+        send_message(stream, {'operation': operation, 'args': args, 'cwd': os.getcwd(), 'options': options or {}})
+        while True:
+            message = read_message(stream)
+            if message is None:
+                print('Session closed the connection unexpectedly')
+                return 1
+            if 'output' in message:
+                sys.stdout.write(message['output'])
+                sys.stdout.flush()
+            elif 'status' in message:
+                return message['status']
+
+
+def apply_options(dev, options:dict) -> dict:
+    """ override device settings with options (see SESSION_OPTIONS), returns the previous values, to apply again afterwards
+        unknown options are ignored
+    """
+    previous = {}
+    for option, value in options.items():
+        if option in SESSION_OPTIONS:
+            previous[option] = getattr(dev, SESSION_OPTIONS[option])
+            setattr(dev, SESSION_OPTIONS[option], value)
+    if previous.get('async_depth', dev.ASYNC_DEPTH) != dev.ASYNC_DEPTH:
+        if dev.ASYNC_DEPTH:
+            dev.open_engine()
+        else:
+            dev.close_engine()
+    return previous
+
+
+def run_operation(dev, operation:str, args:list, options:dict=None) -> int:
+    """ run an operation on the session device, with options applied for its duration, returns exit status """
+    if operation not in OPERATIONS:
+        print(f'Unknown operation: {operation}')
+        return 1
+    previous = apply_options(dev, options or {})
+    try:
+        OPERATIONS[operation](dev, *args)
+    except SystemExit as exs:
+        # operations exit the script on fatal errors, but the session should keep going
+        if isinstance(exs.code, int):
+            return exs.code
+        return 0 if exs.code is None else 1
+    except Exception as ex:
+        print(f'Error during {operation}: {ex}')
+        print(traceback.format_exc())
+        return 1
+    finally:
+        apply_options(dev, previous)
+    return 0
+
+
+def run_session(dev):
+    """ serve operations on the given device until interrupted, or asked to end """
+    if not hasattr(socket, 'AF_UNIX'):
+        print('Sessions need Unix socket support, which is not available on this platform')
+        sys.exit(1)
+    if session_available():
+        print(f'A session is already running at: {SESSION_SOCKET}')
+        sys.exit(1)
+    if os.path.exists(SESSION_SOCKET):
+        # left behind by a session that did not exit cleanly
+        os.unlink(SESSION_SOCKET)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    original_cwd = os.getcwd()
+    try:
+        server.bind(SESSION_SOCKET)
+        os.chmod(SESSION_SOCKET, 0o600)  # only the user running the session may send it operations
+        server.listen(1)
+        print(f'Session ready, listening at: {SESSION_SOCKET}')
+        print('  superbird_tool.py will now send operations to this session; press Ctrl-C to end it')
+        while True:
+            connection, _address = server.accept()
+            with connection:
+                stream = connection.makefile('rwb')
+                try:
+                    request = read_message(stream)
+                except ValueError:
+                    continue
+                if request is None:
+                    # just checking if we are available
+                    continue
+                operation = request.get('operation', '')
+                args = request.get('args', [])
+                if operation == END_SESSION:
+                    send_message(stream, {'output': 'Ending session\n'})
+                    send_message(stream, {'status': 0})
+                    break
+                print(f'running: {operation} {" ".join(args)}')
+                # relative paths in arguments are relative to where the client was run
+                os.chdir(request.get('cwd', original_cwd))
+                status = 1
+                try:
+                    with redirect_stdout(SocketWriter(stream)):
+                        status = run_operation(dev, operation, args, request.get('options', {}))
+                    send_message(stream, {'status': status})
+                except OSError as exo:
+                    print(f'Lost connection to client during {operation}: {exo}')
+                finally:
+                    os.chdir(original_cwd)
+                print(f'finished: {operation} status: {status}')
+    except KeyboardInterrupt:
+        print('')
+    finally:
+        server.close()
+        if os.path.exists(SESSION_SOCKET):
+            os.unlink(SESSION_SOCKET)
+        print('Session ended')
@@ -1,328 +1,191 @@
 #!/usr/bin/env python3
 """
 Tool for working with Spotify Car Thing, aka superbird
+
+Each command only imports what it needs: offline commands never load pyamlboot / libusb, and do not need root
+    device modules are imported when a device command actually runs
 """
-# pylint: disable=line-too-long,broad-except
+# pylint: disable=line-too-long,broad-except,import-outside-toplevel
 
 import sys
 import time
 import argparse
 import os
-import shutil
 import platform
-import tempfile
-
-from pathlib import Path
-
-from uboot_env import read_environ
-
-from superbird_device import SuperbirdDevice
-from superbird_device import find_device, check_device_mode, enter_burn_mode
-
-VERSION = '0.1.0'
-
-# this method chosen specifically because it works correctly when bundled using nuitka --onefile
-IMAGES_PATH = Path(os.path.dirname(__file__)).joinpath('images')
-
-
-def convert_env_dump(env_dump:str, env_file:str):
-    """ convert a dumped env partition image into a human-readable text file """
-    print(f'Converting partition dump: {env_dump} to textfile: {env_file}')
-    (environ, _length, _crc) = read_environ(env_dump)
-    with open(env_file, 'w', encoding='utf-8') as oef:
-        lines = []
-        for key, value in environ.items():
-            lines.append(f'{key}={value}\n')
-        oef.writelines(lines)
-
-
-if __name__ == '__main__':
-    print(f'Spotify Car Thing (superbird) toolkit, v{VERSION}, by bishopdynamics')
-    print('     https://github.com/bishopdynamics/superbird-tool')
-    print('')
-    argument_parser = argparse.ArgumentParser(
-        description='Options cannot be combined; do one thing at a time :)'
+import multiprocessing
+
+VERSION = '0.1.1'
+
+# command name: (arguments, help, needs device)
+#   every command can also be given the old way, as an option: --command ARGS
+COMMANDS = {
+    'find_device': ([], 'find superbird device and show its current boot mode', True),
+    'burn_mode': ([], 'enter USB Burn Mode (if currently in USB Mode)', True),
+    'continue_boot': ([], 'continue booting normally (if currently in USB Burn Mode)', True),
+    'bulkcmd': (['COMMAND'], 'run a uboot command on the device', True),
+    'boot_adb_kernel': (['BOOT_SLOT'], 'boot a kernel with adb enabled on chosen slot (A or B)(not persistent)', True),
+    'enable_uart_shell': ([], 'enable UART shell', True),
+    'disable_avb2': (['BOOT_SLOT'], 'disable A/B booting, lock to chosen slot(A or B)', True),
+    'enable_burn_mode': ([], 'enable USB Burn Mode at every boot (when connected to USB host)', True),
+    'enable_burn_mode_button': ([], 'enable USB Burn Mode if preset button 4 is held while booting (when connected to USB host)', True),
+    'disable_burn_mode': ([], 'Disable USB Burn Mode at every boot (when connected to USB host)', True),
+    'disable_charger_check': ([], 'disable check for valid charger at boot', True),
+    'enable_charger_check': ([], 'enable check for valid charger at boot', True),
+    'dump_device': (['OUTPUT_FOLDER'], 'Dump all partitions to a folder', True),
+    'restore_device': (['INPUT_FOLDER'], 'Restore all partitions from a folder', True),
+    'dump_partition': (['PARTITION_NAME', 'OUTPUT_FILE'], 'Dump a partition to a file', True),
+    'restore_partition': (['PARTITION_NAME', 'INPUT_FILE'], 'Restore a partition from a dump file', True),
+    'restore_stock_env': ([], 'wipe env, then restore default env values from stock_env.txt', True),
+    'send_env': (['ENV_TXT'], 'import contents of given env.txt file (without wiping)', True),
+    'send_full_env': (['ENV_TXT'], 'wipe env, then import contents of given env.txt file', True),
+    'convert_env_dump': (['ENV_DUMP', 'OUTPUT_TXT'], 'convert a local dump of env partition into text format', False),
+    'benchmark_link': ([], 'measure USB transfer speed with different settings, and save the best settings for later runs (only writes to RAM)', True),
+    'get_env': (['ENV_TXT'], 'dump device env partition, and convert it to env.txt format', True),
+    'session': ([], 'hold the device open and run operations sent by other invocations of this tool, until Ctrl-C', True),
+    'end_session': ([], 'stop a running session', False),
+    'assemble_image': (['INPUT_FOLDER', 'OUTPUT_IMAGE'], 'assemble a local --dump_device folder into a single sparse raw disk image', False),
+    'split_image': (['INPUT_IMAGE', 'OUTPUT_FOLDER'], 'split a local raw disk image into a folder of partition dumps, for --restore_device', False),
+    'make_patch': (['BASE_FOLDER', 'TARGET_FOLDER', 'PATCH_FILE'], 'compare two local --dump_device folders, and write a patch bundle with only the changed chunks', False),
+    'apply_patch': (['PATCH_FILE'], 'check that the device matches the base of a patch bundle, then write only the changed chunks', True),
+    'clone_slot': (['SOURCE_SLOT', 'TARGET_SLOT'], 'copy every partition of one slot (A or B) to the other, entirely on the device', True),
+    'add_to_catalog': (['CATALOG_FILE', 'INPUT_FOLDER', 'IMAGE_NAME'], 'add a local --dump_device folder to a catalog of known firmware, for fingerprint', False),
+    'fingerprint': (['CATALOG_FILE'], 'identify which catalogued firmware the device is running, without dumping it', True),
+    'serve_nbd': (['PARTITION_NAME', 'SOCKET_PATH'], 'serve a partition read-only as a network block device (NBD) on a local Unix socket, until Ctrl-C', True),
+    'serve_nbd_writable': (['PARTITION_NAME', 'SOCKET_PATH'], 'serve a partition read-write as a network block device (NBD) on a local Unix socket, until Ctrl-C', True),
+}
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """ build argument parser, with a subcommand for each command """
+    parser = argparse.ArgumentParser(
+        description='Commands cannot be combined; do one thing at a time :)'
     )
-    argument_parser.add_argument('--find_device', action='store_true', help='find superbird device and show its current boot mode')
-    argument_parser.add_argument('--burn_mode', action='store_true', help='enter USB Burn Mode (if currently in USB Mode)')
-    argument_parser.add_argument('--continue_boot', action='store_true', help='continue booting normally (if currently in USB Burn Mode)')
-    argument_parser.add_argument('--bulkcmd', action='store', type=str, nargs=1, metavar=('COMMAND'), help='run a uboot command on the device')
-    argument_parser.add_argument('--boot_adb_kernel', action='store', type=str, nargs=1, metavar=('BOOT_SLOT'), help='boot a kernel with adb enabled on chosen slot (A or B)(not persistent)')
-    argument_parser.add_argument('--enable_uart_shell', action='store_true', help='enable UART shell')
-    argument_parser.add_argument('--disable_avb2', action='store', type=str, nargs=1, metavar=('BOOT_SLOT'), help='disable A/B booting, lock to chosen slot(A or B)')
-    argument_parser.add_argument('--enable_burn_mode', action='store_true', help='enable USB Burn Mode at every boot (when connected to USB host)')
-    argument_parser.add_argument('--enable_burn_mode_button', action='store_true', help='enable USB Burn Mode if preset button 4 is held while booting (when connected to USB host)')
-    argument_parser.add_argument('--disable_burn_mode', action='store_true', help='Disable USB Burn Mode at every boot (when connected to USB host)')
-    argument_parser.add_argument('--disable_charger_check', action='store_true', help='disable check for valid charger at boot')
-    argument_parser.add_argument('--enable_charger_check', action='store_true', help='enable check for valid charger at boot')
-    argument_parser.add_argument('--dump_device', action='store', type=str, nargs=1, metavar=('OUTPUT_FOLDER'), help='Dump all partitions to a folder')
-    argument_parser.add_argument('--restore_device', action='store', type=str, nargs=1, metavar=('INPUT_FOLDER'), help='Restore all partitions from a folder')
-    argument_parser.add_argument('--dump_partition', action='store', type=str, nargs=2, metavar=('PARTITION_NAME', 'OUTPUT_FILE'), help='Dump a partition to a file')
-    argument_parser.add_argument('--restore_partition', action='store', type=str, nargs=2, metavar=('PARTITION_NAME', 'INPUT_FILE'), help='Restore a partition from a dump file')
-    argument_parser.add_argument('--restore_stock_env', action='store_true', help='wipe env, then restore default env values from stock_env.txt')
-    argument_parser.add_argument('--send_env', action='store', type=str, nargs=1, metavar=('ENV_TXT'), help='import contents of given env.txt file (without wiping)')
-    argument_parser.add_argument('--send_full_env', action='store', type=str, nargs=1, metavar=('ENV_TXT'), help='wipe env, then import contents of given env.txt file')
-    argument_parser.add_argument('--convert_env_dump', action='store', type=str, nargs=2, metavar=('ENV_DUMP', 'OUTPUT_TXT'), help='convert a local dump of env partition into text format')
-    argument_parser.add_argument('--get_env', action='store', type=str, nargs=1, metavar=('ENV_TXT'), help='dump device env partition, and convert it to env.txt format')
-
-    args = argument_parser.parse_args()
-
-    if len(sys.argv) <= 1:
-        argument_parser.print_help()
-        sys.exit()
+    subparsers = parser.add_subparsers(dest='command', metavar='COMMAND')
+    device_options = argparse.ArgumentParser(add_help=False)
+    device_options.add_argument('--retries', action='store', type=int, metavar=('COUNT'), help='how many times to try a command or chunk when USB errors occur, before giving up')
+    device_options.add_argument('--async_depth', action='store', type=int, metavar=('COUNT'), help='keep this many USB transfers in flight for memory reads and writes (needs python-libusb1), helps most through hubs and VMs')
+    device_options.add_argument('--compress', action='store_true', help='restore_partition / restore_device: pack chunks on the host, and expand them on the device, sending fewer bytes over USB for images with lots of repeated data (like empty space)')
+    device_options.add_argument('--network', action='store', type=str, metavar=('TRANSPORT'), help='dump/restore over the network when the device is booted normally with the USB Gadget: adb, tcp, tcp:HOST or tcp:HOST:PORT (falls back to USB Burn Mode if not reachable)')
+    for name, (arguments, help_text, needs_device) in COMMANDS.items():
+        parents = [device_options] if needs_device else []
+        subparser = subparsers.add_parser(name, help=help_text, description=help_text, parents=parents)
+        for argument in arguments:
+            subparser.add_argument(f'arg_{argument.lower()}', metavar=argument, type=str)
+    return parser
+
+
+def translate_legacy_args(argv:list) -> list:
+    """ translate old-style options (--dump_partition NAME FILE) into a subcommand (dump_partition NAME FILE)
+        the command is moved to the front, everything else keeps its order
+    """
+    for index, token in enumerate(argv):
+        if token.startswith('--') and token[2:] in COMMANDS:
+            return [token[2:]] + argv[:index] + argv[index + 1:]
+    return argv
+
+
+def run_offline(command:str, command_args:list):
+    """ run a command which does not need the device """
+    if command == 'convert_env_dump':
+        from superbird_operations import convert_env_dump
+        convert_env_dump(*command_args)
+    elif command == 'end_session':
+        from superbird_session import END_SESSION, session_available, request_operation
+        if not session_available():
+            print('No session is running')
+            sys.exit(1)
+        sys.exit(request_operation(END_SESSION, []))
+    elif command == 'assemble_image':
+        from superbird_image import assemble_image
+        assemble_image(*command_args)
+    elif command == 'split_image':
+        from superbird_image import split_image
+        split_image(*command_args)
+    elif command == 'make_patch':
+        from superbird_patch import make_patch
+        make_patch(*command_args)
+    elif command == 'add_to_catalog':
+        from superbird_fingerprint import add_to_catalog
+        add_to_catalog(*command_args)
+
+
+def run_network(command:str, command_args:list, transport_spec:str) -> bool:
+    """ run a command over the network, if it supports that and the device is reachable
+        returns False if the command should run in USB Burn Mode instead
+    """
+    from superbird_network import NETWORK_OPERATIONS, NetworkTransportError, NetworkUnsupportedError, make_transport
+    if command not in NETWORK_OPERATIONS:
+        print(f'{command} cannot run over the network, using USB Burn Mode')
+        return False
+    try:
+        transport = make_transport(transport_spec)
+    except ValueError as ex:
+        print(f'Error: {ex}')
+        sys.exit(1)
+    if not transport.available():
+        print(f'Device is not reachable over {transport.name}, falling back to USB Burn Mode')
+        return False
+    start_time = time.time()
+    try:
+        NETWORK_OPERATIONS[command](transport, *command_args)
+    except NetworkUnsupportedError as ex:
+        print(f'{ex}, falling back to USB Burn Mode')
+        return False
+    except (NetworkTransportError, ValueError) as ex:
+        print(f'Error: {ex}')
+        sys.exit(1)
+    print(f'Operation took: {str(time.time() - start_time)}')
+    return True
+
+
+def run_device(command:str, command_args:list, retries:int=None, async_depth:int=None, network:str=None, compress:bool=False):
+    """ run a command which needs the device, or send it to a running session """
+    if network is not None and run_network(command, command_args, network):
+        return
+    from superbird_operations import OPERATIONS
+    from superbird_session import SESSION_OPTIONS
+    # device settings given on the command line, by SESSION_OPTIONS name
+    options = {}
+    if retries is not None:
+        options['retries'] = max(1, retries)
+    if async_depth is not None and async_depth > 1:
+        options['async_depth'] = async_depth
+    if compress:
+        options['compress'] = True
+    if command in OPERATIONS:
+        # if a session is running, it already has the device, so just send it the operation, and the settings to run it with
+        from superbird_session import SESSION_SOCKET, session_available, request_operation
+        if session_available():
+            print(f'Sending {command} to session at: {SESSION_SOCKET}')
+            sys.exit(request_operation(command, command_args, options))
+    elif command in ['serve_nbd', 'serve_nbd_writable']:
+        # the session has the device, and the NBD server would hold it for as long as it runs
+        from superbird_session import SESSION_SOCKET, session_available
+        if session_available():
+            print(f'A session is running at: {SESSION_SOCKET}, and has the device; stop it first with: end_session')
+            sys.exit(1)
 
     if platform.system() == 'Linux':
         if os.geteuid() != 0:
             print('Need to run as root!')
             sys.exit(1)
 
-    # First check options that do not need the device
+    from superbird_device import SuperbirdDevice
+    from superbird_device import find_device, check_device_mode, enter_burn_mode
 
-    if args.find_device:
+    if command == 'find_device':
         find_device()
         sys.exit()
-    elif args.convert_env_dump:
-        ENV_DUMP = args.convert_env_dump[0]
-        ENV_FILE = args.convert_env_dump[1]
-        convert_env_dump(ENV_DUMP, ENV_FILE)
-        sys.exit()
 
-    # Now get the device, and check options that need it
-    START_TIME = time.time()
-    dev = SuperbirdDevice()
+    for option, value in options.items():
+        setattr(SuperbirdDevice, SESSION_OPTIONS[option], value)
 
-    if args.bulkcmd:
-        dev = enter_burn_mode(dev)
-        if dev is not None:
-            BULKCMD_STRING = args.bulkcmd[0]
-            dev.bulkcmd(BULKCMD_STRING)
-    elif args.boot_adb_kernel:
-        dev = enter_burn_mode(dev)
-        if dev is not None:
-            SLOT = args.boot_adb_kernel[0]
-            if SLOT.lower() not in ['a', 'b']:
-                print('Invalid slot provided, using slot a')
-                SLOT = 'a'
-            print('Booting adb kernel on slot', SLOT)
-            if SLOT.lower() == 'a':
-                FILE_ENV = str(IMAGES_PATH.joinpath('env_a.txt'))
-            elif SLOT.lower() == 'b':
-                FILE_ENV = str(IMAGES_PATH.joinpath('env_b.txt'))
-            FILE_KERNEL = str(IMAGES_PATH.joinpath('superbird.kernel.img'))
-            FILE_INITRD = str(IMAGES_PATH.joinpath('superbird.initrd.img'))
-            dev.boot(FILE_ENV, FILE_KERNEL, FILE_INITRD)
-    elif args.enable_uart_shell:
-        dev = enter_burn_mode(dev)
-        if dev is not None:
-            print('Enabling UART shell')
-            dev.bulkcmd('amlmmc env')
-            dev.bulkcmd('setenv initargs init=/sbin/pre-init')
-            dev.bulkcmd(r'setenv initargs ${initargs} ramoops.pstore_en=1')
-            dev.bulkcmd(r'setenv initargs ${initargs} ramoops.record_size=0x8000')
-            dev.bulkcmd(r'setenv initargs ${initargs} ramoops.console_size=0x4000')
-            dev.bulkcmd(r'setenv initargs ${initargs} rootfstype=ext4')
-            dev.bulkcmd(r'setenv initargs ${initargs} console=ttyS0,115200n8')
-            dev.bulkcmd(r'setenv initargs ${initargs} no_console_suspend')
-            dev.bulkcmd(r'setenv initargs ${initargs} earlycon=aml-uart,0xff803000')
-            dev.bulkcmd('env save')
-    elif args.disable_avb2:
-        dev = enter_burn_mode(dev)
-        if dev is not None:
-            SLOT = args.disable_avb2[0]
-            if SLOT.lower() not in ['a', 'b']:
-                print('Invalid slot provided, using slot a')
-                SLOT = 'a'
-            print('Disabling A/B booting locking to slot:', SLOT)
+    # Now get the device, and run the command
+    start_time = time.time()
+    dev = SuperbirdDevice()
 
-            dev.bulkcmd('amlmmc env')
-            dev.bulkcmd(r'setenv storeargs ${storeargs} setenv avb2 0\;')
-            dev.bulkcmd('setenv initargs init=/sbin/pre-init')
-            dev.bulkcmd(r'setenv initargs "${initargs} ramoops.pstore_en=1"')
-            dev.bulkcmd(r'setenv initargs "${initargs} ramoops.record_size=0x8000"')
-            dev.bulkcmd(r'setenv initargs "${initargs} ramoops.console_size=0x4000"')
-            dev.bulkcmd(r'setenv initargs "${initargs} rootfstype=ext4"')
-            dev.bulkcmd(r'setenv initargs "${initargs} console=ttyS0,115200n8"')
-            dev.bulkcmd(r'setenv initargs "${initargs} no_console_suspend"')
-            dev.bulkcmd(r'setenv initargs "${initargs} earlycon=aml-uart,0xff803000"')
-            if SLOT.lower() == 'a':
-                dev.bulkcmd(r'setenv initargs "${initargs} ro root=/dev/mmcblk0p14"')
-                dev.bulkcmd('setenv active_slot _a')
-                dev.bulkcmd('setenv boot_part boot_a')
-            elif SLOT.lower() == 'b':
-                dev.bulkcmd(r'setenv initargs "${initargs} ro root=/dev/mmcblk0p15"')
-                dev.bulkcmd('setenv active_slot _b')
-                dev.bulkcmd('setenv boot_part boot_b')
-            dev.bulkcmd('env save')
-    elif args.enable_burn_mode:
-        dev = enter_burn_mode(dev)
-        if dev is not None:
-            print('Enabling USB Burn Mode at every boot (if USB host connected)')
-            dev.bulkcmd('amlmmc env')
-            dev.bulkcmd(r'setenv storeargs "${storeargs} run update\;"')
-            dev.bulkcmd('env save')
-            print('Every time the device boots, if usb is connected it will boot into USB Burn Mode')
-    elif args.enable_burn_mode_button:
-        dev = enter_burn_mode(dev)
-        if dev is not None:
-            print('Enabling USB Burn Mode at boot if preset button 4 is held')
-            dev.bulkcmd('amlmmc env')
-            dev.bulkcmd(r'setenv storeargs "${storeargs} if gpio input GPIOA_3; then run update; fi;"')
-            dev.bulkcmd('env save')
-            print('Every time the device boots, if usb is connected AND preset button 4 is held, it will boot into USB Burn Mode')
-    elif args.disable_burn_mode:
-        dev = enter_burn_mode(dev)
-        if dev is not None:
-            print('Disabling USB Burn Mode at every boot (if USB host connected)')
-            dev.bulkcmd('amlmmc env')
-            dev.bulkcmd(r'setenv storeargs "setenv bootargs \${initargs} \${fs_type}"')
-            dev.bulkcmd(r'setenv storeargs "${storeargs} reboot_mode_android=\${reboot_mode_android}"')
-            dev.bulkcmd(r'setenv storeargs "${storeargs} logo=\${display_layer},loaded,\${fb_addr}"')
-            dev.bulkcmd(r'setenv storeargs "${storeargs} fb_width=\${fb_width} fb_height=\${fb_height}"')
-            dev.bulkcmd(r'setenv storeargs "${storeargs} vout=\${outputmode},enable"')
-            dev.bulkcmd(r'setenv storeargs "${storeargs} panel_type=\${panel_type}"')
-            dev.bulkcmd(r'setenv storeargs "${storeargs} frac_rate_policy=\${frac_rate_policy}"')
-            dev.bulkcmd(r'setenv storeargs "${storeargs} osd_reverse=\${osd_reverse}"')
-            dev.bulkcmd(r'setenv storeargs "${storeargs} video_reverse=\${video_reverse}"')
-            dev.bulkcmd(r'setenv storeargs "${storeargs} irq_check_en=\${Irq_check_en}"')
-            dev.bulkcmd(r'setenv storeargs "${storeargs} androidboot.selinux=\${EnableSelinux}"')
-            dev.bulkcmd(r'setenv storeargs "${storeargs} androidboot.firstboot=\${firstboot}"')
-            dev.bulkcmd(r'setenv storeargs "${storeargs} jtag=\${jtag} uboot_version=\${gitver}\;"')
-            dev.bulkcmd(r'setenv storeargs "${storeargs} setenv bootargs \${bootargs} androidboot.hardware=amlogic\;"')
-            dev.bulkcmd(r'setenv storeargs "${storeargs} setenv avb2 0\;"')
-            dev.bulkcmd('env save')
-            print('The device will now boot normally, and will NOT boot into USB Burn Mode')
-    elif args.dump_partition:
-        dev = enter_burn_mode(dev)
-        if dev is not None:
-            PARTITION_NAME = args.dump_partition[0]
-            OUTFILE = args.dump_partition[1]
-            dev.dump_partition(PARTITION_NAME, OUTFILE)
-            print(f'dumped partition to {OUTFILE}')
-    elif args.restore_partition:
-        dev = enter_burn_mode(dev)
-        if dev is not None:
-            PARTITION_NAME = args.restore_partition[0]
-            INFILE = args.restore_partition[1]
-            dev.restore_partition(PARTITION_NAME, INFILE)
-            print(f'restored partition from {INFILE}')
-    elif args.dump_device:
-        dev = enter_burn_mode(dev)
-        if dev is not None:
-            FOLDER_NAME = args.dump_device[0]
-            print(f'dumping entire device to {FOLDER_NAME}')
-            shutil.rmtree(FOLDER_NAME, ignore_errors=True)
-            os.mkdir(FOLDER_NAME)
-            dev.dump_partition('bootloader', f'{FOLDER_NAME}/bootloader.dump')
-            dev.dump_partition('env', f'{FOLDER_NAME}/env.dump')
-            # convert dumped env to txt version, for ease of access,
-            #   and so it is present when restoring later
-            convert_env_dump(f'{FOLDER_NAME}/env.dump', f'{FOLDER_NAME}/env.txt')
-            dev.dump_partition('fip_a', f'{FOLDER_NAME}/fip_a.dump')
-            dev.dump_partition('fip_b', f'{FOLDER_NAME}/fip_b.dump')
-            dev.dump_partition('logo', f'{FOLDER_NAME}/logo.dump')
-            dev.dump_partition('dtbo_a', f'{FOLDER_NAME}/dtbo_a.dump')
-            dev.dump_partition('dtbo_b', f'{FOLDER_NAME}/dtbo_b.dump')
-            dev.dump_partition('vbmeta_a', f'{FOLDER_NAME}/vbmeta_a.dump')
-            dev.dump_partition('vbmeta_b', f'{FOLDER_NAME}/vbmeta_b.dump')
-            dev.dump_partition('boot_a', f'{FOLDER_NAME}/boot_a.dump')
-            dev.dump_partition('boot_b', f'{FOLDER_NAME}/boot_b.dump')
-            dev.dump_partition('misc', f'{FOLDER_NAME}/misc.dump')
-            dev.dump_partition('settings', f'{FOLDER_NAME}/settings.ext4')
-            dev.dump_partition('system_a', f'{FOLDER_NAME}/system_a.ext2')
-            dev.dump_partition('system_b', f'{FOLDER_NAME}/system_b.ext2')
-            dev.dump_partition('data', f'{FOLDER_NAME}/data.ext4')
-            print('device dump complete')
-    elif args.restore_device:
-        dev = enter_burn_mode(dev)
-        if dev is not None:
-            # NOTE: here we do NOT touch bootloader partition
-            FOLDER_NAME = args.restore_device[0]
-            print(f'restoring entire device from dumpfiles in {FOLDER_NAME}')
-            FILE_LIST = [
-                'fip_a.dump', 'fip_b.dump', 'logo.dump', 'dtbo_a.dump', 'dtbo_b.dump', 'vbmeta_a.dump',
-                'vbmeta_b.dump', 'boot_a.dump', 'boot_b.dump', 'misc.dump', 'settings.ext4', 'system_a.ext2', 'system_b.ext2',
-            ]
-            for part_name in FILE_LIST:
-                if not os.path.isfile(f'{FOLDER_NAME}/{part_name}'):
-                    print(f'Error: missing expected dump file: {FOLDER_NAME}/{part_name}')
-                    sys.exit(1)
-            # we use the .txt instead of .dump because sometimes the partition size does not line up perfectly
-            #   also probably the safer way to interact with env partition
-            #   if txt version does not exist, we create it for you
-            if not os.path.isfile(f'{FOLDER_NAME}/env.txt'):
-                if not os.path.isfile(f'{FOLDER_NAME}/env.dump'):
-                    print(f'Error: missing expected dump file: {FOLDER_NAME}/env.dump')
-                    sys.exit(1)
-                convert_env_dump(f'{FOLDER_NAME}/env.dump', f'{FOLDER_NAME}/env.txt')
-            print('Wiping env partition')
-            dev.bulkcmd('amlmmc env')
-            dev.bulkcmd('amlmmc erase env')
-            dev.send_env_file(f'{FOLDER_NAME}/env.txt')
-            dev.bulkcmd('env save')
-            dev.restore_partition('fip_a', f'{FOLDER_NAME}/fip_a.dump')
-            dev.restore_partition('fip_b', f'{FOLDER_NAME}/fip_b.dump')
-            dev.restore_partition('logo', f'{FOLDER_NAME}/logo.dump')
-            dev.restore_partition('dtbo_a', f'{FOLDER_NAME}/dtbo_a.dump')
-            dev.restore_partition('dtbo_b', f'{FOLDER_NAME}/dtbo_b.dump')
-            dev.restore_partition('vbmeta_a', f'{FOLDER_NAME}/vbmeta_a.dump')
-            dev.restore_partition('vbmeta_b', f'{FOLDER_NAME}/vbmeta_b.dump')
-            dev.restore_partition('boot_a', f'{FOLDER_NAME}/boot_a.dump')
-            dev.restore_partition('boot_b', f'{FOLDER_NAME}/boot_b.dump')
-            dev.restore_partition('misc', f'{FOLDER_NAME}/misc.dump')
-            dev.restore_partition('settings', f'{FOLDER_NAME}/settings.ext4')
-            dev.restore_partition('system_a', f'{FOLDER_NAME}/system_a.ext2')
-            dev.restore_partition('system_b', f'{FOLDER_NAME}/system_b.ext2')
-            # handle data partition last
-            if not os.path.exists(f'{FOLDER_NAME}/data.ext4'):
-                print(f'did not find {FOLDER_NAME}/data.ext4, erasing data partition instead')
-                dev.bulkcmd('amlmmc erase data')
-            else:
-                try:
-                    # test if data.ext4 is actually all zeros (dumped a wiped filesystem)
-                    #   A true stock image has that partition erased, and it gets formatted at first boot
-                    #   if this dump is from stock, then we can save time by just erasing that partition
-                    TEST_CHUNK = None
-                    with open(f'{FOLDER_NAME}/data.ext4', 'rb') as daf:
-                        # read the first 1024KB
-                        TEST_CHUNK = daf.read(1024 * 1024)
-                    try:
-                        DECODED_CHUNK = TEST_CHUNK.decode('ascii').strip('\x00')
-                    except Exception:
-                        # since it is not really ascii, decoding will only work if all the
-                        # bytes are within the appropriate range for ascii
-                        # however, if it fails to decode, then it is definitely NOT all zeroed out
-                        DECODED_CHUNK = '42' # just needs to not be empty
-                    if DECODED_CHUNK == '':
-                        print(f'The first 1MB of {FOLDER_NAME}/data.ext4 are null, erasing data partition instead')
-                        dev.bulkcmd('amlmmc erase data')
-                    else:
-                        dev.restore_partition('data', f'{FOLDER_NAME}/data.ext4')
-                except:
-                    print(f'Error restoring data.ext4, erasing data partition instead')
-                    dev.bulkcmd('amlmmc erase data')
-            # always do bootloader last
-            dev.restore_partition('bootloader', f'{FOLDER_NAME}/bootloader.dump')
-            dev.bulkcmd('reset')
-            print('device restore complete')
-    elif args.disable_charger_check:
-        dev = enter_burn_mode(dev)
-        if dev is not None:
-            print('Disabling check for valid charger')
-            # normally, bootcmd=run check_charger
-            #   if it detects OK charger, it then calls: run storeboot
-            #   so we can skip the check by changing bootcmd to just call: run storeboot
-            dev.bulkcmd('amlmmc env')
-            dev.bulkcmd('setenv bootcmd "run storeboot"')
-            dev.bulkcmd('env save')
-            print('The device will not check for valid charger')
-    elif args.enable_charger_check:
-        dev = enter_burn_mode(dev)
-        if dev is not None:
-            dev.bulkcmd('amlmmc env')
-            dev.bulkcmd('setenv bootcmd "run check_charger"')
-            dev.bulkcmd('env save')
-            print('The device will now check for valid charger, requiring you to press menu button to bypass')
-    elif args.burn_mode:
+    if command == 'burn_mode':
+        from superbird_operations import IMAGES_PATH
         if check_device_mode('usb'):
             print('Entering USB Burn Mode')
             dev.bl2_boot(str(IMAGES_PATH.joinpath('superbird.bl2.encrypted.bin')), str(IMAGES_PATH.joinpath('superbird.bootloader.img')))
@@ -332,50 +195,46 @@ if __name__ == '__main__':
                 print('Device is now in USB Burn Mode')
             else:
                 print('Failed to enter USB Burn Mode!')
-    elif args.continue_boot:
+    elif command == 'continue_boot':
         if check_device_mode('usb-burn'):
-            print('Continuing boot...')
-            dev.bulkcmd('mw.b 0x17f89754 1')
-    elif args.restore_stock_env:
-        ENV_FILE = 'stock_env.txt'
-        dev = enter_burn_mode(dev)
-        if dev is not None:
-            print('Restoring env by first wiping env, then importing stock_env.txt')
-            dev.bulkcmd('amlmmc env')
-            dev.bulkcmd('amlmmc erase env')
-            dev.send_env_file(ENV_FILE)
-            dev.bulkcmd('env save')
-    elif args.send_env:
-        ENV_FILE = args.send_env[0]
+            OPERATIONS['continue_boot'](dev)
+    elif command == 'session':
+        from superbird_session import run_session
         dev = enter_burn_mode(dev)
         if dev is not None:
-            # Do not wipe env partition first, just import values from given file
-            print(f'Importing the contents of {ENV_FILE}')
-            dev.bulkcmd('amlmmc env')
-            dev.send_env_file(ENV_FILE)
-            dev.bulkcmd('env save')
-    elif args.send_full_env:
-        ENV_FILE = args.send_full_env[0]
+            run_session(dev)
+    elif command in ['serve_nbd', 'serve_nbd_writable']:
+        from superbird_nbd import serve_nbd
         dev = enter_burn_mode(dev)
         if dev is not None:
-            # wipe the env partition, then import from given file
-            print('Wiping env partition')
-            dev.bulkcmd('amlmmc env')
-            dev.bulkcmd('amlmmc erase env')
-            print(f'Importing the contents of {ENV_FILE}')
-            dev.send_env_file(ENV_FILE)
-            dev.bulkcmd('env save')
-    elif args.get_env:
-        ENV_FILE = args.get_env[0]
+            serve_nbd(dev, *command_args, writable=command == 'serve_nbd_writable')
+    else:
         dev = enter_burn_mode(dev)
         if dev is not None:
-            with tempfile.NamedTemporaryFile() as TEMP_FILE:
-                print(f'Getting current env and writing to text file: {ENV_FILE}')
-                dev.dump_partition('env', TEMP_FILE.name)
-                convert_env_dump(TEMP_FILE.name, ENV_FILE)
+            OPERATIONS[command](dev, *command_args)
+
+    end_time = time.time()
+    time_delta = end_time - start_time
+    print(f'Operation took: {str(time_delta)}')
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()  # restore with --compress uses a process pool, which needs this in standalone binaries
+    print(f'Spotify Car Thing (superbird) toolkit, v{VERSION}, by bishopdynamics')
+    print('     https://github.com/bishopdynamics/superbird-tool')
+    print('')
+    argument_parser = build_parser()
+    args = argument_parser.parse_args(translate_legacy_args(sys.argv[1:]))
+
+    if args.command is None:
+        argument_parser.print_help()
+        sys.exit()
 
-    END_TIME = time.time()
-    TIME_DELTA = END_TIME - START_TIME
-    print(f'Operation took: {str(TIME_DELTA)}')
+    (COMMAND_ARGS, _HELP, NEEDS_DEVICE) = COMMANDS[args.command]
+    ARG_VALUES = [getattr(args, f'arg_{argument.lower()}') for argument in COMMAND_ARGS]
+    if NEEDS_DEVICE:
+        run_device(args.command, ARG_VALUES, args.retries, args.async_depth, args.network, args.compress)
+    else:
+        run_offline(args.command, ARG_VALUES)
 
     sys.exit()
@@ -0,0 +1,9 @@
+"""
+Tests run against stand-ins for the device, so no hardware is needed
+"""
+import os
+import sys
+
+# modules live in the repository root, next to superbird_tool.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
@@ -0,0 +1,105 @@
+"""
+Stand-in for the shell agent of superbird_network (nc -l -e sh), run on the host, with the device's partitions as files
+
+Like the real agent, each connection reads one command line, and runs it with sh, its stdin and stdout connected to the socket
+Paths under /dev and /proc in commands are moved into a folder, so partitions, /proc/mounts and /proc/cmdline are files the test controls
+blockdev is replaced with a shell function giving the size of a file
+Files have no device numbers, so stat is wrapped to give each partition one (major:minor, from write_node),
+    and the device of / is set with set_root; everything else stat is asked passes through
+"""
+import os
+import re
+import socket
+import subprocess
+import threading
+
+BLOCKDEV = 'blockdev() { command stat -L -c %s "$2"; }; '
+STAT = (
+    'stat() { '
+    'if [ "$1 $2 $3" = "-L -c %t:%T" ]; then number=$(grep -F "$4 " "$DEVICE_NUMBERS" | cut -d" " -f2); echo "${number:-0:0}"; '
+    'elif [ "$1 $2 $3" = "-c %d /" ]; then cat "$ROOT_DEVICE"; '
+    'else command stat "$@"; fi; }; '
+)
+MMC_MAJOR = 179
+COMMAND_TOOLS = ['sh', 'dd', 'gzip', 'gunzip', 'md5sum', 'head', 'stat', 'cut', 'grep', 'cat', 'sync']
+
+
+class FakeAgent:
+    """ serves the agent on localhost, in a thread; commands holds each command run, before paths were moved """
+    def __init__(self, root:str) -> None:
+        self.root = root
+        for folder in ['dev', 'proc']:
+            os.makedirs(f'{root}/{folder}', exist_ok=True)
+        if not os.path.lexists(f'{root}/dev/null'):
+            os.symlink(os.devnull, f'{root}/dev/null')
+        self.device_numbers = {}  # node name: (major, minor)
+        open(f'{root}/device_numbers', 'w', encoding='utf-8').close()
+        self.set_mounted([])
+        self.set_root(None)
+        self.set_cmdline('console=ttyS0,115200n8')
+        self.commands = []
+        self.server = socket.create_server(('127.0.0.1', 0))
+        self.port = self.server.getsockname()[1]
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+
+    def node(self, name:str) -> str:
+        """ file standing in for /dev/name """
+        return f'{self.root}/dev/{name}'
+
+    def write_node(self, name:str, data:bytes):
+        with open(self.node(name), 'wb') as nfl:
+            nfl.write(data)
+        if name not in self.device_numbers:
+            self.set_device_number(name, MMC_MAJOR, len(self.device_numbers) + 1)
+
+    def set_device_number(self, name:str, major:int, minor:int):
+        """ give a node a block device number; nodes for the same number stand for the same device """
+        self.device_numbers[name] = (major, minor)
+        with open(f'{self.root}/device_numbers', 'w', encoding='utf-8') as dnf:
+            for (node_name, (node_major, node_minor)) in self.device_numbers.items():
+                dnf.write(f'{self.node(node_name)} {node_major:x}:{node_minor:x}\n')
+
+    def set_root(self, name:str):
+        """ make a node the device of the root filesystem, as stat -c %d / reports it; None for a device which is not a partition """
+        (major, minor) = self.device_numbers[name] if name else (8, 1)
+        with open(f'{self.root}/root_device', 'w', encoding='utf-8') as rdf:
+            rdf.write(f'{(minor & 0xff) | (major << 8) | ((minor & ~0xff) << 12)}\n')
+
+    def set_cmdline(self, cmdline:str):
+        with open(f'{self.root}/proc/cmdline', 'w', encoding='utf-8') as cmf:
+            cmf.write(cmdline + '\n')
+
+    def read_node(self, name:str) -> bytes:
+        with open(self.node(name), 'rb') as nfl:
+            return nfl.read()
+
+    def set_mounted(self, names:list):
+        """ list partitions as mounted, in /proc/mounts """
+        with open(f'{self.root}/proc/mounts', 'w', encoding='utf-8') as mfl:
+            for index, name in enumerate(names):
+                mfl.write(f'{self.node(name)} /mnt/{index} ext4 rw 0 0\n')
+
+    def accept_loop(self):
+        while True:
+            try:
+                (conn, _address) = self.server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def handle(self, conn:socket.socket):
+        with conn:
+            line = b''
+            while not line.endswith(b'\n'):
+                data = conn.recv(1)
+                if not data:
+                    return
+                line += data
+            command = line.decode('utf-8').rstrip('\n')
+            self.commands.append(command)
+            command = re.sub(r'/(dev|proc)/', f'{self.root}/\\1/', command)
+            environment = dict(os.environ, DEVICE_NUMBERS=f'{self.root}/device_numbers', ROOT_DEVICE=f'{self.root}/root_device')
+            subprocess.run(['sh', '-c', BLOCKDEV + STAT + command], stdin=conn.fileno(), stdout=conn.fileno(), stderr=subprocess.DEVNULL, env=environment, check=False)
+
+    def close(self):
+        self.server.close()
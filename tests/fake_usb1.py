@@ -0,0 +1,181 @@
+"""
+Stand-in for python-libusb1 (usb1), backed by a simulated device in USB Burn Mode, with per-transfer latency
+
+Only what superbird_async uses is implemented: memory reads (control transfers) and large memory writes (control setup + bulk transfers)
+Transfers complete in order of submission, each LATENCY seconds after it was submitted, so keeping several in flight is faster
+Like the ctypes callbacks of the real module, exceptions raised in a transfer callback are printed and swallowed
+"""
+import heapq
+import itertools
+import struct
+import time
+import traceback
+
+TRANSFER_COMPLETED = 0
+TRANSFER_ERROR = 1
+TRANSFER_CANCELLED = 3
+
+RAM_BASE = 0x10000000
+RAM_SIZE = 64 * 1024 * 1024
+ENDPOINT_OUT = 0x02
+
+
+class FakeDevice:
+    """ simulated device: RAM, and knobs for failures """
+    def __init__(self, latency:float=0.002) -> None:
+        self.latency = latency
+        self.ram = bytearray(RAM_SIZE)
+        self.short_read_address = None  # reads of this address return fewer bytes than asked for
+        self.fail_bulk_at = None  # the Nth bulk transfer (counting from 1) fails
+        self.bulk_count = 0
+        self.large_writes = []  # (address, length, block_size, block_count) of each large memory write set up
+        self.max_in_flight = 0
+
+
+class _Endpoint:
+    def __init__(self, address:int, attributes:int) -> None:
+        self.address = address
+        self.attributes = attributes
+
+    def getAddress(self):
+        return self.address
+
+    def getAttributes(self):
+        return self.attributes
+
+
+class _Device:
+    def iterSettings(self):
+        return iter([[_Endpoint(0x81, 0x02), _Endpoint(ENDPOINT_OUT, 0x02)]])
+
+
+class USBContext:
+    """ event loop: completes transfers in order, once their latency has passed """
+    def __init__(self, device:FakeDevice=None) -> None:
+        self.device = device or FakeDevice()
+        self.queue = []
+        self.sequence = itertools.count()
+        self.in_flight = 0
+
+    def openByVendorIDAndProductID(self, _vendor_id, _product_id):
+        return USBDeviceHandle(self)
+
+    def close(self):
+        pass
+
+    def handleEvents(self):
+        if not self.queue:
+            # real libusb would block here until something happens, which with nothing in flight is forever
+            raise RuntimeError('handleEvents called with no transfers in flight')
+        (due, _sequence, transfer) = heapq.heappop(self.queue)
+        delay = due - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        self.in_flight -= 1
+        transfer.complete()
+
+
+class USBDeviceHandle:
+    def __init__(self, context:USBContext) -> None:
+        self.context = context
+        self.device = context.device
+        self.claimed = False
+        self.large_write = None  # [address, length, written]
+
+    def getDevice(self):
+        return _Device()
+
+    def close(self):
+        pass
+
+    def claimInterface(self, _interface):
+        assert not self.claimed, 'interface already claimed'
+        self.claimed = True
+
+    def releaseInterface(self, _interface):
+        self.claimed = False
+
+    def getTransfer(self):
+        return USBTransfer(self)
+
+    def controlWrite(self, _request_type, _request, value, index, data, timeout=0):  # pylint: disable=unused-argument
+        time.sleep(self.device.latency)
+        (address, length, _, _) = struct.unpack('<IIII', data)
+        self.large_write = [address, length, 0]
+        self.device.large_writes.append((address, length, value, index))
+        return len(data)
+
+
+class USBTransfer:
+    def __init__(self, handle:USBDeviceHandle) -> None:
+        self.handle = handle
+        self.submitted = False
+        self.cancelled = False
+        self.user_data = None
+        self.kind = None
+        self.callback = None
+        self.status = None
+        self.buffer = b''
+
+    def setControl(self, _request_type, _request, value, index, length, callback=None, timeout=0):  # pylint: disable=unused-argument
+        (self.kind, self.address, self.length, self.callback) = ('control', (value << 16) | index, length, callback)
+
+    def setBulk(self, endpoint, buffer, callback=None, timeout=0):  # pylint: disable=unused-argument
+        assert endpoint == ENDPOINT_OUT
+        (self.kind, self.buffer, self.callback) = ('bulk', bytes(buffer), callback)
+
+    def setUserData(self, data):
+        self.user_data = data
+
+    def getUserData(self):
+        return self.user_data
+
+    def isSubmitted(self):
+        return self.submitted
+
+    def submit(self):
+        assert not self.submitted, 'transfer submitted twice'
+        if self.kind == 'bulk':
+            assert self.handle.claimed, 'bulk transfer without claiming the interface'
+        context = self.handle.context
+        self.submitted = True
+        context.in_flight += 1
+        context.device.max_in_flight = max(context.device.max_in_flight, context.in_flight)
+        heapq.heappush(context.queue, (time.perf_counter() + context.device.latency, next(context.sequence), self))
+
+    def cancel(self):
+        self.cancelled = True
+
+    def complete(self):
+        device = self.handle.device
+        self.submitted = False
+        self.status = TRANSFER_COMPLETED
+        if self.cancelled:
+            (self.status, self.cancelled) = (TRANSFER_CANCELLED, False)
+        elif self.kind == 'control':
+            start = self.address - RAM_BASE
+            length = self.length // 2 if self.address == device.short_read_address else self.length
+            self.buffer = bytes(device.ram[start:start + length])
+        else:
+            device.bulk_count += 1
+            if device.bulk_count == device.fail_bulk_at:
+                self.status = TRANSFER_ERROR
+            else:
+                (address, _length, written) = self.handle.large_write
+                start = address - RAM_BASE + written
+                device.ram[start:start + len(self.buffer)] = self.buffer
+                self.handle.large_write[2] += len(self.buffer)
+        try:
+            self.callback(self)
+        except Exception:  # pylint: disable=broad-except
+            # what ctypes does with an exception raised in a callback
+            traceback.print_exc()
+
+    def getStatus(self):
+        return self.status
+
+    def getBuffer(self):
+        return self.buffer
+
+    def getActualLength(self):
+        return len(self.buffer)
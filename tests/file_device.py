@@ -0,0 +1,49 @@
+"""
+Stand-in for SuperbirdDevice, with one partition backed by a file
+
+Only the partition access used by PartitionReader and the NBD server is implemented, with the same sector alignment rules as the device
+"""
+import os
+
+PART_SIZE = 16 * 1024 * 1024
+
+
+class FileDevice:
+    """ every partition name maps to the same file; reads and writes record each chunk accessed, as (offset, size) """
+    PART_SECTOR_SIZE = 512
+    READ_CHUNK_SIZE = 128 * 1024
+    WRITE_CHUNK_SIZE = 512 * 1024
+
+    def __init__(self, path:str, size:int=PART_SIZE) -> None:
+        self.path = path
+        self.size = size
+        self.partition_table_loaded = True
+        self.env_cache = None
+        self.reads = []
+        self.writes = []
+        with open(path, 'wb') as pfl:
+            pfl.write(os.urandom(size))
+
+    def contents(self) -> bytes:
+        with open(self.path, 'rb') as pfl:
+            return pfl.read()
+
+    def validate_partition_size(self, _part_name:str) -> tuple:
+        return (self.size, 0)
+
+    def retry(self, _description:str, function, *args, **kwargs):
+        return function(*args, **kwargs)
+
+    def read_partition_chunk(self, _part_name:str, offset:int, size:int) -> bytes:
+        assert offset % self.PART_SECTOR_SIZE == 0 and size % self.PART_SECTOR_SIZE == 0 and size <= self.READ_CHUNK_SIZE
+        self.reads.append((offset, size))
+        with open(self.path, 'rb') as pfl:
+            pfl.seek(offset)
+            return pfl.read(size)
+
+    def write_partition_chunk(self, _part_name:str, data:bytes, offset:int, size:int):
+        assert offset % self.PART_SECTOR_SIZE == 0 and size % self.PART_SECTOR_SIZE == 0 and size <= self.WRITE_CHUNK_SIZE and len(data) == size
+        self.writes.append((offset, size))
+        with open(self.path, 'r+b') as pfl:
+            pfl.seek(offset)
+            pfl.write(data)
@@ -0,0 +1,78 @@
+"""
+superbird_async against a stand-in for python-libusb1 (fake_usb1), with simulated latency
+"""
+import os
+import time
+
+import pytest
+
+pytest.importorskip('usb.core')  # superbird_async errors are USBErrors, from pyusb
+
+import fake_usb1  # pylint: disable=wrong-import-position
+import superbird_async  # pylint: disable=wrong-import-position
+from superbird_async import AsyncTransferEngine, AsyncTransferError  # pylint: disable=wrong-import-position
+
+ADDRESS = fake_usb1.RAM_BASE + 0x100000
+
+
+@pytest.fixture(name='device')
+def fixture_device(monkeypatch):
+    monkeypatch.setattr(superbird_async, 'usb1', fake_usb1)
+    return fake_usb1.FakeDevice()
+
+
+def make_engine(device, depth):
+    context = fake_usb1.USBContext(device)
+    return AsyncTransferEngine(context, context.openByVendorIDAndProductID(0x1b8e, 0xc003), depth)
+
+
+def test_write_then_read(device):
+    engine = make_engine(device, 8)
+    data = os.urandom(256 * 1024)
+    engine.write_large_memory(ADDRESS, data, 4096)
+    assert engine.read_memory(ADDRESS, 1000) == data[:1000]
+    assert engine.read_memory(ADDRESS + 4000, 100) == data[4000:4100]
+    assert device.large_writes == [(ADDRESS, len(data), 4096, 64)]
+    assert device.max_in_flight == 8
+
+
+def test_depth_hides_latency(device):
+    data = os.urandom(64 * 4096)
+    timings = []
+    for depth in (1, 16):
+        engine = make_engine(device, depth)
+        start = time.perf_counter()
+        engine.write_large_memory(ADDRESS, data, 4096)
+        timings.append(time.perf_counter() - start)
+    assert timings[1] * 4 < timings[0]
+
+
+def test_short_read_fails_instead_of_hanging(device):
+    engine = make_engine(device, 4)
+    device.short_read_address = ADDRESS + 128
+    with pytest.raises(AsyncTransferError, match='short read'):
+        engine.read_memory(ADDRESS, 512)
+    # nothing may be left in flight
+    assert not engine.context.queue
+
+
+def test_failed_bulk_transfer(device):
+    engine = make_engine(device, 4)
+    device.fail_bulk_at = 5
+    with pytest.raises(AsyncTransferError):
+        engine.write_large_memory(ADDRESS, bytes(32 * 4096), 4096)
+    assert not engine.context.queue
+    assert not engine.handle.claimed
+
+
+def test_large_writes_are_split(device, monkeypatch):
+    monkeypatch.setattr(superbird_async, 'MAX_WRITE_BLOCKS', 16)
+    engine = make_engine(device, 8)
+    data = os.urandom(40 * 512)
+    engine.write_large_memory(ADDRESS, data, 512)
+    assert device.large_writes == [
+        (ADDRESS, 16 * 512, 512, 16),
+        (ADDRESS + 16 * 512, 16 * 512, 512, 16),
+        (ADDRESS + 32 * 512, 8 * 512, 512, 8),
+    ]
+    assert engine.read_memory(ADDRESS, len(data)) == data
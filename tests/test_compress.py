@@ -0,0 +1,104 @@
+"""
+superbird_compress: packed spans, expanded the way the device does it, with mw.l and cp.l in RAM
+"""
+import os
+
+from superbird_compress import MAX_COMMAND_LENGTH, PACK_BLOCK_SIZE, pack_chunk, pack_span, packed_spans, plan_chunk
+
+RAM_BASE = 0x12000000
+ADDR_SCRATCH = 0x12000000
+ADDR_TMP = 0x13000000
+MIN_SIZE = 512 * 1024
+SPAN_SIZE = 4 * 1024 * 1024
+
+
+def expand(packed, size:int) -> bytes:
+    """ upload literal to scratch, run the fills and copies of the command, return the expanded chunk """
+    ram = bytearray(ADDR_TMP - RAM_BASE + size)
+    ram[ADDR_TMP - RAM_BASE:] = b'\xee' * size  # left over from an earlier chunk
+    ram[ADDR_SCRATCH - RAM_BASE:ADDR_SCRATCH - RAM_BASE + len(packed.literal)] = packed.literal
+    for command in packed.command.split(' && '):
+        words = command.split()
+        if words[0] == 'mw.l':
+            (address, value, count) = (int(word, 16) for word in words[1:])
+            ram[address - RAM_BASE:address - RAM_BASE + count * 4] = value.to_bytes(4, 'little') * count
+        else:
+            assert words[0] == 'cp.l'
+            (source, target, count) = (int(word, 16) for word in words[1:])
+            ram[target - RAM_BASE:target - RAM_BASE + count * 4] = ram[source - RAM_BASE:source - RAM_BASE + count * 4]
+    return bytes(ram[ADDR_TMP - RAM_BASE:])
+
+
+def mixed_image(size:int) -> bytes:
+    """ data, empty space, erased flash and repeated blocks, in runs of various lengths """
+    repeated = os.urandom(PACK_BLOCK_SIZE)
+    pieces = []
+    for index in range(size // (64 * 1024)):
+        kind = index % 5
+        if kind == 0:
+            pieces.append(os.urandom(64 * 1024))
+        elif kind == 1:
+            pieces.append(bytes(64 * 1024))
+        elif kind == 2:
+            pieces.append(b'\xff' * 64 * 1024)
+        elif kind == 3:
+            pieces.append(repeated * 16)
+        else:
+            pieces.append(os.urandom(PACK_BLOCK_SIZE) + bytes(60 * 1024))
+    return b''.join(pieces)
+
+
+def check_pieces(data:bytes, offset:int, pieces:list, max_length:int):
+    """ pieces cover the span in order, and each packed piece expands to the data it replaces """
+    position = offset
+    for (piece_offset, size, packed) in pieces:
+        assert piece_offset == position
+        if packed is None:
+            assert size <= MIN_SIZE
+        else:
+            assert len(packed.command) <= max_length
+            assert expand(packed, size) == data[piece_offset:piece_offset + size]
+        position += size
+    return position
+
+
+def test_plan_chunk_round_trip():
+    data = mixed_image(1024 * 1024)
+    (literal, command) = plan_chunk(data, 1, True, ADDR_TMP, ADDR_SCRATCH)
+    packed = pack_chunk(data, ADDR_TMP, ADDR_SCRATCH, len(command))
+    assert packed.literal == literal
+    assert expand(packed, len(data)) == data
+    assert len(literal) < len(data) // 2
+
+
+def test_pack_span_round_trip(tmp_path):
+    image = tmp_path / 'image.raw'
+    data = mixed_image(SPAN_SIZE) + os.urandom(SPAN_SIZE) + bytes(SPAN_SIZE - 1000) + os.urandom(1000)
+    image.write_bytes(data)
+    max_length = MAX_COMMAND_LENGTH - 60
+    sent = 0
+    for offset in range(0, len(data), SPAN_SIZE):
+        pieces = pack_span(str(image), offset, SPAN_SIZE, MIN_SIZE, ADDR_TMP, ADDR_SCRATCH, max_length)
+        assert check_pieces(data, offset, pieces, max_length) == offset + SPAN_SIZE
+        sent += sum(size if packed is None else packed.wire_size() for (_offset, size, packed) in pieces)
+    assert sent < len(data) * 3 // 4
+
+
+def test_pack_span_past_end_of_file(tmp_path):
+    image = tmp_path / 'image.raw'
+    data = os.urandom(SPAN_SIZE // 2 + 512)
+    image.write_bytes(data)
+    padded = data + bytes(SPAN_SIZE - len(data))
+    pieces = pack_span(str(image), 0, SPAN_SIZE, MIN_SIZE, ADDR_TMP, ADDR_SCRATCH, MAX_COMMAND_LENGTH)
+    assert check_pieces(padded, 0, pieces, MAX_COMMAND_LENGTH) == SPAN_SIZE
+
+
+def test_packed_spans_in_order(tmp_path):
+    image = tmp_path / 'image.raw'
+    data = mixed_image(3 * SPAN_SIZE)
+    image.write_bytes(data)
+    spans = [(offset, SPAN_SIZE) for offset in range(0, len(data), SPAN_SIZE)]
+    position = 0
+    for pieces in packed_spans(str(image), spans, MIN_SIZE, ADDR_TMP, ADDR_SCRATCH, MAX_COMMAND_LENGTH):
+        position = check_pieces(data, position, pieces, MAX_COMMAND_LENGTH)
+    assert position == len(data)
@@ -0,0 +1,67 @@
+"""
+SuperbirdDevice.bulkcmd retries, against a stand-in for pyamlboot.AmlogicSoC which times out on chosen commands
+"""
+import pytest
+
+pytest.importorskip('usb.core')  # superbird_device needs pyusb and pyamlboot
+pytest.importorskip('pyamlboot')
+
+import superbird_device  # pylint: disable=wrong-import-position
+from superbird_device import SuperbirdDevice  # pylint: disable=wrong-import-position
+from usb.core import USBTimeoutError  # pylint: disable=wrong-import-position
+
+
+class TimeoutSoC:
+    """ runs no commands, only records them; the first command containing each of time_out_on times out, after it was received """
+    commands = []
+    time_out_on = []
+
+    def bulkCmd(self, command:str):  # pylint: disable=invalid-name
+        TimeoutSoC.commands.append(command)
+        for word in TimeoutSoC.time_out_on:
+            if word in command:
+                TimeoutSoC.time_out_on.remove(word)
+                raise USBTimeoutError('Operation timed out')
+        return memoryview(b'success')
+
+
+@pytest.fixture(name='dev')
+def fixture_dev(monkeypatch):
+    monkeypatch.setattr(superbird_device.pyamlboot, 'AmlogicSoC', TimeoutSoC)
+    monkeypatch.setattr(superbird_device, 'check_device_mode', lambda mode, silent=False: True)
+    monkeypatch.setattr(superbird_device.time, 'sleep', lambda seconds: None)
+    (TimeoutSoC.commands, TimeoutSoC.time_out_on) = ([], [])
+    dev = SuperbirdDevice()
+    TimeoutSoC.commands = []
+    return dev
+
+
+def test_is_idempotent(dev):
+    assert dev.is_idempotent('amlmmc read system_a 0x13000000 0x0 0x100000')
+    assert dev.is_idempotent('mw.l 0x12fff000 0 1 && amlmmc read env 0x13000000 0x0 0x200 && crc32 0x13000000 0x200 0x12fff000')
+    assert dev.is_idempotent('setenv initargs "init=/sbin/pre-init"; env save')
+    assert not dev.is_idempotent('setenv initargs "${initargs} ro rootwait"')
+    assert not dev.is_idempotent('amlmmc part 1; booti 0x1080000')
+
+
+def test_idempotent_command_is_retried(dev):
+    TimeoutSoC.time_out_on = ['amlmmc read', 'amlmmc read']  # twice, so the handle is re-opened
+    dev.partition_table_loaded = True
+    dev.partition_cache['system_a'] = (1024, 0)
+    dev.env_cache = {'bootdelay': '1'}
+    dev.bulkcmd('amlmmc read system_a 0x13000000 0x0 0x100000')
+    assert dev.retry_count == 2
+    # the device may have been reset, so the partition table was loaded again before the last attempt
+    assert TimeoutSoC.commands[-2:] == ['amlmmc part 1', 'amlmmc read system_a 0x13000000 0x0 0x100000']
+    assert (dev.partition_table_loaded, dev.partition_cache, dev.env_cache) == (True, {}, None)
+
+
+def test_appending_setenv_is_not_retried(dev):
+    TimeoutSoC.time_out_on = ['setenv']
+    with pytest.raises(SystemExit):
+        dev.bulkcmd('setenv initargs "${initargs} ro rootwait"')
+    assert TimeoutSoC.commands == ['setenv initargs "${initargs} ro rootwait"']
+    # callers can still opt in
+    TimeoutSoC.time_out_on = ['setenv']
+    dev.bulkcmd('setenv bootargs "${initargs}"', retry=True)
+    assert TimeoutSoC.commands[-2:] == ['setenv bootargs "${initargs}"'] * 2
@@ -0,0 +1,126 @@
+"""
+superbird_fingerprint against a stand-in device which runs the amlmmc read / mw.l / crc32 commands it sends
+"""
+import binascii
+import json
+import os
+import struct
+
+import pytest
+
+from superbird_fingerprint import MAX_COMMAND_LENGTH, FINGERPRINT_PARTITIONS, add_to_catalog, fingerprint, sample_partition, sample_ranges
+from superbird_partitions import DUMP_FILENAMES
+
+PART_SIZE = 1024 * 1024
+
+
+class CrcDevice:
+    """ runs the commands fingerprint sends, on partitions held as bytes; fail_on: partition names whose reads fail with fail_with """
+    ADDR_TMP = 0x13000000
+    ADDR_CRC = 0x12fff000
+
+    def __init__(self, partitions:dict) -> None:
+        self.partitions = partitions
+        self.memory = {}  # address: bytes
+        self.commands = []
+        self.partition_table_loaded = True
+        self.fail_on = []
+        self.fail_with = RuntimeError
+
+    def validate_partition_size(self, part_name:str) -> tuple:
+        if part_name not in self.partitions:
+            return (None, None)
+        return (len(self.partitions[part_name]) - (512 if part_name == 'bootloader' else 0), 0)
+
+    def retry(self, _description:str, function, *args, **kwargs):
+        return function(*args, **kwargs)
+
+    @staticmethod
+    def crc_command(address:int, size:int, result_address:int) -> str:
+        return f'mw.l {hex(result_address)} 0 1 && crc32 {hex(address)} {hex(size)} {hex(result_address)}'
+
+    @staticmethod
+    def crc_matches(result:bytes, crc:int) -> bool:
+        return struct.unpack('<I', result)[0] == crc
+
+    def bulkcmd_once(self, command:str, silent:bool=False):  # pylint: disable=unused-argument
+        assert len(command) <= MAX_COMMAND_LENGTH
+        self.commands.append(command)
+        for part in command.split(' && '):
+            words = part.split()
+            if words[:2] == ['amlmmc', 'read']:
+                (part_name, address, offset, size) = (words[2], int(words[3], 16), int(words[4], 16), int(words[5], 16))
+                data = self.partitions[part_name]
+                if part_name in self.fail_on or offset + size > len(data):
+                    raise self.fail_with('Bulkcmd failed')
+                self.memory[address] = data[offset:offset + size]
+            elif words[0] == 'mw.l':
+                self.memory[int(words[1], 16)] = bytes(4)
+            elif words[0] == 'crc32':
+                (address, size, result_address) = (int(word, 16) for word in words[1:])
+                self.memory[result_address] = struct.pack('<I', binascii.crc32(self.memory[address][:size]))
+
+    def read_memory(self, address:int, size:int) -> bytes:
+        return b''.join(self.memory[address + offset] for offset in range(0, size, 4))
+
+
+def make_dump(folder, changed:tuple=()) -> dict:
+    """ write a dump of random firmware partitions to folder, returns partitions as the device holds them """
+    os.makedirs(folder)
+    partitions = {}
+    for part_name in FINGERPRINT_PARTITIONS:
+        data = bytearray(os.urandom(PART_SIZE))
+        if part_name in changed:
+            data[:4] = b'diff'
+        with open(os.path.join(folder, DUMP_FILENAMES[part_name]), 'wb') as dmf:
+            dmf.write(data)
+        partitions[part_name] = (bytes(512) + bytes(data)) if part_name == 'bootloader' else bytes(data)
+    return partitions
+
+
+def test_sample_partition_batches_and_clamps():
+    data = os.urandom(PART_SIZE)
+    dev = CrcDevice({'system_a': data})
+    ranges = sample_ranges(PART_SIZE) + [(PART_SIZE - 1024, 4096), (PART_SIZE, 4096)] + [(offset, 4096) for offset in range(0, 64 * 1024, 4096)]
+    results = sample_partition(dev, 'system_a', ranges, PART_SIZE)
+    assert len(dev.commands) > 1
+    for (offset, size) in ranges:
+        if offset >= PART_SIZE:
+            assert results[(offset, size)] is None
+        else:
+            assert dev.crc_matches(results[(offset, size)], binascii.crc32(data[offset:offset + size]))
+
+
+def test_fingerprint(tmp_path, capsys):
+    pytest.importorskip('usb.core')  # fingerprint catches BulkcmdException, from superbird_device
+    from superbird_device import BulkcmdException  # pylint: disable=import-outside-toplevel
+    catalog = str(tmp_path / 'catalog.json')
+    stock = make_dump(str(tmp_path / 'stock'))
+    custom = make_dump(str(tmp_path / 'custom'), changed=('system_a', 'boot_a'))
+    add_to_catalog(catalog, str(tmp_path / 'stock'), 'stock')
+    add_to_catalog(catalog, str(tmp_path / 'custom'), 'custom')
+    capsys.readouterr()
+
+    fingerprint(CrcDevice(stock), catalog)
+    assert 'Device matches: stock\n' in capsys.readouterr().out
+    fingerprint(CrcDevice(custom), catalog)
+    assert 'Device matches: custom\n' in capsys.readouterr().out
+
+    # a partition which fails to read is unknown, and the rest still match
+    dev = CrcDevice(custom)
+    (dev.fail_on, dev.fail_with) = (['boot_a'], BulkcmdException)
+    fingerprint(dev, catalog)
+    output = capsys.readouterr().out
+    assert 'Could not sample: boot_a;' in output
+    assert 'Device matches: custom\n' in output
+
+    # so is a partition this tool does not sample, in a catalog from elsewhere
+    with open(catalog, encoding='utf-8') as ctf:
+        entries = json.load(ctf)
+    entries['images']['custom']['settings'] = [{'offset': 0, 'size': 4096, 'crc': 0}]
+    with open(catalog, 'w', encoding='utf-8') as ctf:
+        json.dump(entries, ctf)
+    fingerprint(CrcDevice(custom), catalog)
+    output = capsys.readouterr().out
+    assert 'Could not sample: settings;' in output
+    assert 'Device matches: custom\n' in output
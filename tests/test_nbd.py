@@ -0,0 +1,101 @@
+"""
+superbird_nbd end to end: NbdServer serving a file-backed device (file_device), NbdClient talking to it over a Unix socket
+"""
+import os
+import socket
+import threading
+
+import pytest
+
+if not hasattr(socket, 'AF_UNIX'):
+    pytest.skip('NBD needs Unix sockets', allow_module_level=True)
+
+import superbird_session  # pylint: disable=wrong-import-position
+import superbird_tool  # pylint: disable=wrong-import-position
+from file_device import FileDevice  # pylint: disable=wrong-import-position
+from superbird_nbd import NbdServer, NbdClient, NbdError, PartitionExport, serve_nbd, NBD_FLAG_READ_ONLY  # pylint: disable=wrong-import-position
+
+
+@pytest.fixture(name='dev')
+def fixture_dev(tmp_path):
+    return FileDevice(str(tmp_path / 'settings.img'))
+
+
+def serve_once(export, socket_path:str) -> threading.Thread:
+    """ serve one client in a thread """
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(1)
+
+    def serve():
+        with server:
+            (connection, _address) = server.accept()
+            with connection:
+                NbdServer(export).serve(connection)
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_read_only(dev, tmp_path):
+    expected = dev.contents()
+    socket_path = str(tmp_path / 'nbd.sock')
+    thread = serve_once(PartitionExport(dev, 'settings'), socket_path)
+    with NbdClient(socket_path, 'settings') as client:
+        assert client.size == dev.size
+        assert client.flags & NBD_FLAG_READ_ONLY
+        assert client.read(1000, 3000) == expected[1000:4000]
+        assert client.read(dev.size - 4096, 4096) == expected[-4096:]
+        with pytest.raises(NbdError):
+            client.write(0, b'x' * 512)
+        with pytest.raises(NbdError):
+            client.read(dev.size - 10, 20)
+    thread.join(5)
+    assert not dev.writes
+    assert dev.contents() == expected
+
+
+def test_writes_are_coalesced(dev, tmp_path):
+    expected = bytearray(dev.contents())
+    socket_path = str(tmp_path / 'nbd.sock')
+    thread = serve_once(PartitionExport(dev, 'settings', writable=True), socket_path)
+    with NbdClient(socket_path, 'settings') as client:
+        for index in range(256):
+            data = os.urandom(4096)
+            offset = 65536 + index * 4096
+            client.write(offset, data)
+            expected[offset:offset + len(data)] = data
+        client.write(10, b'hello')
+        expected[10:15] = b'hello'
+        # pending writes are seen by reads, before they reach the device
+        assert client.read(0, 2 * 1024 * 1024) == expected[:2 * 1024 * 1024]
+        assert not dev.writes
+        client.flush()
+        assert dev.writes == [(0, 512), (65536, 512 * 1024), (65536 + 512 * 1024, 512 * 1024)]
+        client.write(8 * 1024 * 1024, b'z' * 700, fua=True)
+        expected[8 * 1024 * 1024:8 * 1024 * 1024 + 700] = b'z' * 700
+    thread.join(5)
+    assert dev.contents() == bytes(expected)
+
+
+def test_serve_nbd_keeps_files(dev, tmp_path):
+    path = tmp_path / 'notes.txt'
+    path.write_text('not a socket')
+    with pytest.raises(SystemExit):
+        serve_nbd(dev, 'settings', str(path))
+    assert path.read_text() == 'not a socket'
+
+
+def test_serve_nbd_keeps_running_server(dev, tmp_path):
+    socket_path = str(tmp_path / 'nbd.sock')
+    thread = serve_once(PartitionExport(dev, 'settings'), socket_path)
+    with pytest.raises(SystemExit):
+        serve_nbd(dev, 'settings', socket_path)
+    thread.join(5)
+    assert os.path.exists(socket_path)
+
+
+def test_serve_nbd_refused_during_session(monkeypatch, tmp_path):
+    monkeypatch.setattr(superbird_session, 'session_available', lambda: True)
+    with pytest.raises(SystemExit):
+        superbird_tool.run_device('serve_nbd', ['settings', str(tmp_path / 'nbd.sock')])
@@ -0,0 +1,99 @@
+"""
+superbird_network over TcpTransport, against a stand-in for the shell agent (fake_agent)
+"""
+import os
+import shutil
+import struct
+import binascii
+
+import pytest
+
+from fake_agent import FakeAgent, COMMAND_TOOLS
+from superbird_network import TcpTransport, NetworkUnsupportedError, BOOTLOADER_SIZE, is_mounted, PART_SECTOR_SIZE, RESTORE_PARTITIONS, dump_device, restore_device, restore_partition
+from superbird_partitions import DUMP_FILENAMES
+
+pytestmark = pytest.mark.skipif(any(shutil.which(tool) is None for tool in COMMAND_TOOLS), reason='needs the shell tools the agent runs')
+
+PART_SIZE = 64 * 1024
+MOUNTED = ['system_a', 'settings', 'data']
+ENV_DATA = b'bootdelay=1\x00storeboot=run update\x00\x00'
+
+
+def env_image() -> bytes:
+    data = ENV_DATA + bytes(PART_SIZE - 4 - len(ENV_DATA))
+    return struct.pack('<I', binascii.crc32(data)) + data
+
+
+@pytest.fixture(name='agent')
+def fixture_agent(tmp_path):
+    agent = FakeAgent(str(tmp_path / 'device'))
+    agent.write_node('mmcblk0', os.urandom(PART_SECTOR_SIZE + BOOTLOADER_SIZE))
+    for part_name in DUMP_FILENAMES:
+        if part_name == 'env':
+            agent.write_node(part_name, env_image())
+        elif part_name != 'bootloader':
+            agent.write_node(part_name, os.urandom(PART_SIZE))
+    yield agent
+    agent.close()
+
+
+def test_dump_restore_round_trip(agent, tmp_path, capsys):
+    transport = TcpTransport('127.0.0.1', agent.port)
+    folder = str(tmp_path / 'dump')
+    agent.set_mounted(MOUNTED)
+    dump_device(transport, folder)
+    assert open(f'{folder}/bootloader.dump', 'rb').read() == agent.read_node('mmcblk0')[PART_SECTOR_SIZE:]
+    for part_name in RESTORE_PARTITIONS:
+        assert open(f'{folder}/{DUMP_FILENAMES[part_name]}', 'rb').read() == agent.read_node(part_name)
+    assert open(f'{folder}/env.dump', 'rb').read() == agent.read_node('env')
+    assert open(f'{folder}/env.txt', encoding='utf-8').read() == 'bootdelay=1\nstoreboot=run update\n'
+
+    # wipe the device, restore it from the dump
+    before = {part_name: agent.read_node(part_name) for part_name in RESTORE_PARTITIONS}
+    for part_name in RESTORE_PARTITIONS:
+        agent.write_node(part_name, bytes(PART_SIZE))
+    capsys.readouterr()
+    restore_device(transport, folder)
+    output = capsys.readouterr().out
+    for part_name in RESTORE_PARTITIONS:
+        if part_name in MOUNTED:
+            # mounted partitions are skipped, and listed to restore in USB Burn Mode
+            assert agent.read_node(part_name) == bytes(PART_SIZE)
+            assert f'restore_partition {part_name} {folder}/{DUMP_FILENAMES[part_name]}' in output
+        else:
+            assert agent.read_node(part_name) == before[part_name]
+    assert not any(f'of={agent.node(part_name)}' in command or f"of='/dev/{part_name}'" in command for part_name in MOUNTED for command in agent.commands)
+
+
+def test_restore_mounted_partition_is_unsupported(agent, tmp_path):
+    transport = TcpTransport('127.0.0.1', agent.port)
+    image = tmp_path / 'system.img'
+    image.write_bytes(os.urandom(PART_SIZE))
+    agent.set_mounted(['system_b'])
+    with pytest.raises(NetworkUnsupportedError):
+        restore_partition(transport, 'system_a,system_b', str(image))
+    # nothing was written, not even to the partition which is not mounted
+    assert agent.read_node('system_a') != image.read_bytes()
+    with pytest.raises(NetworkUnsupportedError):
+        restore_partition(transport, 'env', str(image))
+
+
+def test_root_slot_is_mounted(agent):
+    """ after disable_avb2, root is given as root=/dev/mmcblk0p14, and mounted as /dev/root; neither names system_a """
+    transport = TcpTransport('127.0.0.1', agent.port)
+    agent.set_cmdline('console=ttyS0,115200n8 ro root=/dev/mmcblk0p14 rootfstype=ext4')
+    agent.write_node('mmcblk0p14', b'')
+    agent.set_device_number('mmcblk0p14', *agent.device_numbers['system_a'])
+    with open(f'{agent.root}/proc/mounts', 'w', encoding='utf-8') as mfl:
+        mfl.write('/dev/root / ext4 ro 0 0\nproc /proc proc rw 0 0\n')
+    agent.set_root('system_a')
+    assert is_mounted(transport, 'system_a')
+    assert not is_mounted(transport, 'system_b')
+    with pytest.raises(NetworkUnsupportedError):
+        restore_partition(transport, 'system_a', agent.node('system_b'))
+    # mounted by its mmcblk0pN name, rather than as root
+    agent.set_root(None)
+    agent.set_mounted(['mmcblk0p14'])
+    assert is_mounted(transport, 'system_a')
+    agent.set_mounted([])
+    assert not is_mounted(transport, 'system_a')
@@ -0,0 +1,79 @@
+"""
+superbird_session: operations and their options, sent from a client to a session over its socket
+"""
+import socket
+import threading
+
+import pytest
+
+if not hasattr(socket, 'AF_UNIX'):
+    pytest.skip('sessions need Unix sockets', allow_module_level=True)
+
+import superbird_session  # pylint: disable=wrong-import-position
+from superbird_session import END_SESSION, SESSION_OPTIONS, request_operation, run_session, session_available  # pylint: disable=wrong-import-position
+
+
+class SessionDevice:
+    """ stand-in for SuperbirdDevice, with only the settings sessions can override """
+    RETRY_BUDGET = 5
+    ASYNC_DEPTH = None
+    COMPRESS_CHUNKS = False
+
+    def __init__(self) -> None:
+        self.engine_opened = []  # ASYNC_DEPTH each time the engine was opened, 0 when it was closed
+
+    def open_engine(self):
+        self.engine_opened.append(self.ASYNC_DEPTH)
+
+    def close_engine(self):
+        self.engine_opened.append(0)
+
+
+@pytest.fixture(name='session')
+def fixture_session(monkeypatch, tmp_path):
+    """ run a session in a thread, with an operation which records the settings it ran with """
+    monkeypatch.setattr(superbird_session, 'SESSION_SOCKET', str(tmp_path / 'session.sock'))
+    settings = []
+    monkeypatch.setitem(superbird_session.OPERATIONS, 'record_settings', lambda dev: settings.append({option: getattr(dev, attribute) for option, attribute in SESSION_OPTIONS.items()}))
+    dev = SessionDevice()
+    thread = threading.Thread(target=run_session, args=(dev,), daemon=True)
+    thread.start()
+    while not session_available():
+        thread.join(0.01)
+    yield (dev, settings)
+    request_operation(END_SESSION, [])
+    thread.join(5)
+
+
+def test_options_apply_to_one_operation(session):
+    (dev, settings) = session
+    assert request_operation('record_settings', [], {'retries': 2, 'async_depth': 16, 'compress': True}) == 0
+    assert request_operation('record_settings', []) == 0
+    assert settings == [
+        {'retries': 2, 'async_depth': 16, 'compress': True},
+        {'retries': 5, 'async_depth': None, 'compress': False},
+    ]
+    # the engine was opened for the operation which asked for it, and closed after
+    assert dev.engine_opened == [16, 0]
+
+
+def test_unknown_options_are_ignored(session):
+    (_dev, settings) = session
+    assert request_operation('record_settings', [], {'turbo': True}) == 0
+    assert settings == [{'retries': 5, 'async_depth': None, 'compress': False}]
+
+
+def test_missing_cwd_fails_one_operation(session, tmp_path):
+    (_dev, settings) = session
+    missing = str(tmp_path / 'deleted')
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(superbird_session.SESSION_SOCKET)
+        stream = client.makefile('rwb')
+        superbird_session.send_message(stream, {'operation': 'record_settings', 'args': [], 'cwd': missing})
+        output = superbird_session.read_message(stream)
+        assert f'in {missing}' in output['output']
+        assert superbird_session.read_message(stream) == {'status': 1}
+    assert not settings
+    # the session is still running
+    assert request_operation('record_settings', []) == 0
+    assert len(settings) == 1